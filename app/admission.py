@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Module for admission control in front of the database pool
+
+A request takes one of DB_MAX_CONCURRENCY slots (by default the pool size
+plus its overflow) before it gets a database, and gives it back when done.
+Requests beyond that wait on the event loop, not in the pool or in a
+thread, and are shed with 503 and Retry-After once they waited longer
+than DB_POOL_TIMEOUT_S. A request gives its slot back while it only
+uses the CPU, such as hashing a password, see AsyncDB.idle. The pool
+applies the same timeout to checkouts, for connections taken outside of
+requests.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from prometheus_client import Counter
+
+from app.config import settings
+
+SHED = Counter(
+    "shed_requests_total",
+    "Requests answered 503 because the database was saturated",
+    ("reason",),
+)
+
+
+class Overloaded(Exception):
+    """No database slot freed up in time"""
+
+
+class Admission:
+    """Bound on the requests using the database at once"""
+
+    def __init__(self, limit: int, timeout: float):
+        """Initialize Admission"""
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = None
+
+    def reset(self):
+        """Free every slot, on the running event loop"""
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def acquire(self):
+        """Take a slot, or raise Overloaded"""
+        if self._slots is None:
+            self.reset()
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self._slots.acquire()
+        except TimeoutError:
+            SHED.labels("admission").inc()
+            raise Overloaded
+
+    def release(self):
+        """Give a slot back"""
+        self._slots.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the block, or raise Overloaded"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+admission = Admission(
+    settings.db_max_concurrency
+    or settings.db_pool_size + settings.db_max_overflow,
+    timeout=settings.db_pool_timeout_s,
+)
@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+"""
+Bulk import of users, posts, votes and comments from JSONL or CSV files
+
+Usage: python -m app.bulk_import [--users FILE] [--posts FILE]
+           [--votes FILE] [--comments FILE] [--append]
+           [--checkpoint FILE] [--batch-size N] [--jobs N] [--workers N]
+           [--rounds N]
+
+Files ending in .csv are read as CSV with a header, any other as JSONL.
+Records carry the ids of the source system, which are kept:
+
+    users:    id, username, email, password or hashed_password, created_at
+    posts:    id, owner_id, title, content, published, created_at
+    votes:    user_id, post_id, created_at
+    comments: id (optional), post_id, owner_id, parent_id (optional),
+              content, created_at
+
+With --append, ids are shifted past the rows already in each table, so an
+import can land next to existing data. Files are imported in the order
+above, in batches: each batch is COPYed into a temporary table and moved
+into its table in one statement, skipping rows that already exist, on up
+to --jobs connections at once. Ids are checked against bitmaps of the
+users and posts held in memory, and records referencing neither an
+imported nor an existing row are counted and dropped. Plain passwords
+are hashed with bcrypt across --workers processes; bcrypt hashes are
+taken as they are.
+
+Comments without an id take one from the sequence of the table, which is
+first moved past the largest id of the file, so that a generated id
+never takes the id of a later record. Replies may come before the
+comment they answer, as in exports: comments are imported top-level,
+their parent_id kept aside, and once the whole file is in they are
+linked to their parents, with their thread paths and the reply counts
+of the parents, in one transaction. A reply whose parent is missing, on
+another post, or part of a cycle stays top-level.
+
+After every batch the rows read so far are saved to --checkpoint, and a
+rerun resumes from there. A batch committed but not yet checkpointed is
+skipped as duplicates on resume, except comments without ids.
+"""
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import orjson
+
+from app.config import settings
+from app.database import init_db, upgrade_schema
+from app.utils import hash_password
+
+KINDS = ("users", "posts", "votes", "comments")
+
+
+def _bool(value) -> bool:
+    """A boolean from JSON, or from CSV text"""
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("true", "t", "yes", "1"):
+        return True
+    if str(value).lower() in ("false", "f", "no", "0"):
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+# Staged columns per kind: (name, parse, SQL type, required)
+COLUMNS = {
+    "users": (
+        ("id", int, "integer", True),
+        ("username", str, "text", True),
+        ("email", str, "text", True),
+        ("hashed_password", str, "text", False),
+        ("created_at", str, "timestamptz", False),
+    ),
+    "posts": (
+        ("id", int, "integer", True),
+        ("owner_id", int, "integer", True),
+        ("title", str, "text", True),
+        ("content", str, "text", True),
+        ("published", _bool, "boolean", False),
+        ("created_at", str, "timestamptz", False),
+    ),
+    "votes": (
+        ("user_id", int, "integer", True),
+        ("post_id", int, "integer", True),
+        ("created_at", str, "timestamptz", False),
+    ),
+    "comments": (
+        ("id", int, "integer", False),
+        ("post_id", int, "integer", True),
+        ("owner_id", int, "integer", True),
+        ("parent_id", int, "integer", False),
+        ("content", str, "text", True),
+        ("created_at", str, "timestamptz", False),
+    ),
+}
+
+# Id columns per kind, and the table whose ids they hold
+REFERENCES = {
+    "users": {"id": "users"},
+    "posts": {"id": "posts", "owner_id": "users"},
+    "votes": {"user_id": "users", "post_id": "posts"},
+    "comments": {
+        "id": "comments",
+        "post_id": "posts",
+        "owner_id": "users",
+        "parent_id": "comments",
+    },
+}
+
+# Id columns checked once the whole file is in, see Importer.link
+LINKS = {"comments": "parent_id"}
+
+# Move a staged batch into its table; returns the ids, or the vote count
+MOVES = {
+    "users": """
+        INSERT INTO users (id, username, email, hashed_password, created_at)
+        SELECT id, username, email, hashed_password, COALESCE(created_at, now())
+        FROM import_users
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    """,
+    "posts": """
+        INSERT INTO posts
+            (id, owner_id, title, content, published, created_at, updated_at)
+        SELECT id, owner_id, title, content, COALESCE(published, false),
+            COALESCE(created_at, now()), COALESCE(created_at, now())
+        FROM import_posts
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    """,
+    "votes": """
+        WITH added AS (
+            INSERT INTO votes (user_id, post_id, created_at)
+            SELECT user_id, post_id, COALESCE(created_at, now())
+            FROM import_votes
+            ON CONFLICT DO NOTHING
+            RETURNING post_id
+        ), counted AS (
+            UPDATE posts SET vote_count = posts.vote_count + added_count.n
+            FROM (
+                SELECT post_id, count(*) AS n FROM added GROUP BY post_id
+            ) AS added_count
+            WHERE posts.id = added_count.post_id
+        )
+        SELECT count(*) FROM added
+    """,
+    "comments": """
+        WITH staged AS MATERIALIZED (
+            SELECT
+                COALESCE(
+                    id, nextval(pg_get_serial_sequence('comments', 'id'))
+                ) AS id,
+                post_id, owner_id, parent_id, content, created_at
+            FROM import_comments
+        ), added AS (
+            INSERT INTO comments
+                (id, post_id, owner_id, content, created_at, updated_at)
+            SELECT id, post_id, owner_id, content,
+                COALESCE(created_at, now()), COALESCE(created_at, now())
+            FROM staged
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        ), replies AS (
+            INSERT INTO import_comment_parents (id, parent_id)
+            SELECT staged.id, staged.parent_id
+            FROM staged JOIN added USING (id)
+            WHERE staged.parent_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+        )
+        SELECT id FROM added
+    """,
+}
+
+# Parents of the replies imported so far, kept across runs until linked
+CREATE_PARENTS = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS import_comment_parents (
+        id integer PRIMARY KEY,
+        parent_id integer NOT NULL
+    )
+"""
+
+# Link the imported replies whose parent is a comment of the same post,
+# each subtree from the path of the comment it hangs from
+LINK_REPLIES = """
+    WITH RECURSIVE links AS (
+        SELECT link.id, link.parent_id
+        FROM import_comment_parents AS link
+        JOIN comments AS reply ON reply.id = link.id
+        JOIN comments AS parent ON parent.id = link.parent_id
+        WHERE parent.post_id = reply.post_id
+    ), tree AS (
+        SELECT links.id, links.parent_id, parent.path AS ancestry
+        FROM links JOIN comments AS parent ON parent.id = links.parent_id
+        WHERE links.parent_id NOT IN (SELECT id FROM links)
+        UNION ALL
+        SELECT links.id, links.parent_id,
+            tree.ancestry || lpad(to_hex(tree.id), 8, '0')
+        FROM links JOIN tree ON links.parent_id = tree.id
+    )
+    UPDATE comments SET parent_id = tree.parent_id, ancestry = tree.ancestry
+    FROM tree
+    WHERE comments.id = tree.id
+"""
+
+# Count the replies just linked towards their parents
+COUNT_REPLIES = """
+    UPDATE comments SET reply_count = comments.reply_count + counted.n
+    FROM (
+        SELECT parent_id, count(*) AS n FROM comments
+        WHERE id IN (SELECT id FROM import_comment_parents)
+            AND parent_id IS NOT NULL
+        GROUP BY parent_id
+    ) AS counted
+    WHERE comments.id = counted.parent_id
+"""
+
+# Lock the posts a batch of votes counts towards in id order, so that
+# concurrent batches wait on each other instead of deadlocking
+LOCK_VOTED_POSTS = """
+    SELECT id FROM posts
+    WHERE id IN (SELECT post_id FROM import_votes)
+    ORDER BY id
+    FOR UPDATE
+"""
+
+# Keep the id sequence of a table past the ids of the table and the batch
+SET_SEQUENCE = """
+    SELECT setval(seq, GREATEST(
+        (SELECT max(id) FROM {kind}),
+        (SELECT max(id) FROM import_{kind}),
+        pg_sequence_last_value(seq::regclass),
+        1
+    ))
+    FROM pg_get_serial_sequence('{kind}', 'id') AS seq
+"""
+
+# Move the id sequence of a table past an id, before generating any
+RESERVE_IDS = """
+    SELECT setval(seq, GREATEST(
+        %(largest)s, pg_sequence_last_value(seq::regclass), 1
+    ))
+    FROM pg_get_serial_sequence('{kind}', 'id') AS seq
+"""
+
+
+class IdSet:
+    """Set of positive ids as a bitmap, one bit per id up to the largest
+
+    Ten million posts take about a megabyte, where a set of ints would
+    take hundreds.
+    """
+
+    def __init__(self):
+        """Initialize IdSet"""
+        self._bits = bytearray()
+
+    def add(self, id: int):
+        """Add an id; raises ValueError unless it is positive"""
+        if id <= 0:
+            raise ValueError(f"not a positive id: {id}")
+        byte = id >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 + len(self._bits) // 2))
+        self._bits[byte] |= 1 << (id & 7)
+
+    def __contains__(self, id: int) -> bool:
+        """Whether an id was added"""
+        byte = id >> 3
+        return 0 <= byte < len(self._bits) and bool(
+            self._bits[byte] >> (id & 7) & 1
+        )
+
+
+def read_records(path: str):
+    """Records of a CSV or JSONL file, as dicts"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+
+def parse(kind: str, record: dict, offsets: dict) -> list:
+    """Staged values of a record, with ids shifted by offsets"""
+    values = []
+    for name, convert, _, required in COLUMNS[kind]:
+        value = record.get(name)
+        if value is None or value == "":
+            if required:
+                raise ValueError(f"missing {name}")
+            values.append(None)
+            continue
+        value = convert(value)
+        table = REFERENCES[kind].get(name)
+        if table is not None:
+            if value <= 0:
+                raise ValueError(f"{name} is not a positive id")
+            value += offsets.get(table, 0)
+        values.append(value)
+    return values
+
+
+def copy_value(value) -> str:
+    """A value in the text format of COPY"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def connect():
+    """A connection of its own, with the staging tables"""
+    connection = init_db().raw_connection()
+    with connection.cursor() as cursor:
+        for kind, columns in COLUMNS.items():
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE import_{kind} ("
+                + ", ".join(f"{c[0]} {c[2]}" for c in columns)
+                + ") ON COMMIT DELETE ROWS"
+            )
+    connection.commit()
+    return connection
+
+
+class Importer:
+    """Batches parsed in this thread and moved by --jobs connections"""
+
+    def __init__(self, offsets: dict, pool, workers: int, rounds, jobs: int):
+        """Initialize Importer"""
+        self.offsets = offsets
+        self.pool = pool
+        self.workers = workers
+        self.rounds = rounds
+        self.jobs = jobs
+        self.movers = ThreadPoolExecutor(jobs)
+        self.known = {}
+        self._local = threading.local()
+        self._connections = []
+
+    def ids(self, table: str) -> IdSet:
+        """Ids of a table, loaded once, then kept up to date by imports"""
+        if table not in self.known:
+            known = IdSet()
+            with self._connection().cursor(name=f"ids_{table}") as cursor:
+                cursor.itersize = 100_000
+                cursor.execute(f"SELECT id FROM {table}")
+                for (id,) in cursor:
+                    known.add(id)
+            self._connection().commit()
+            self.known[table] = known
+        return self.known[table]
+
+    def _connection(self):
+        """The connection of the calling thread"""
+        if not hasattr(self._local, "connection"):
+            self._local.connection = connect()
+            self._connections.append(self._local.connection)
+        return self._local.connection
+
+    def _parents(self, kind: str) -> list:
+        """(index, ids) of the columns of a kind referencing another row"""
+        return [
+            (i, self.ids(REFERENCES[kind][name]))
+            for i, (name, *_) in enumerate(COLUMNS[kind])
+            if name not in ("id", LINKS.get(kind)) and name in REFERENCES[kind]
+        ]
+
+    def _hash_passwords(self, records: list, rows: list):
+        """Fill in the hash of the users given a plain password"""
+        plain = [i for i, row in enumerate(rows) if row[3] is None]
+        if not plain:
+            return
+        passwords = [str(records[i].get("password") or "") for i in plain]
+        hashes = self.pool.map(
+            hash_password,
+            passwords,
+            itertools.repeat(self.rounds),
+            chunksize=max(1, len(plain) // (4 * self.workers)),
+        )
+        for i, hashed in zip(plain, hashes):
+            rows[i][3] = hashed
+
+    def prepare(self, kind: str, records: list, first_line: int) -> tuple:
+        """COPY data of a batch, and how many records it dropped
+
+        Records referencing a user or post that does not exist are dropped.
+        """
+        rows = []
+        for line, record in enumerate(records, first_line):
+            try:
+                rows.append(parse(kind, record, self.offsets))
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"{kind} record {line}: {e}") from None
+            if kind == "users":
+                hashed, password = rows[-1][3], record.get("password")
+                if hashed is None and not password:
+                    raise ValueError(f"{kind} record {line}: missing password")
+                if hashed is not None and not hashed.startswith("$2"):
+                    raise ValueError(f"{kind} record {line}: not a bcrypt hash")
+        if kind == "users":
+            self._hash_passwords(records, rows)
+        parents = self._parents(kind)
+        buffer = io.StringIO()
+        orphans = 0
+        for row in rows:
+            if all(row[i] in ids for i, ids in parents):
+                buffer.write("\t".join(map(copy_value, row)) + "\n")
+            else:
+                orphans += 1
+        buffer.seek(0)
+        return buffer, orphans
+
+    def move(self, kind: str, buffer) -> list:
+        """COPY a batch into its table, in a transaction of this thread
+
+        Returns the ids added, or for votes their count.
+        """
+        connection = self._connection()
+        names = ", ".join(column[0] for column in COLUMNS[kind])
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY import_{kind} ({names}) FROM STDIN", buffer
+            )
+            if kind == "votes":
+                cursor.execute(LOCK_VOTED_POSTS)
+            else:
+                cursor.execute(SET_SEQUENCE.format(kind=kind))
+            cursor.execute(MOVES[kind])
+            result = cursor.fetchall()
+        connection.commit()
+        return result
+
+    def added(self, kind: str, result: list) -> int:
+        """Count the rows a move added, and remember the new ids"""
+        if kind == "votes":
+            return result[0][0]
+        if kind in self.known:
+            known = self.known[kind]
+            for (id,) in result:
+                known.add(id)
+        return len(result)
+
+    def start(self, kind: str, source: str):
+        """Get a table ready for the records of a file
+
+        Only comments may leave out their id: the sequence is moved past
+        the largest id of the file, so the ids generated stay clear of the
+        ids that later records carry. Their parents are kept aside until
+        the whole file is in.
+        """
+        if kind != "comments":
+            return
+        largest = 0
+        for record in read_records(source):
+            try:
+                id = parse(kind, record, self.offsets)[0]
+                largest = max(largest, id or 0)
+            except (ValueError, TypeError):
+                continue  # reported with its line by prepare
+        connection = self._connection()
+        with connection.cursor() as cursor:
+            cursor.execute(RESERVE_IDS.format(kind=kind), {"largest": largest})
+            cursor.execute(CREATE_PARENTS)
+        connection.commit()
+
+    def link(self, kind: str) -> tuple:
+        """Link the replies imported to their parents, in one transaction
+
+        Returns how many were linked, and how many stay top-level.
+        """
+        if kind != "comments":
+            return 0, 0
+        connection = self._connection()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM import_comment_parents")
+            (replies,) = cursor.fetchone()
+            cursor.execute(LINK_REPLIES)
+            linked = cursor.rowcount
+            cursor.execute(COUNT_REPLIES)
+            cursor.execute("DROP TABLE import_comment_parents")
+        connection.commit()
+        return linked, replies - linked
+
+    def analyze(self, kind: str):
+        """Refresh the planner statistics of a table after its import"""
+        connection = self._connection()
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {kind}")
+        connection.commit()
+
+    def close(self):
+        """Wait for the moves and close every connection"""
+        self.movers.shutdown()
+        for connection in self._connections:
+            connection.close()
+
+
+class Checkpoint:
+    """Records read per file, and the id offsets, saved after each batch"""
+
+    def __init__(self, path: str):
+        """Initialize Checkpoint, from its file if there is one"""
+        self.path = path
+        self.state = {"offsets": None, "done": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def done(self, kind: str, source: str) -> int:
+        """Records of a file imported by previous runs"""
+        entry = self.state["done"].get(kind)
+        if entry is None:
+            return 0
+        if entry["file"] != source:
+            raise SystemExit(
+                f"{self.path} is a checkpoint of {entry['file']}, not "
+                f"{source}; remove it to start over"
+            )
+        return entry["records"]
+
+    def save(self, kind: str, source: str, records: int):
+        """Record the progress of a file, atomically"""
+        self.state["done"][kind] = {"file": source, "records": records}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temporary, self.path)
+
+
+def current_offsets() -> dict:
+    """Largest id of each table, to append past them"""
+    offsets = {}
+    with init_db().connect() as connection:
+        for table in ("users", "posts", "comments"):
+            offsets[table] = connection.exec_driver_sql(
+                f"SELECT COALESCE(max(id), 0) FROM {table}"
+            ).scalar()
+    return offsets
+
+
+def import_file(importer, checkpoint, kind: str, source: str, size: int):
+    """Import a file in batches, print progress and a summary line
+
+    Up to two batches per job are in flight; results are taken in file
+    order, so the checkpoint only ever covers batches that committed.
+    """
+    done = checkpoint.done(kind, source)
+    importer.start(kind, source)
+    records = itertools.islice(read_records(source), done, None)
+    read = imported = orphans = 0
+    pending = collections.deque()
+    start = time.perf_counter()
+
+    def finish_oldest():
+        nonlocal read, imported, orphans
+        count, dropped, future = pending.popleft()
+        imported += importer.added(kind, future.result())
+        read += count
+        orphans += dropped
+        checkpoint.save(kind, source, done + read)
+        print(
+            f"{kind}: {done + read:,} records, "
+            f"{read / (time.perf_counter() - start):,.0f} records/s",
+            flush=True,
+        )
+
+    queued = 0
+    while batch := list(itertools.islice(records, size)):
+        buffer, dropped = importer.prepare(kind, batch, done + queued + 1)
+        queued += len(batch)
+        future = importer.movers.submit(importer.move, kind, buffer)
+        pending.append((len(batch), dropped, future))
+        if len(pending) >= 2 * importer.jobs:
+            finish_oldest()
+    while pending:
+        finish_oldest()
+    linked, unlinked = importer.link(kind)
+    if read:
+        importer.analyze(kind)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{kind}: {imported:,} imported, "
+        f"{read - imported - orphans:,} already there, "
+        f"{orphans:,} referencing missing rows, skipped {done:,} "
+        f"from the checkpoint, in {elapsed:.1f}s "
+        f"({imported / elapsed if elapsed else 0:,.0f} rows/s)"
+    )
+    if linked or unlinked:
+        print(
+            f"{kind}: {linked:,} replies linked to their parents, "
+            f"{unlinked:,} left top-level"
+        )
+
+
+def main():
+    """Parse the arguments and import the files"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    for kind in KINDS:
+        parser.add_argument(f"--{kind}", metavar="FILE")
+    parser.add_argument("--append", action="store_true")
+    parser.add_argument("--checkpoint", default="bulk_import.checkpoint.json")
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--rounds", type=int, default=settings.bcrypt_rounds)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    checkpoint = Checkpoint(args.checkpoint)
+    if checkpoint.state["offsets"] is None:
+        checkpoint.state["offsets"] = current_offsets() if args.append else {}
+    # Spawned, not forked: a forked worker would hold on to the sockets of
+    # the connections, and keep their transactions open past a crash
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(args.workers, mp_context=spawn) as pool:
+        importer = Importer(
+            checkpoint.state["offsets"],
+            pool,
+            args.workers,
+            args.rounds,
+            args.jobs,
+        )
+        try:
+            for kind in KINDS:
+                source = getattr(args, kind)
+                if source is not None:
+                    import_file(
+                        importer, checkpoint, kind, source, args.batch_size
+                    )
+        finally:
+            importer.close()
+
+
+if __name__ == "__main__":
+    main()
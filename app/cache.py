@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Module for cache backends: in-process LRU or Redis
+
+Both backends store JSON-serializable values under string keys, expire
+them after a TTL and count their hits and misses.
+"""
+import json
+import time
+from collections import OrderedDict
+
+from app.config import settings
+
+
+class MemoryCache:
+    """Bounded in-process LRU cache with a TTL"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        """Initialize MemoryCache"""
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str):
+        """Get a value, or None when missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key: str, value, ttl: float = None):
+        """Store a value, evicting the least recently used when full"""
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys: str):
+        """Remove values"""
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """Counters of the cache"""
+        return {
+            "backend": "memory",
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RedisCache:
+    """Cache shared by every worker through Redis
+
+    Redis applies the TTL and its own maxmemory eviction policy; evictions
+    are reported server-wide by Redis (INFO stats, evicted_keys).
+    """
+
+    def __init__(self, name: str, ttl: float, url: str = None):
+        """Initialize RedisCache"""
+        from redis import asyncio as aioredis
+
+        self.name = name
+        self.ttl = ttl
+        self.client = aioredis.from_url(url or settings.redis_url)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key: str) -> str:
+        """Namespace a key with the name of the cache"""
+        return f"{self.name}:{key}"
+
+    async def get(self, key: str):
+        """Get a value, or None when missing or expired"""
+        raw = await self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key: str, value, ttl: float = None):
+        """Store a value"""
+        await self.client.set(
+            self._key(key),
+            json.dumps(value),
+            px=int((ttl or self.ttl) * 1000),
+        )
+
+    async def delete(self, *keys: str):
+        """Remove values"""
+        if keys:
+            await self.client.delete(*(self._key(key) for key in keys))
+
+    def stats(self) -> dict:
+        """Counters of the cache"""
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+def make_cache(name: str, maxsize: int, ttl: float):
+    """Create a named cache on the backend chosen in the settings"""
+    if settings.cache_backend == "redis":
+        cache = RedisCache(name, ttl=ttl)
+    elif settings.cache_backend == "memory":
+        cache = MemoryCache(name, maxsize=maxsize, ttl=ttl)
+    else:
+        raise ValueError(f"Unknown cache backend {settings.cache_backend}")
+    return cache
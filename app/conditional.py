@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Module for conditional GET: ETag and 304 Not Modified
+
+Routes build their ETag from a cheap metadata query, answer 304 when
+If-None-Match lists it, and otherwise send it with the body. There is no
+Last-Modified: votes and deletes change the representations without
+advancing any timestamp, so If-Modified-Since is ignored, as RFC 9110
+allows without one.
+"""
+import hashlib
+
+from fastapi import Request, Response, status
+
+
+def etag(*parts) -> str:
+    """Strong ETag of the parts of a representation's state"""
+    state = "/".join(str(part) for part in parts)
+    digest = hashlib.blake2b(state.encode(), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def validators(tag: str) -> dict:
+    """ETag header"""
+    return {"ETag": tag}
+
+
+def _matches(if_none_match: str, tag: str) -> bool:
+    """Whether an If-None-Match header lists the tag, weakly compared"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (c.strip() for c in if_none_match.split(","))
+    return tag in (c[2:] if c.startswith("W/") else c for c in candidates)
+
+
+def not_modified(request: Request, tag: str) -> bool:
+    """Whether the client's copy is current and a 304 will do"""
+    if_none_match = request.headers.get("if-none-match")
+    return if_none_match is not None and _matches(if_none_match, tag)
+
+
+def not_modified_response(headers: dict) -> Response:
+    """304 response carrying the validators"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Module for read-your-writes over the read replicas
+
+With DB_REPLICA_URLS set, GET and HEAD requests read from a replica,
+picked round-robin, and every other request goes to the primary. A write
+request pins its client (the user of its access token, or else its IP
+address) to the primary for DB_REPLICA_PIN_S, from its start and again
+from its end, so the client reads its own writes however far the
+replicas lag, up to that long. Pins live per worker or in Redis,
+following CACHE_BACKEND.
+"""
+from fastapi import Request
+from prometheus_client import Counter
+
+from app.cache import make_cache
+from app.config import settings
+from app.rate_limit import client_key
+
+ROUTED = Counter(
+    "db_routed_requests_total",
+    "Requests by the database serving their reads",
+    ("target",),
+)
+
+# Methods that never write
+SAFE_METHODS = frozenset({"GET", "HEAD"})
+
+pins = make_cache(
+    "replica_pins",
+    maxsize=settings.db_replica_pin_clients,
+    ttl=settings.db_replica_pin_s,
+)
+
+
+async def read_your_writes(request: Request):
+    """Let a read request use a replica unless its client just wrote"""
+    if not settings.db_replica_urls:
+        yield
+        return
+    key = client_key(request)
+    if request.method in SAFE_METHODS:
+        request.state.replica = await pins.get(key) is None
+        ROUTED.labels("replica" if request.state.replica else "pinned").inc()
+        yield
+        return
+    ROUTED.labels("primary").inc()
+    await pins.set(key, True)
+    yield
+    await pins.set(key, True)
@@ -2,80 +2,639 @@
 """
 Module for database class
 """
-from sqlalchemy import create_engine, or_
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import NoResultFound
+import functools
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+from itertools import count
 
+from alembic import command
+from alembic.config import Config
+from fastapi import Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from sqlalchemy import (
+    create_engine,
+    tuple_,
+    inspect,
+    func,
+    cast,
+    insert,
+    delete,
+    update,
+    bindparam,
+    select,
+    or_,
+    case,
+    true,
+    String,
+)
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import aliased, sessionmaker, Session
+from sqlalchemy.exc import IntegrityError, NoResultFound
+
+from app.admission import admission
 from app.config import settings as s
-from app.models import User, Post, Vote, Comment, Base
+from app.metrics import instrument_engine
+from app.slow_queries import slow_query_log
+from app.models import User, Post, Vote, Comment, SEARCH_CONFIG
 from app.utils import hash_password
+from app.pagination import (
+    created_at_id,
+    decode_cursor,
+    encode_cursor,
+    paginate,
+    page,
+)
+
+ALEMBIC_INI = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini"
+)
+# Revision of the schema create_all built before migrations existed
+CREATE_ALL_REVISION = "0001"
+# Columns of its tables, and those create_all may have added since, which
+# later revisions add when they are missing
+CREATE_ALL_COLUMNS = {
+    "users": {"id", "username", "email", "hashed_password", "created_at"},
+    "posts": {
+        "id",
+        "title",
+        "content",
+        "published",
+        "created_at",
+        "updated_at",
+        "owner_id",
+    },
+    "comments": {
+        "id",
+        "content",
+        "post_id",
+        "owner_id",
+        "created_at",
+        "updated_at",
+    },
+    "votes": {"post_id", "user_id", "created_at"},
+}
+CREATE_ALL_EXTRA_COLUMNS = {"posts": {"vote_count", "search_vector"}}
+
+# Transaction of DB.stream: one snapshot for every statement
+SNAPSHOT = {"isolation_level": "REPEATABLE READ"}
+
+# ts_headline options for search snippets
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxFragments=2"
+
+# Columns DB.find_user looks users up by
+USER_KEYS = ("id", "username", "email")
+
+_engine = None
+_session_factory = None
+_async_engine = None
+_async_session_factory = None
+_replicas = []
+_async_replicas = []
+_replica_turns = count()
+
+
+def get_db_url(driver: str = "postgresql") -> str:
+    """Build the database URL from the settings"""
+    return (
+        f"{driver}://{s.db_username}:{s.db_password}"
+        + f"@{s.db_host}:{s.db_port}/{s.db_name}"
+    )
+
+
+def replica_url(url: str, driver: str = "postgresql") -> URL:
+    """A replica URL of DB_REPLICA_URLS, for the driver"""
+    return make_url(url).set(drivername=driver)
+
+
+def pool_options() -> dict:
+    """Pool settings of every engine, primary or replica"""
+    return {
+        "pool_size": s.db_pool_size,
+        "max_overflow": s.db_max_overflow,
+        "pool_recycle": s.db_pool_recycle,
+        "pool_pre_ping": s.db_pool_pre_ping,
+        "pool_timeout": s.db_pool_timeout_s,
+    }
+
+
+_statement_builders = []
+
+
+def cached_statement(build):
+    """Build a hot-path statement once per variant of its arguments
+
+    The statement takes its values as bound parameters, so every call of a
+    variant reuses the same object: SQLAlchemy neither rebuilds it nor
+    regenerates its cache key. Variants are the long-lived loader options
+    and column tuples of app.loaders.
+    """
+    cached = functools.lru_cache(maxsize=64)(build)
+    _statement_builders.append(cached)
+    return cached
+
+
+def statement_cache_stats() -> dict:
+    """Counters of the statements reused by cached_statement"""
+    infos = [build.cache_info() for build in _statement_builders]
+    return {
+        "backend": "memory",
+        "size": sum(info.currsize for info in infos),
+        "hits": sum(info.hits for info in infos),
+        "misses": sum(info.misses for info in infos),
+    }
+
+
+@cached_statement
+def user_by(keys: tuple, options: tuple):
+    """The user matching any of keys, the earliest matching key first"""
+    matches = [getattr(User, key) == bindparam(key) for key in keys]
+    statement = select(User).options(*options).where(or_(*matches))
+    if len(matches) > 1:
+        statement = statement.order_by(
+            case(*((match, i) for i, match in enumerate(matches)))
+        )
+    return statement.limit(1)
+
+
+@cached_statement
+def post_by_id(options: tuple):
+    """The post of id"""
+    return (
+        select(Post)
+        .options(*options)
+        .where(Post.id == bindparam("id"))
+        .limit(1)
+    )
+
+
+@cached_statement
+def vote_by_key():
+    """The vote of user_id on post_id"""
+    return select(Vote).where(
+        Vote.post_id == bindparam("post_id"),
+        Vote.user_id == bindparam("user_id"),
+    )
+
+
+@cached_statement
+def comments_of_post(options: tuple, columns: tuple, after: bool):
+    """A page of the comments of post_id, oldest first
+
+    limit is the page size plus one. With after, the page starts past the
+    (after_created_at, after_id) cursor. With columns, rows hold those
+    columns followed by the sort keys missing from them.
+    """
+    keys = (Comment.created_at, Comment.id)
+    if columns is None:
+        statement = select(Comment).options(*options)
+    else:
+        missing = [k for k in keys if not any(k is c for c in columns)]
+        statement = select(*columns, *missing)
+    statement = statement.where(Comment.post_id == bindparam("post_id"))
+    if after:
+        statement = statement.where(
+            tuple_(*keys)
+            > tuple_(
+                bindparam("after_created_at", type_=Comment.created_at.type),
+                bindparam("after_id", type_=Comment.id.type),
+            )
+        )
+    return statement.order_by(*keys).limit(bindparam("limit"))
+
+
+@cached_statement
+def comment_threads(columns: tuple):
+    """A page of the top-level comments of post_id, with their first replies
+
+    limit top-level comments (the page size plus one) come oldest first
+    past the after_id cursor, each with up to replies of the comments
+    under it, depth first. Paths are hex digits, so the replies under a
+    comment are the paths between its own and its own followed by "g":
+    both come from index ranges, in one statement.
+
+    Rows hold the columns and path of the top-level comment, then those
+    of one reply, or nulls when it has none.
+    """
+    top = (
+        select(*columns, Comment.path)
+        .where(
+            Comment.post_id == bindparam("post_id"),
+            Comment.parent_id.is_(None),
+            Comment.id > bindparam("after_id"),
+        )
+        .order_by(Comment.id)
+        .limit(bindparam("limit"))
+        .subquery("top")
+    )
+    reply = aliased(Comment, name="reply")
+    replies = (
+        select(*(getattr(reply, c.key) for c in columns), reply.path)
+        .where(
+            reply.post_id == bindparam("post_id"),
+            reply.path > top.c.path,
+            reply.path < top.c.path + "g",
+        )
+        .order_by(reply.path)
+        .limit(bindparam("replies"))
+        .lateral("replies")
+    )
+    return (
+        select(top, replies)
+        .select_from(top.outerjoin(replies, true()))
+        .order_by(top.c.id, replies.c.path)
+    )
+
+
+@cached_statement
+def comment_replies(columns: tuple):
+    """A page of the replies under comment_id, depth first
+
+    limit replies (the page size plus one) past the after_path cursor, in
+    one statement. Rows hold the columns then the path of a reply; a
+    single row of nulls means no replies, and no row no comment.
+    """
+    root = aliased(Comment, name="root")
+    start = func.greatest(bindparam("after_path", type_=String), root.path)
+    replies = (
+        select(*columns, Comment.path)
+        .where(
+            Comment.post_id == root.post_id,
+            Comment.path > start,
+            Comment.path < root.path + "g",
+        )
+        .order_by(Comment.path)
+        .limit(bindparam("limit"))
+        .lateral("replies")
+    )
+    return (
+        select(replies)
+        .select_from(root)
+        .outerjoin(replies, true())
+        .where(root.id == bindparam("comment_id"))
+    )
+
+
+class RoutingSession(Session):
+    """Session reading from the replica in its info, if it has one
+
+    Flushes and INSERT, UPDATE and DELETE statements always go to the
+    primary, the bind of the session.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        """The replica for reads, else the primary"""
+        replica = self.info.get("replica")
+        if (
+            replica is None
+            or self._flushing
+            or getattr(clause, "is_dml", False)
+        ):
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        return replica
+
+
+def init_db():
+    """Create the process-wide engine and session factory"""
+    global _engine, _session_factory
+    if _engine is None:
+        _engine = create_engine(get_db_url(), **pool_options())
+        _replicas[:] = [
+            create_engine(replica_url(url), **pool_options())
+            for url in s.db_replica_urls
+        ]
+        _session_factory = sessionmaker(bind=_engine, class_=RoutingSession)
+        for engine in (_engine, *_replicas):
+            instrument_engine(engine)
+            slow_query_log.attach(engine)
+    return _engine
+
+
+def init_async_db():
+    """Create the process-wide asyncpg engine and session factory"""
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        _async_engine = create_async_engine(
+            get_db_url("postgresql+asyncpg"), **pool_options()
+        )
+        _async_replicas[:] = [
+            create_async_engine(
+                replica_url(url, "postgresql+asyncpg"), **pool_options()
+            )
+            for url in s.db_replica_urls
+        ]
+        _async_session_factory = async_sessionmaker(
+            bind=_async_engine, sync_session_class=RoutingSession
+        )
+        init_db()
+        # asyncpg statements are explained on the sync engines
+        for engine, explain_engine in zip(
+            (_async_engine, *_async_replicas), (_engine, *_replicas)
+        ):
+            instrument_engine(engine.sync_engine)
+            slow_query_log.attach(engine.sync_engine, explain_engine)
+    return _async_engine
+
+
+def upgrade_schema():
+    """Apply the pending migrations, kept out of the request path
+
+    A database create_all built, with tables but no alembic_version, is
+    stamped with CREATE_ALL_REVISION first, provided its tables have the
+    columns of that revision; otherwise it is left for a manual stamp.
+    """
+    config = Config(ALEMBIC_INI)
+    with init_db().connect() as connection:
+        config.attributes["connection"] = connection
+        tables = inspect(connection)
+        if not tables.has_table("alembic_version") and tables.has_table(
+            "users"
+        ):
+            mismatch = create_all_mismatch(tables)
+            if mismatch:
+                raise RuntimeError(
+                    f"Not stamping revision {CREATE_ALL_REVISION}, the"
+                    f" schema differs: {mismatch}; stamp it with alembic"
+                )
+            command.stamp(config, CREATE_ALL_REVISION)
+        command.upgrade(config, "head")
+
+
+def create_all_mismatch(tables) -> str:
+    """How the live tables differ from CREATE_ALL_REVISION, if they do"""
+    for table, columns in CREATE_ALL_COLUMNS.items():
+        if not tables.has_table(table):
+            return f"no {table} table"
+        live = {column["name"] for column in tables.get_columns(table)}
+        if columns - live:
+            return f"{table} lacks {', '.join(sorted(columns - live))}"
+        extra = live - columns - CREATE_ALL_EXTRA_COLUMNS.get(table, set())
+        if extra:
+            return f"{table} has {', '.join(sorted(extra))}"
+    return ""
+
+
+def dispose_db():
+    """Close every pooled connection of the engine and its replicas"""
+    global _engine, _session_factory
+    if _engine is not None:
+        _engine.dispose()
+    for replica in _replicas:
+        replica.dispose()
+    _engine = None
+    _session_factory = None
+    _replicas.clear()
+
+
+async def dispose_async_db():
+    """Close every pooled connection of the asyncpg engine and replicas"""
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+    for replica in _async_replicas:
+        await replica.dispose()
+    _async_engine = None
+    _async_session_factory = None
+    _async_replicas.clear()
+
+
+def get_session_factory() -> sessionmaker:
+    """Get the process-wide session factory"""
+    init_db()
+    return _session_factory
+
+
+def get_async_session_factory() -> async_sessionmaker:
+    """Get the process-wide asyncpg session factory"""
+    init_async_db()
+    return _async_session_factory
 
 
 class DB:
     """Database class"""
 
-    def __init__(self):
+    # Methods that only read, which a replica may serve
+    READS = frozenset(
+        {
+            "get_all_users",
+            "find_user",
+            "get_posts",
+            "search_posts",
+            "get_posts_by_ids",
+            "get_post_scores",
+            "get_top_post_scores",
+            "find_post_with_id",
+            "get_post_version",
+            "find_vote",
+            "get_votes",
+            "get_comments",
+            "get_comments_version",
+            "get_comment_threads",
+            "get_replies",
+            "find_comment",
+            "stream",
+        }
+    )
+
+    def __init__(self, session: Session = None):
         """Initialize DB"""
-        db_url = (
-            f"postgresql://{s.db_username}:{s.db_password}"
-            + f"@{s.db_host}:{s.db_port}/{s.db_name}"
-        )
-        self.engine = create_engine(db_url)
-        Base.metadata.create_all(bind=self.engine)
-        self.__session = None
+        self.engine = init_db()
+        self.__session = session
 
     @property
     def _session(self):
         """Create session"""
         if self.__session is None:
-            DBsession = sessionmaker(bind=self.engine)
-            self.__session = DBsession()
+            self.__session = get_session_factory()()
         return self.__session
 
-    def get_all_users(self, limit: int = 10):
-        """Get all posts"""
-        users = self._session.query(User).limit(limit).all()
-        return users
+    def _entities_or_rows(
+        self, entity, options: tuple, columns: tuple, keys: tuple
+    ):
+        """Query entities, or rows of the columns followed by the sort keys"""
+        if columns is None:
+            return self._session.query(entity).options(*options)
+        missing = [k for k in keys if not any(k is c for c in columns)]
+        return self._session.query(*columns, *missing)
 
-    def find_user(self, **kwargs) -> User:
-        """Find a user using their username"""
-        for key, value in kwargs.items():
-            if key in {"id", "username", "email"}:
-                result = (
-                    self._session.query(User)
-                    .filter(getattr(User, key) == value)
-                    .first()
-                )
-                if result is not None:
-                    return result
-        raise NoResultFound
-
-    def get_posts(self, skip: int = 0, limit: int = 0, search: str = ""):
-        """Get all posts"""
-        query = self._session.query(Post)
-        if search:
-            query = query.filter(
-                or_(
-                    Post.title.icontains(search), Post.content.icontains(search)
-                )
+    def get_all_users(
+        self,
+        limit: int = 10,
+        cursor: str = None,
+        options: tuple = (),
+        columns: tuple = None,
+    ) -> tuple:
+        """Get a page of users, oldest first, and the next page cursor
+
+        With columns, the page holds rows of those columns, not users.
+        """
+        keys = (User.created_at, User.id)
+        query = paginate(
+            self._entities_or_rows(User, options, columns, keys),
+            keys,
+            created_at_id(cursor) if cursor else None,
+            limit,
+        )
+        return page(query.all(), limit, lambda u: (u.created_at, u.id))
+
+    def find_user(self, options: tuple = (), **kwargs) -> User:
+        """Find a user by id, username or email, in one query
+
+        Given several, the user matching the earliest one given wins.
+        """
+        keys = tuple(key for key in kwargs if key in USER_KEYS)
+        if not keys:
+            raise NoResultFound
+        user = self._session.scalars(
+            user_by(keys, options), {key: kwargs[key] for key in keys}
+        ).first()
+        if user is None:
+            raise NoResultFound
+        return user
+
+    def get_posts(
+        self,
+        limit: int = 10,
+        cursor: str = None,
+        options: tuple = (),
+        columns: tuple = None,
+    ) -> tuple:
+        """Get a page of posts, newest first, and the next page cursor
+
+        With columns, the page holds rows of those columns, not posts.
+        """
+        keys = (Post.created_at, Post.id)
+        query = paginate(
+            self._entities_or_rows(Post, options, columns, keys),
+            keys,
+            created_at_id(cursor) if cursor else None,
+            limit,
+            desc=True,
+        )
+        return page(query.all(), limit, lambda p: (p.created_at, p.id))
+
+    def search_posts(
+        self,
+        search: str,
+        limit: int = 10,
+        cursor: str = None,
+        highlight: bool = False,
+        columns: tuple = None,
+    ) -> tuple:
+        """Get a page of the posts matching a search, best match first
+
+        Rows hold the columns (every PostDisplay one by default), then the
+        rank, the snippet with highlight, and the id if not in columns.
+        """
+        columns = columns or (
+            Post.id,
+            Post.title,
+            Post.content,
+            Post.published,
+            Post.owner_id,
+            Post.vote_count,
+        )
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, search)
+        # double precision so the rank survives the cursor round trip
+        rank = cast(
+            func.ts_rank_cd(Post.search_vector, tsquery), DOUBLE_PRECISION
+        ).label("rank")
+        # The snippet needs the whole content, whatever the columns
+        document = (Post.content.label("document"),) if highlight else ()
+        missing = () if any(c is Post.id for c in columns) else (Post.id,)
+        query = paginate(
+            self._session.query(
+                *columns, rank, *document, *missing
+            ).filter(Post.search_vector.op("@@")(tsquery)),
+            (rank, Post.id),
+            decode_cursor(cursor, float, int) if cursor else None,
+            limit,
+            desc=True,
+        )
+        if highlight:
+            # Only build snippets for the rows of the page
+            matches = query.subquery()
+            snippet = func.ts_headline(
+                SEARCH_CONFIG, matches.c.document, tsquery, HEADLINE_OPTIONS
             )
-        if limit:
-            query = query.limit(limit)
-        if skip:
-            query = query.offset(skip)
+            query = self._session.query(
+                *(matches.c[column.key] for column in columns),
+                matches.c.rank,
+                snippet.label("snippet"),
+                *(matches.c.id for _ in missing),
+            ).order_by(matches.c.rank.desc(), matches.c.id.desc())
+        return page(query.all(), limit, lambda p: (p.rank, p.id))
+
+    def get_posts_by_ids(
+        self, post_ids: list, options: tuple = (), columns: tuple = None
+    ) -> list:
+        """Get posts, or rows of columns, in the order of their ids
 
-        posts = query.all()
-        return posts
+        Ids of posts that no longer exist are skipped.
+        """
+        if not post_ids:
+            return []
+        keys = (Post.id,)
+        found = (
+            self._entities_or_rows(Post, options, columns, keys)
+            .filter(Post.id.in_(post_ids))
+            .all()
+        )
+        by_id = {post.id: post for post in found}
+        return [by_id[id] for id in post_ids if id in by_id]
+
+    def get_post_scores(self, post_ids: list) -> list:
+        """(id, vote_count, created_at) of the posts that still exist"""
+        return (
+            self._session.query(Post.id, Post.vote_count, Post.created_at)
+            .filter(Post.id.in_(post_ids))
+            .all()
+        )
 
-    def find_post_with_id(self, id: str):
+    def get_top_post_scores(self, limit: int, score) -> list:
+        """(id, vote_count, created_at) of the posts ranking first by score
+
+        score is an SQL expression over the Post columns.
+        """
+        return (
+            self._session.query(Post.id, Post.vote_count, Post.created_at)
+            .order_by(score.desc(), Post.id.desc())
+            .limit(limit)
+            .all()
+        )
+
+    def find_post_with_id(self, id: str, options: tuple = ()):
         """Find an existing post using its id"""
-        post = self._session.query(Post).filter_by(id=id).first()
+        post = self._session.scalars(post_by_id(options), {"id": id}).first()
         if post is None:
             raise NoResultFound
         return post
 
+    def get_post_version(self, post_id: int):
+        """Row of what a post's representation changes with, not the post"""
+        version = (
+            self._session.query(Post.id, Post.updated_at, Post.vote_count)
+            .filter(Post.id == post_id)
+            .first()
+        )
+        if version is None:
+            raise NoResultFound
+        return version
+
     def create_post(
-        self, title: str, content: str, owner_id: int, published: bool = False
+        self,
+        title: str,
+        content: str,
+        owner_id: int,
+        published: bool = False,
+        options: tuple = (),
     ):
         """Create a new post"""
         if title and content:
@@ -86,9 +645,29 @@ class DB:
             new_post.published = published
             self._session.add(new_post)
             self._session.commit()
-            return new_post
+            return self.find_post_with_id(id=new_post.id, options=options)
+
+    def create_posts(self, posts: list, owner_id: int) -> list:
+        """Create many posts in one transaction, return their ids in order"""
+        rows = [{**post, "owner_id": owner_id} for post in posts]
+        ids = self._session.scalars(
+            insert(Post).returning(Post.id, sort_by_parameter_order=True),
+            rows,
+        ).all()
+        self._session.commit()
+        return ids
+
+    def _lock_existing_posts(self, post_ids) -> set:
+        """Ids of the posts that exist, locked against deletion"""
+        return set(
+            self._session.scalars(
+                select(Post.id)
+                .where(Post.id.in_(set(post_ids)))
+                .with_for_update(key_share=True)
+            )
+        )
 
-    def update_post(self, post_id: int, **kwargs):
+    def update_post(self, post_id: int, options: tuple = (), **kwargs):
         """Update an existing post"""
         post = self.find_post_with_id(id=post_id)
         for key, value in kwargs.items():
@@ -104,11 +683,23 @@ class DB:
                 setattr(post, key, value)
 
         self._session.commit()
-        return post
+        return self.find_post_with_id(id=post_id, options=options)
+
+    def delete_post(self, post_id: int):
+        """Delete an existing post"""
+        post = self.find_post_with_id(id=post_id)
+        self._session.delete(post)
+        self._session.commit()
 
-    def create_user(self, username: str, email: str, password: str):
+    def create_user(
+        self,
+        username: str,
+        email: str,
+        password: str = None,
+        hashed_password: str = None,
+    ):
         """Create a new user"""
-        if username and email and password:
+        if username and email and (password or hashed_password):
             try:
                 self.find_user(email=email)
                 raise ValueError(f"User with email {email} already exists")
@@ -124,53 +715,620 @@ class DB:
 
             new_user = User()
             new_user.username = username
-            new_user.hashed_password = hash_password(password)
+            new_user.hashed_password = hashed_password or hash_password(
+                password
+            )
             new_user.email = email
 
             self._session.add(new_user)
             self._session.commit()
+            self._session.refresh(new_user)
 
             return new_user
 
-    def update_user_password(self, user_id: int, password: str):
+    def update_user_password(
+        self, user_id: int, password: str = None, hashed_password: str = None
+    ):
         """Update a user"""
-        user = self._session.query(User).filter_by(id=user_id).one()
+        user = self._session.query(User).filter_by(id=user_id).one_or_none()
         if user is None:
             raise NoResultFound
 
-        user.hashed_password = hash_password(password)
+        user.hashed_password = hashed_password or hash_password(password)
+        self._session.commit()
+
+    def delete_user(self, user_id: int) -> list:
+        """Delete a user with all of their content
+
+        Returns the ids of the posts they owned, voted or commented on.
+        """
+        user = self.find_user(id=user_id)
+        affected = (
+            self._session.query(Post.id)
+            .filter(Post.owner_id == user_id)
+            .union(
+                self._session.query(Vote.post_id).filter(
+                    Vote.user_id == user_id
+                ),
+                self._session.query(Comment.post_id).filter(
+                    Comment.owner_id == user_id
+                ),
+            )
+            .all()
+        )
+        # Their votes go away with them
+        voted = self._session.query(Vote.post_id).filter(
+            Vote.user_id == user_id
+        )
+        self._session.query(Post).filter(Post.id.in_(voted)).update(
+            {
+                Post.vote_count: Post.vote_count - 1,
+                Post.updated_at: Post.updated_at,
+            },
+            synchronize_session=False,
+        )
+        # And so do their replies
+        replied = (
+            select(Comment.parent_id, func.count().label("replies"))
+            .where(Comment.owner_id == user_id, Comment.parent_id.isnot(None))
+            .group_by(Comment.parent_id)
+            .subquery()
+        )
+        self._session.query(Comment).filter(
+            Comment.id == replied.c.parent_id
+        ).update(
+            {
+                Comment.reply_count: Comment.reply_count - replied.c.replies,
+                Comment.updated_at: Comment.updated_at,
+            },
+            synchronize_session=False,
+        )
+        self._session.delete(user)
         self._session.commit()
+        return [post_id for (post_id,) in affected]
 
-    def create_vote(self, user_id: int, post_id: int, dir: int):
-        """Create a new vote for a user on a post"""
-        if dir not in (0, 1):
-            raise ValueError(
-                "Invalid vote direction. Use 0 for downvote and 1 for upvote."
+    def _count_votes(self, changed, delta: int):
+        """UPDATE of vote_count for the post_id column of a CTE"""
+        return (
+            update(Post)
+            .where(Post.id.in_(select(changed.c.post_id)))
+            .values(
+                vote_count=Post.vote_count + delta,
+                # A vote is not an edit of the post
+                updated_at=Post.updated_at,
             )
+            .returning(Post.id)
+            .cte("counted")
+        )
+
+    def find_vote(self, user_id: int, post_id: int):
+        """Find the vote of a user on a post, or None"""
+        return self._session.scalars(
+            vote_by_key(), {"post_id": post_id, "user_id": user_id}
+        ).first()
+
+    def vote(self, user_id: int, post_id: int, dir: int) -> str:
+        """Add (dir 1) or remove (dir 0) a vote in a single statement
+
+        The vote and the post's vote_count change together in one round
+        trip. Returns "added", "exists" (already voted), "removed",
+        "no_vote" (nothing to remove) or "no_post". The foreign key tells
+        that a post is missing; removing from a missing post is "no_vote".
+        """
+        if dir == 1:
+            changed = (
+                pg_insert(Vote)
+                .values(user_id=user_id, post_id=post_id)
+                .on_conflict_do_nothing()
+                .returning(Vote.post_id)
+                .cte("changed")
+            )
+        else:
+            changed = (
+                delete(Vote)
+                .where(Vote.user_id == user_id, Vote.post_id == post_id)
+                .returning(Vote.post_id)
+                .cte("changed")
+            )
+        counted = self._count_votes(changed, 1 if dir == 1 else -1)
+        try:
+            done = self._session.scalar(
+                select(func.count()).select_from(counted)
+            )
+        except IntegrityError:
+            self._session.rollback()
+            return "no_post"
+        self._session.commit()
+        if dir == 1:
+            return "added" if done else "exists"
+        return "removed" if done else "no_vote"
+
+    def apply_votes(self, votes: list) -> list:
+        """Add or remove many votes, of any users, in one transaction
+
+        votes is a list of (user_id, post_id, dir). Returns the outcome of
+        each, as in vote, or "duplicate" when the same user voted on the
+        same post earlier in the list.
+        """
+        outcomes = [None] * len(votes)
+        seen = set()
+        for i, (user_id, post_id, _) in enumerate(votes):
+            if (user_id, post_id) in seen:
+                outcomes[i] = "duplicate"
+            seen.add((user_id, post_id))
+        # One missing post must not fail the inserts of the others
+        existing = self._lock_existing_posts(p for _, p in seen)
+        up, down = set(), set()
+        for i, (user_id, post_id, dir) in enumerate(votes):
+            if outcomes[i] is None and post_id not in existing:
+                outcomes[i] = "no_post"
+            elif outcomes[i] is None:
+                (up if dir == 1 else down).add((user_id, post_id))
 
-        # Check if the user has already voted on this post
-        existing_vote = (
+        added, removed = set(), set()
+        if up:
+            added = set(
+                map(
+                    tuple,
+                    self._session.execute(
+                        pg_insert(Vote)
+                        .values([{"user_id": u, "post_id": p} for u, p in up])
+                        .on_conflict_do_nothing()
+                        .returning(Vote.user_id, Vote.post_id)
+                    ),
+                )
+            )
+        if down:
+            removed = set(
+                map(
+                    tuple,
+                    self._session.execute(
+                        delete(Vote)
+                        .where(tuple_(Vote.user_id, Vote.post_id).in_(down))
+                        .returning(Vote.user_id, Vote.post_id)
+                    ),
+                )
+            )
+        # One UPDATE per post however many votes it got, in id order so
+        # concurrent batches lock posts in the same order
+        deltas = Counter(post_id for _, post_id in added)
+        deltas.subtract(post_id for _, post_id in removed)
+        changes = [
+            {"pid": post_id, "delta": delta}
+            for post_id, delta in sorted(deltas.items())
+            if delta
+        ]
+        if changes:
+            self._session.connection().execute(
+                update(Post)
+                .where(Post.id == bindparam("pid"))
+                .values(
+                    vote_count=Post.vote_count + bindparam("delta"),
+                    updated_at=Post.updated_at,
+                ),
+                changes,
+            )
+        self._session.commit()
+
+        for i, (user_id, post_id, dir) in enumerate(votes):
+            if outcomes[i] is not None:
+                continue
+            pair = (user_id, post_id)
+            if dir == 1:
+                outcomes[i] = "added" if pair in added else "exists"
+            else:
+                outcomes[i] = "removed" if pair in removed else "no_vote"
+        return outcomes
+
+    def get_votes(
+        self,
+        post_id: int,
+        limit: int = 10,
+        cursor: str = None,
+        options: tuple = (),
+    ) -> tuple:
+        """Get a page of the votes on a post, oldest first"""
+        query = paginate(
             self._session.query(Vote)
-            .filter_by(user_id=user_id, post_id=post_id)
-            .first()
+            .options(*options)
+            .filter(Vote.post_id == post_id),
+            (Vote.created_at, Vote.user_id),
+            created_at_id(cursor) if cursor else None,
+            limit,
+        )
+        return page(query.all(), limit, lambda v: (v.created_at, v.user_id))
+
+    def get_comments(
+        self,
+        post_id: int,
+        limit: int = 10,
+        cursor: str = None,
+        options: tuple = (),
+        columns: tuple = None,
+    ) -> tuple:
+        """Get a page of the comments of a post, oldest first
+
+        With columns, the page holds rows of those columns, not comments.
+        """
+        params = {"post_id": post_id, "limit": limit + 1}
+        if cursor:
+            params["after_created_at"], params["after_id"] = created_at_id(
+                cursor
+            )
+        result = self._session.execute(
+            comments_of_post(options, columns, bool(cursor)), params
+        )
+        rows = result.scalars().all() if columns is None else result.all()
+        return page(rows, limit, lambda c: (c.created_at, c.id))
+
+    def get_comments_version(self, post_id: int):
+        """Count, last id and last update of the comments of a post
+
+        Together they change with any insert, edit or delete of a comment.
+        """
+        return (
+            self._session.query(
+                func.count(Comment.id),
+                func.max(Comment.id),
+                func.max(Comment.updated_at),
+            )
+            .filter(Comment.post_id == post_id)
+            .one()
+        )
+
+    def get_comment_threads(
+        self,
+        post_id: int,
+        columns: tuple,
+        limit: int = 10,
+        cursor: str = None,
+        replies: int = 3,
+    ) -> tuple:
+        """Get a page of the top-level comments of a post, oldest first
+
+        Each comes as a dict of the columns (which must hold id) with its
+        first replies, depth first, under "replies", and the cursor of its
+        next replies for get_replies under "replies_cursor".
+        """
+        params = {
+            "post_id": post_id,
+            "after_id": decode_cursor(cursor, int)[0] if cursor else 0,
+            "limit": limit + 1,
+            "replies": replies + 1,
+        }
+        keys = [column.key for column in columns]
+        threads = {}
+        for row in self._session.execute(comment_threads(columns), params):
+            top, reply = row[: len(keys) + 1], row[len(keys) + 1 :]
+            thread = threads.get(top[-1])
+            if thread is None:
+                thread = threads[top[-1]] = dict(zip(keys, top))
+                thread["replies"], thread["replies_cursor"] = [], None
+                # Replies resume past the last one shown, or from the top
+                last_path = top[-1]
+            if reply[-1] is None:
+                continue
+            if len(thread["replies"]) == replies:
+                thread["replies_cursor"] = encode_cursor(last_path)
+            else:
+                thread["replies"].append(dict(zip(keys, reply)))
+                last_path = reply[-1]
+        return page(list(threads.values()), limit, lambda t: (t["id"],))
+
+    def get_replies(
+        self,
+        comment_id: int,
+        columns: tuple,
+        limit: int = 10,
+        cursor: str = None,
+    ) -> tuple:
+        """Get a page of the replies under a comment, however deep
+
+        Replies come depth first, each right after the one it answers, as
+        rows of the columns. Raises NoResultFound if the comment does not
+        exist.
+        """
+        params = {
+            "comment_id": comment_id,
+            "after_path": decode_cursor(cursor, str)[0] if cursor else "",
+            "limit": limit + 1,
+        }
+        rows = self._session.execute(comment_replies(columns), params).all()
+        if not rows:
+            raise NoResultFound
+        if rows[0][-1] is None:
+            return [], None
+        return page(rows, limit, lambda r: (r[-1],))
+
+    def find_comment(self, id: int):
+        """Find an existing comment using its id"""
+        comment = self._session.query(Comment).filter_by(id=id).first()
+        if comment is None:
+            raise NoResultFound
+        return comment
+
+    def _count_replies(self, replies: Counter):
+        """Add to the reply_count of the comments counted in replies"""
+        self._session.execute(
+            update(Comment)
+            .where(Comment.id.in_(replies))
+            .values(
+                reply_count=Comment.reply_count
+                + case(replies, value=Comment.id),
+                # A reply is not an edit of the comment
+                updated_at=Comment.updated_at,
+            )
+            .execution_options(synchronize_session=False)
         )
 
-        if existing_vote:
-            # If a vote exists, update it (change the direction)
-            existing_vote.dir = dir
+    def _thread(self, comments: list) -> list:
+        """Place comments under their parents and count them as replies
+
+        Locks the parents, and returns each comment with the ancestry it
+        takes, or why it has no place: "no_parent", "other_post" (the
+        parent is on another post) or "too_deep".
+        """
+        parent_ids = {c["parent_id"] for c in comments if c.get("parent_id")}
+        parents = (
+            {
+                parent.id: parent
+                for parent in self._session.execute(
+                    select(
+                        Comment.id, Comment.post_id, Comment.path, Comment.depth
+                    )
+                    .where(Comment.id.in_(parent_ids))
+                    .order_by(Comment.id)
+                    .with_for_update()
+                )
+            }
+            if parent_ids
+            else {}
+        )
+        placed = []
+        for comment in comments:
+            parent = parents.get(comment.get("parent_id"))
+            if not comment.get("parent_id"):
+                placed.append({**comment, "ancestry": ""})
+            elif parent is None:
+                placed.append("no_parent")
+            elif parent.post_id != comment["post_id"]:
+                placed.append("other_post")
+            elif parent.depth >= s.comment_max_depth:
+                placed.append("too_deep")
+            else:
+                placed.append({**comment, "ancestry": parent.path})
+        replies = Counter(
+            comment["parent_id"]
+            for comment in placed
+            if isinstance(comment, dict) and comment.get("parent_id")
+        )
+        if replies:
+            self._count_replies(replies)
+        return placed
+
+    def create_comment(
+        self, content: str, post_id: int, owner_id: int, parent_id: int = None
+    ):
+        """Create a new comment on a post, or a reply to another comment
+
+        Raises ValueError with the reason of _thread if the reply has no
+        place, or "no_post" if the post is gone.
+        """
+        (placed,) = self._thread(
+            [{"content": content, "post_id": post_id, "parent_id": parent_id}]
+        )
+        if isinstance(placed, str):
+            self._session.rollback()
+            raise ValueError(placed)
+        new_comment = Comment(**placed, owner_id=owner_id)
+        self._session.add(new_comment)
+        try:
             self._session.commit()
-            return existing_vote
+        except IntegrityError:
+            # The post was deleted since the caller found it
+            self._session.rollback()
+            raise ValueError("no_post")
+        self._session.refresh(new_comment)
+        return new_comment
 
-        # If no vote exists, create a new vote
-        new_vote = Vote(user_id=user_id, post_id=post_id, dir=dir)
-        self._session.add(new_vote)
+    def create_comments(self, comments: list, owner_id: int) -> list:
+        """Create many comments and replies in one transaction
+
+        Returns the id of each comment in order, or why it was skipped:
+        "no_post" when its post does not exist, or a reason of _thread.
+        """
+        existing = self._lock_existing_posts(c["post_id"] for c in comments)
+        placed = iter(
+            self._thread([c for c in comments if c["post_id"] in existing])
+        )
+        outcomes = [
+            next(placed) if comment["post_id"] in existing else "no_post"
+            for comment in comments
+        ]
+        rows = [
+            {**outcome, "owner_id": owner_id}
+            for outcome in outcomes
+            if isinstance(outcome, dict)
+        ]
+        ids = iter(
+            self._session.scalars(
+                insert(Comment).returning(
+                    Comment.id, sort_by_parameter_order=True
+                ),
+                rows,
+            ).all()
+            if rows
+            else ()
+        )
+        self._session.commit()
+        return [
+            next(ids) if isinstance(outcome, dict) else outcome
+            for outcome in outcomes
+        ]
+
+    def update_comment(self, comment_id: int, content: str):
+        """Update the content of an existing comment"""
+        comment = self.find_comment(id=comment_id)
+        comment.content = content
+        self._session.commit()
+        self._session.refresh(comment)
+        return comment
+
+    def delete_comment(self, comment_id: int):
+        """Delete an existing comment, and the replies under it"""
+        comment = self.find_comment(id=comment_id)
+        # The parent first, in the order of the ON DELETE CASCADE locks
+        if comment.parent_id:
+            self._count_replies(Counter({comment.parent_id: -1}))
+        self._session.delete(comment)
         self._session.commit()
-        return new_vote
 
+    def stream(self, statements: tuple, size: int):
+        """Yield (name, rows) batches of (name, statement) pairs
+
+        The statements run on server-side cursors, size rows at a time, in
+        one REPEATABLE READ transaction so they all see the same snapshot.
+        """
+        self._session.commit()
+        self._session.connection(execution_options=SNAPSHOT)
+        for name, statement in statements:
+            result = self._session.execute(
+                statement.execution_options(yield_per=size)
+            )
+            for rows in result.partitions():
+                yield name, rows
+
+
+class AsyncDB:
+    """Awaitable facade running DB methods on an asyncpg AsyncSession"""
+
+    # Whether the facade holds an admission slot, see get_db
+    admitted = False
+
+    def __init__(self, session: AsyncSession):
+        """Initialize AsyncDB"""
+        self.session = session
+
+    def __getattr__(self, name):
+        """Expose every public DB method as a coroutine"""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = getattr(DB, name)
+        if name not in DB.READS:
+            self.use_primary()
+
+        async def call(*args, **kwargs):
+            return await self.session.run_sync(
+                lambda session: method(DB(session), *args, **kwargs)
+            )
+
+        return call
+
+    async def stream(self, statements: tuple, size: int):
+        """Yield (name, rows) batches of statements, see DB.stream"""
+        await self.session.commit()
+        await self.session.connection(execution_options=SNAPSHOT)
+        for name, statement in statements:
+            result = await self.session.stream(
+                statement.execution_options(yield_per=size)
+            )
+            async for rows in result.partitions():
+                yield name, rows
+
+    def use_primary(self):
+        """Send the rest of the session's statements to the primary"""
+        self.session.info.pop("replica", None)
+
+    async def close(self):
+        """Close the session"""
+        await self.session.close()
+
+    @asynccontextmanager
+    async def idle(self):
+        """Hold neither a connection nor an admission slot for the block
+
+        For CPU-only work between statements, such as hashing a password.
+        The session is closed, so its transaction ends: call it with no
+        write pending. Objects already loaded stay readable, and the next
+        statement waits for a slot again before it takes a connection.
+        """
+        await self.close()
+        admitted = self.admitted
+        if admitted:
+            admission.release()
+            self.admitted = False
+        yield
+        if admitted:
+            await admission.acquire()
+            self.admitted = True
+
+
+class ThreadedDB(AsyncDB):
+    """Awaitable facade running DB methods in the threadpool"""
+
+    def __init__(self, db: DB = None):
+        """Initialize ThreadedDB"""
+        self.db = db or DB()
+
+    def __getattr__(self, name):
+        """Expose every public DB method as a coroutine"""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = getattr(self.db, name)
+        if name not in DB.READS:
+            self.use_primary()
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+
+        return call
+
+    async def stream(self, statements: tuple, size: int):
+        """Yield (name, rows) batches of statements, see DB.stream"""
+        batches = self.db.stream(statements, size)
+        async for batch in iterate_in_threadpool(batches):
+            yield batch
+
+    def use_primary(self):
+        """Send the rest of the session's statements to the primary"""
+        self.db._session.info.pop("replica", None)
+
+    async def close(self):
+        """Close the session"""
+        await run_in_threadpool(self.db._session.close)
+
+
+def open_db(replica: bool = False) -> AsyncDB:
+    """Open a database, async or threaded per settings; close it after
+
+    With replica, its reads go to the next replica in turn, if any.
+    """
+    if s.db_async:
+        factory = get_async_session_factory()
+        replicas = [engine.sync_engine for engine in _async_replicas]
+    else:
+        factory = get_session_factory()
+        replicas = _replicas
+    info = {}
+    if replica and replicas:
+        info["replica"] = replicas[next(_replica_turns) % len(replicas)]
+    if s.db_async:
+        return AsyncDB(factory(info=info))
+    return ThreadedDB(DB(factory(info=info)))
+
+
+async def get_db(request: Request):
+    """Yield the database of a request, once admitted
 
-def get_db():
-    db = DB()
+    It reads from a replica when read_your_writes allowed the request to.
+    The slot is given back while the request is idle, see AsyncDB.idle.
+    """
+    await admission.acquire()
+    db = open_db(replica=getattr(request.state, "replica", False))
+    db.admitted = True
     try:
         yield db
     finally:
-        db._session.close()
+        await db.close()
+        if db.admitted:
+            admission.release()
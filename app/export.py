@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Module for the NDJSON export of a user's content
+
+The export is one JSON object per line, each tagged with its "type": the
+user first, then their posts, comments and votes, in no particular order.
+Rows are read through server-side cursors, EXPORT_BATCH_SIZE at a time,
+and each batch is encoded and sent before the next is fetched, so memory
+stays flat however large the account, and a slow reader holds the cursor
+back instead of piling rows up in the worker.
+"""
+import orjson
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import AsyncDB, NoResultFound
+from app.fast_json import OPTIONS, fields
+from app.models import User, Post, Vote, Comment
+
+# Columns exported per type; never the password hash
+COLUMNS = {
+    "user": (User.id, User.username, User.email, User.created_at),
+    "post": (
+        Post.id,
+        Post.title,
+        Post.content,
+        Post.published,
+        Post.vote_count,
+        Post.created_at,
+        Post.updated_at,
+    ),
+    "comment": (
+        Comment.id,
+        Comment.post_id,
+        Comment.parent_id,
+        Comment.content,
+        Comment.created_at,
+        Comment.updated_at,
+    ),
+    "vote": (Vote.post_id, Vote.created_at),
+}
+
+
+def statements(user_id: int) -> tuple:
+    """(type, statement) pairs selecting everything of a user"""
+    owners = {
+        "user": User.id,
+        "post": Post.owner_id,
+        "comment": Comment.owner_id,
+        "vote": Vote.user_id,
+    }
+    return tuple(
+        (kind, select(*COLUMNS[kind]).where(owners[kind] == user_id))
+        for kind in COLUMNS
+    )
+
+
+def encode(kind: str, rows) -> bytes:
+    """NDJSON lines of rows of a type"""
+    names = ("type", *fields(COLUMNS[kind]))
+    return b"".join(
+        orjson.dumps(dict(zip(names, (kind, *row))), option=OPTIONS) + b"\n"
+        for row in rows
+    )
+
+
+async def chunks(db: AsyncDB, user_id: int):
+    """Encoded batches of the export; NoResultFound if there is no user"""
+    found = False
+    async for kind, rows in db.stream(
+        statements(user_id), settings.export_batch_size
+    ):
+        found = found or kind == "user"
+        if not found:
+            raise NoResultFound
+        yield encode(kind, rows)
+    if not found:
+        raise NoResultFound
+
+
+async def export_response(db: AsyncDB, user_id: int) -> StreamingResponse:
+    """Streaming NDJSON export of a user, on the request's database
+
+    The first batch, the user, is fetched before answering, so a missing
+    user raises NoResultFound instead of cutting a 200 response short. The
+    request's database stays open until the response is sent.
+    """
+    body = chunks(db, user_id)
+    first = await anext(body)
+
+    async def rest():
+        yield first
+        async for chunk in body:
+            yield chunk
+
+    return StreamingResponse(
+        rest(),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="user-{user_id}.ndjson"'
+            )
+        },
+    )
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Module for the hot feed: posts ranked by votes decayed by age
+
+A post scores log10(votes) + created_at / 45000 seconds, so ten times the
+votes are worth 12.5 hours of recency. The score only changes when the
+vote count does, hence the feed is kept incrementally: writes mark their
+posts dirty, and a background task rescores the dirty posts every
+HOT_FEED_REFRESH_S from the posts table (never from votes), and rebuilds
+the top HOT_FEED_SIZE from scratch every HOT_FEED_REBUILD_S. The ranking
+lives in memory (per worker) or in a Redis sorted set (shared), following
+CACHE_BACKEND, and pages of the feed are read from it alone.
+
+In memory, a write marks its posts dirty in the worker that served it
+only, and the other workers see it at their next rebuild. So by default
+a worker rebuilds in memory every few refreshes, and in Redis hourly.
+"""
+import asyncio
+import contextvars
+import logging
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+
+from prometheus_client import Histogram
+from sqlalchemy import func
+
+from app.config import settings
+from app.database import open_db
+from app.models import Post
+
+logger = logging.getLogger(__name__)
+
+# Seconds of age that cost as much as a tenfold vote count
+DECAY_SECONDS = 45_000
+
+# Default HOT_FEED_REBUILD_S with Redis, and in refreshes in memory
+SHARED_REBUILD_S = 3600
+MEMORY_REBUILD_REFRESHES = 5
+
+# Scores of the top posts, as ranked by the database for a rebuild
+SQL_SCORE = (
+    func.log(func.greatest(Post.vote_count, 1))
+    + func.extract("epoch", Post.created_at) / DECAY_SECONDS
+)
+
+REFRESH_TIME = Histogram(
+    "hot_feed_refresh_seconds",
+    "Time to rescore the dirty posts, or to rebuild the feed",
+    ("kind",),
+)
+REFRESH_POSTS = Histogram(
+    "hot_feed_refresh_posts",
+    "Posts rescored by a refresh, or loaded by a rebuild",
+    ("kind",),
+    buckets=(0, 1, 10, 100, 1_000, 10_000, 100_000),
+)
+LAG = Histogram(
+    "hot_feed_lag_seconds",
+    "Time from the oldest write of a refresh to its score in the feed",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+
+def hot_score(vote_count: int, created_at) -> float:
+    """Score of a post, the same as SQL_SCORE"""
+    return (
+        math.log10(max(vote_count, 1))
+        + created_at.timestamp() / DECAY_SECONDS
+    )
+
+
+class MemoryRanking:
+    """Scores of one worker, in a list sorted best first"""
+
+    def __init__(self):
+        """Initialize MemoryRanking"""
+        self._keys = []  # (-score, -id), ascending
+        self._scores = {}
+        self._dirty = set()
+        self._dirty_since = None
+
+    async def mark(self, *post_ids: int):
+        """Mark posts for rescoring"""
+        if post_ids and self._dirty_since is None:
+            self._dirty_since = time.time()
+        self._dirty.update(post_ids)
+
+    async def take_dirty(self) -> tuple:
+        """The dirty posts, and the time of the oldest mark; unmark them"""
+        dirty, since = self._dirty, self._dirty_since
+        self._dirty, self._dirty_since = set(), None
+        return dirty, since
+
+    async def put(self, scores: dict):
+        """Set the scores of posts"""
+        for post_id, score in scores.items():
+            self._discard(post_id)
+            self._scores[post_id] = score
+            insort(self._keys, (-score, -post_id))
+
+    async def remove(self, *post_ids: int):
+        """Drop posts"""
+        for post_id in post_ids:
+            self._discard(post_id)
+
+    def _discard(self, post_id: int):
+        """Drop a post if ranked"""
+        score = self._scores.pop(post_id, None)
+        if score is not None:
+            del self._keys[bisect_left(self._keys, (-score, -post_id))]
+
+    async def trim(self, size: int):
+        """Keep the best size posts"""
+        for _, post_id in self._keys[size:]:
+            del self._scores[-post_id]
+        del self._keys[size:]
+
+    async def replace(self, scores: dict):
+        """Replace every score"""
+        self._scores = dict(scores)
+        self._keys = sorted((-s, -post_id) for post_id, s in scores.items())
+
+    async def page(self, after: tuple, count: int) -> list:
+        """Up to count (score, id) pairs, best first, after a pair"""
+        start = 0
+        if after is not None:
+            start = bisect_right(self._keys, (-after[0], -after[1]))
+        return [(-s, -i) for s, i in self._keys[start : start + count]]
+
+    async def claim_rebuild(self, seconds: float) -> bool:
+        """Whether this worker should rebuild; always, it is its own"""
+        return True
+
+    async def size(self) -> int:
+        """Number of ranked posts"""
+        return len(self._keys)
+
+
+class RedisRanking:
+    """Scores shared by every worker in a Redis sorted set
+
+    Members are zero-padded ids, so posts of equal score rank by id, as in
+    MemoryRanking.
+    """
+
+    def __init__(self, name: str, url: str = None):
+        """Initialize RedisRanking"""
+        from redis import asyncio as aioredis
+
+        self.client = aioredis.from_url(url or settings.redis_url)
+        self.key = f"{name}:ranking"
+        self.dirty_key = f"{name}:dirty"
+        self.since_key = f"{name}:dirty_since"
+        self.rebuild_key = f"{name}:rebuild"
+
+    @staticmethod
+    def _member(post_id: int) -> str:
+        """Sorted set member of a post"""
+        return f"{post_id:012d}"
+
+    async def mark(self, *post_ids: int):
+        """Mark posts for rescoring"""
+        if post_ids:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.sadd(self.dirty_key, *post_ids)
+                pipe.set(self.since_key, time.time(), nx=True)
+                await pipe.execute()
+
+    async def take_dirty(self) -> tuple:
+        """The dirty posts, and the time of the oldest mark; unmark them"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.smembers(self.dirty_key)
+            pipe.get(self.since_key)
+            pipe.delete(self.dirty_key, self.since_key)
+            dirty, since, _ = await pipe.execute()
+        return {int(p) for p in dirty}, float(since) if since else None
+
+    async def put(self, scores: dict):
+        """Set the scores of posts"""
+        if scores:
+            await self.client.zadd(
+                self.key, {self._member(p): s for p, s in scores.items()}
+            )
+
+    async def remove(self, *post_ids: int):
+        """Drop posts"""
+        if post_ids:
+            await self.client.zrem(self.key, *map(self._member, post_ids))
+
+    async def trim(self, size: int):
+        """Keep the best size posts"""
+        await self.client.zremrangebyrank(self.key, 0, -size - 1)
+
+    async def replace(self, scores: dict):
+        """Replace every score"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key)
+            if scores:
+                pipe.zadd(
+                    self.key,
+                    {self._member(p): s for p, s in scores.items()},
+                )
+            await pipe.execute()
+
+    async def page(self, after: tuple, count: int) -> list:
+        """Up to count (score, id) pairs, best first, after a pair"""
+        top = "+inf" if after is None else after[0]
+        pairs, offset = [], 0
+        while len(pairs) < count:
+            chunk = await self.client.zrange(
+                self.key,
+                top,
+                "-inf",
+                byscore=True,
+                desc=True,
+                offset=offset,
+                num=count,
+                withscores=True,
+            )
+            if not chunk:
+                break
+            offset += len(chunk)
+            for member, score in chunk:
+                post_id = int(member)
+                # Skip the ties ranking before the cursor
+                if after is None or (score, post_id) < after:
+                    pairs.append((score, post_id))
+        return pairs[:count]
+
+    async def claim_rebuild(self, seconds: float) -> bool:
+        """Whether this worker should rebuild, at most one per period"""
+        return bool(
+            await self.client.set(
+                self.rebuild_key, 1, nx=True, px=int(seconds * 1000)
+            )
+        )
+
+    async def size(self) -> int:
+        """Number of ranked posts"""
+        return await self.client.zcard(self.key)
+
+
+def rebuild_interval() -> float:
+    """HOT_FEED_REBUILD_S, or its default for the cache backend"""
+    if settings.hot_feed_rebuild_s is not None:
+        return settings.hot_feed_rebuild_s
+    if settings.cache_backend == "memory":
+        return MEMORY_REBUILD_REFRESHES * settings.hot_feed_refresh_s
+    return SHARED_REBUILD_S
+
+
+def make_ranking(name: str):
+    """Create a ranking on the backend chosen in the settings"""
+    if settings.cache_backend == "redis":
+        return RedisRanking(name)
+    if settings.cache_backend == "memory":
+        return MemoryRanking()
+    raise ValueError(f"Unknown cache backend {settings.cache_backend}")
+
+
+class HotFeed:
+    """The ranking and the task keeping it up to date"""
+
+    def __init__(self, ranking, size: int, refresh: float, rebuild: float):
+        """Initialize HotFeed"""
+        self.ranking = ranking
+        self.size = size
+        self.refresh_interval = refresh
+        self.rebuild_interval = rebuild
+        self._task = None
+        self._ready = asyncio.Event()
+        self._last_rebuild = None
+
+    async def mark_dirty(self, *post_ids: int):
+        """Rescore posts whose votes changed, or that were added or deleted"""
+        await self.ranking.mark(*post_ids)
+
+    async def page(self, after: tuple, count: int) -> list:
+        """(score, id) pairs of a page, once the feed is first built"""
+        await self._ready.wait()
+        return await self.ranking.page(after, count)
+
+    async def refresh(self):
+        """Rescore the dirty posts"""
+        post_ids, since = await self.ranking.take_dirty()
+        if not post_ids:
+            return
+        start = time.perf_counter()
+        db = open_db()
+        try:
+            rows = await db.get_post_scores(post_ids=list(post_ids))
+        except Exception:
+            await self.ranking.mark(*post_ids)
+            raise
+        finally:
+            await db.close()
+        scores = {
+            row.id: hot_score(row.vote_count, row.created_at) for row in rows
+        }
+        await self.ranking.put(scores)
+        await self.ranking.remove(*(post_ids - scores.keys()))
+        await self.ranking.trim(self.size)
+        REFRESH_TIME.labels("refresh").observe(time.perf_counter() - start)
+        REFRESH_POSTS.labels("refresh").observe(len(post_ids))
+        LAG.observe(time.time() - since)
+
+    async def rebuild(self):
+        """Rank the top posts from scratch"""
+        start = time.perf_counter()
+        db = open_db()
+        try:
+            rows = await db.get_top_post_scores(
+                limit=self.size, score=SQL_SCORE
+            )
+        finally:
+            await db.close()
+        await self.ranking.replace(
+            {row.id: hot_score(row.vote_count, row.created_at) for row in rows}
+        )
+        REFRESH_TIME.labels("rebuild").observe(time.perf_counter() - start)
+        REFRESH_POSTS.labels("rebuild").observe(len(rows))
+
+    async def _run(self):
+        """Refresh forever, rebuilding when due"""
+        while True:
+            try:
+                now = time.monotonic()
+                due = (
+                    self._last_rebuild is None
+                    or now - self._last_rebuild >= self.rebuild_interval
+                )
+                if due:
+                    self._last_rebuild = now
+                    claimed = await self.ranking.claim_rebuild(
+                        self.rebuild_interval
+                    )
+                    if claimed:
+                        await self.rebuild()
+                await self.refresh()
+            except Exception:
+                logger.exception("Hot feed refresh failed")
+            finally:
+                self._ready.set()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """Start the background task"""
+        if self._task is None:
+            self._task = asyncio.create_task(
+                self._run(), context=contextvars.Context()
+            )
+
+    async def stop(self):
+        """Stop the background task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stats(self) -> dict:
+        """Size of the feed and the age of its last rebuild"""
+        return {
+            "size": await self.ranking.size(),
+            "rebuilt_seconds_ago": (
+                time.monotonic() - self._last_rebuild
+                if self._last_rebuild is not None
+                else None
+            ),
+        }
+
+
+hot_feed = HotFeed(
+    make_ranking("hot_feed"),
+    size=settings.hot_feed_size,
+    refresh=settings.hot_feed_refresh_s,
+    rebuild=rebuild_interval(),
+)
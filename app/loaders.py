@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Module for relationship loader strategies, one per response schema
+
+Each strategy eagerly loads exactly what its schema serializes and forbids
+any other lazy load, so an endpoint issues a fixed number of queries.
+"""
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload, raiseload
+
+from app.fast_json import schema_columns, sparse
+from app.models import User, Post, Vote, Comment
+from app.schemas import PostDisplay, UserDisplay, CommentDisplay
+
+# PostDisplay, PostDisplayMin: columns only
+POST_DISPLAY = (raiseload("*"),)
+
+# PostDisplayAll: owner in the same query
+POST_DISPLAY_ALL = (joinedload(Post.owner), raiseload("*"))
+
+# UserDisplay: columns only
+USER_DISPLAY = (raiseload("*"),)
+
+# UserDisplayWithPosts: posts in one more query
+USER_DISPLAY_WITH_POSTS = (selectinload(User.posts), raiseload("*"))
+
+# CommentDisplay: columns only
+COMMENT_DISPLAY = (raiseload("*"),)
+
+# VoteDisplay: user in the same query
+VOTE_DISPLAY = (joinedload(Vote.user), raiseload("*"))
+
+# Columns of the schemas the fast JSON path fetches as plain rows
+POST_DISPLAY_COLUMNS = schema_columns(Post, PostDisplay)
+USER_DISPLAY_COLUMNS = schema_columns(User, UserDisplay)
+COMMENT_DISPLAY_COLUMNS = schema_columns(Comment, CommentDisplay)
+
+
+def post_columns(fields: str = None, excerpt: int = None) -> tuple:
+    """POST_DISPLAY_COLUMNS narrowed to some fields, content cut to excerpt
+
+    The cut happens in the database: Postgres only detoasts the start of a
+    long content, and only the excerpt goes over the wire.
+    """
+    columns = POST_DISPLAY_COLUMNS
+    if fields is not None:
+        columns = sparse(columns, fields)
+    if excerpt is not None:
+        columns = tuple(
+            (
+                func.left(Post.content, excerpt).label("content")
+                if column is Post.content
+                else column
+            )
+            for column in columns
+        )
+    return columns
@@ -2,13 +2,90 @@
 """
 Main FastAPI app module
 """
-from fastapi import FastAPI
-from app.routes import posts, users, votes, auth, comments
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Request, status
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from app.admission import SHED, Overloaded, admission
+from app.config import settings
+from app.consistency import read_your_writes
+from app.database import (
+    init_db,
+    init_async_db,
+    upgrade_schema,
+    dispose_db,
+    dispose_async_db,
+)
+from app.hot_feed import hot_feed
+from app.metrics import MetricsMiddleware
+from app.rate_limit import rate_limit
+from app.slow_queries import slow_query_log
+from app.routes import posts, users, votes, auth, comments, admin
+from app.utils import PasswordPoolBusy, shutdown_password_pool
+from app.vote_coalescer import vote_coalescer
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up the shared engine once per worker process"""
+    init_db()
+    admission.reset()
+    if settings.db_async:
+        init_async_db()
+    if settings.db_migrate:
+        upgrade_schema()
+    hot_feed.start()
+    yield
+    await hot_feed.stop()
+    await vote_coalescer.drain()
+    await dispose_async_db()
+    slow_query_log.shutdown()
+    dispose_db()
+    shutdown_password_pool()
+
+
+app = FastAPI(
+    lifespan=lifespan,
+    dependencies=[Depends(rate_limit), Depends(read_your_writes)],
+)
+
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        """Prometheus histograms of the requests served by this process"""
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.exception_handler(PasswordPoolBusy)
+async def password_pool_busy(request: Request, exc: PasswordPoolBusy):
+    """Shed password operations instead of queueing them without bound"""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many password operations, retry later"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(Overloaded)
+@app.exception_handler(PoolTimeout)
+async def database_busy(request: Request, exc: Exception):
+    """Shed requests that waited too long for a database connection"""
+    if isinstance(exc, PoolTimeout):
+        SHED.labels("pool").inc()
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Database busy, retry later"},
+        headers={"Retry-After": "1"},
+    )
 
-app = FastAPI()
 
 app.include_router(posts.router)
 app.include_router(users.router)
 app.include_router(votes.router)
 app.include_router(comments.router)
-app.include_router(auth.router)
\ No newline at end of file
+app.include_router(auth.router)
+app.include_router(admin.router)
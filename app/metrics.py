@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Module for per-request performance metrics
+
+Every request gets a RequestTimings in a context variable. Engine events
+add the SQL statements and their time to it, timer() blocks add named
+phases (auth, password hashing), and TimedRoute adds the serialization of
+the response. The middleware sends them back as a Server-Timing header and
+records them in Prometheus histograms labeled by route template.
+"""
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import CacheStats
+
+UNMATCHED = "<unmatched>"
+
+REQUEST_TIME = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request",
+    ("method", "route", "status"),
+)
+DB_STATEMENTS = Histogram(
+    "db_statements_per_request",
+    "SQL statements run by a request",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+DB_TIME = Histogram(
+    "db_time_seconds", "Time a request spent in SQL statements", ("route",)
+)
+PHASE_TIME = Histogram(
+    "request_phase_seconds",
+    "Time a request spent in auth, password hashing or serialization",
+    ("route", "phase"),
+)
+COMPILED_CACHE = Counter(
+    "db_compiled_cache_total",
+    "SQL statements by the outcome of their compiled cache lookup",
+    ("result",),
+)
+_COMPILED_CACHE_RESULTS = {
+    stat: COMPILED_CACHE.labels(stat.name.lower()) for stat in CacheStats
+}
+
+
+class RequestTimings:
+    """Counters of the request being served"""
+
+    __slots__ = ("scope", "statements", "db", "phases", "endpoint_done")
+
+    def __init__(self, scope: dict):
+        """Initialize RequestTimings"""
+        self.scope = scope
+        self.statements = 0
+        self.db = 0.0
+        self.phases = {}
+        self.endpoint_done = None
+
+    def add(self, phase: str, seconds: float):
+        """Add time to a phase"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        """Value of the Server-Timing header, durations in milliseconds"""
+        metrics = [
+            f'db;dur={self.db * 1000:.2f};desc="{self.statements} queries"'
+        ]
+        for phase, seconds in self.phases.items():
+            metrics.append(f"{phase};dur={seconds * 1000:.2f}")
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+    @property
+    def route(self) -> str:
+        """Template of the matched route, once routing is done"""
+        return getattr(self.scope.get("route"), "path", UNMATCHED)
+
+
+_current = ContextVar("request_timings", default=None)
+
+
+def current_route() -> str | None:
+    """Route template of the request being served, if any"""
+    timings = _current.get()
+    return timings.route if timings is not None else None
+
+
+@contextmanager
+def timer(phase: str):
+    """Add the time of the block to a phase of the current request"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, params, context, many):
+    """Note when a statement starts"""
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, params, context, many):
+    """Add a statement and its time to the current request"""
+    _COMPILED_CACHE_RESULTS[context.cache_hit].inc()
+    timings = _current.get()
+    if timings is not None:
+        timings.statements += 1
+        timings.db += time.perf_counter() - context._metrics_start
+
+
+def compiled_cache_stats() -> dict:
+    """Lookups of SQLAlchemy's compiled cache by the statements so far"""
+    counts = {
+        sample.labels["result"]: int(sample.value)
+        for metric in COMPILED_CACHE.collect()
+        for sample in metric.samples
+        if sample.name == "db_compiled_cache_total"
+    }
+    return {
+        "backend": "sqlalchemy",
+        "hits": counts.get("cache_hit", 0),
+        "misses": counts.get("cache_miss", 0),
+        "uncached": sum(counts.values())
+        - counts.get("cache_hit", 0)
+        - counts.get("cache_miss", 0),
+    }
+
+
+def instrument_engine(engine):
+    """Count the statements of an engine (the sync_engine of async ones)"""
+    if not event.contains(
+        engine, "before_cursor_execute", _before_cursor_execute
+    ):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class TimedRoute(APIRoute):
+    """Route timing the serialization of what its endpoint returns"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        """Initialize TimedRoute"""
+        if inspect.iscoroutinefunction(endpoint):
+            endpoint = self._wrap(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _wrap(endpoint):
+        """Note when the endpoint returns"""
+
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            result = await endpoint(*args, **kwargs)
+            timings = _current.get()
+            if timings is not None:
+                timings.endpoint_done = time.perf_counter()
+            return result
+
+        return timed_endpoint
+
+    def get_route_handler(self):
+        """Add the time from the endpoint return to the response"""
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            timings = _current.get()
+            if timings is not None and timings.endpoint_done is not None:
+                timings.add(
+                    "serialize", time.perf_counter() - timings.endpoint_done
+                )
+            return response
+
+        return timed_handler
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing requests and sending Server-Timing"""
+
+    def __init__(self, app):
+        """Initialize MetricsMiddleware"""
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        """Serve a request with its timings in context"""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings(scope)
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = timings.server_timing(time.perf_counter() - start)
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (b"server-timing", header.encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            self.observe(
+                scope["method"],
+                timings.route,
+                status,
+                time.perf_counter() - start,
+                timings,
+            )
+
+    @staticmethod
+    def observe(method, route, status, seconds, timings):
+        """Record a request in the histograms"""
+        REQUEST_TIME.labels(method, route, str(status)).observe(seconds)
+        DB_STATEMENTS.labels(route).observe(timings.statements)
+        DB_TIME.labels(route).observe(timings.db)
+        for phase, phase_seconds in timings.phases.items():
+            PHASE_TIME.labels(route, phase).observe(phase_seconds)
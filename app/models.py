@@ -10,12 +10,19 @@ from sqlalchemy import (
     ForeignKey,
     TIMESTAMP,
     PrimaryKeyConstraint,
+    Index,
+    Computed,
+    text,
 )
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, declarative_base, deferred
 from sqlalchemy.sql import func
 
 Base = declarative_base()
 
+# Text search configuration of the posts search vector
+SEARCH_CONFIG = "english"
+
 
 class Post(Base):
     """Post model"""
@@ -26,6 +33,8 @@ class Post(Base):
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     published = Column(Boolean, nullable=False, server_default="FALSE")
+    # Kept in step with the votes table by the vote writes in DB
+    vote_count = Column(Integer, nullable=False, server_default="0")
 
     created_at = Column(
         TIMESTAMP(timezone=True),
@@ -39,13 +48,45 @@ class Post(Base):
         onupdate=func.now(),
     )
 
+    # Maintained by Postgres: title weighs more than content
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                f"setweight(to_tsvector('{SEARCH_CONFIG}', title), 'A')"
+                f" || setweight(to_tsvector('{SEARCH_CONFIG}', content), 'B')",
+                persisted=True,
+            ),
+        )
+    )
+
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     owner = relationship("User", back_populates="posts")
 
+    # Deleted by ON DELETE CASCADE, replies included, without loading them
     comments = relationship(
-        "Comment", back_populates="post", cascade="all, delete"
+        "Comment",
+        back_populates="post",
+        cascade="all, delete",
+        passive_deletes=True,
+    )
+    votes = relationship(
+        "Vote",
+        back_populates="post",
+        cascade="all, delete",
+        passive_deletes=True,
+    )
+
+    __table_args__ = (
+        # Keyset pagination, newest first
+        Index("ix_posts_created_at_id", "created_at", "id"),
+        # Posts of a user, and the cascade when a user is deleted
+        Index("ix_posts_owner_id", "owner_id"),
+        # Full-text search
+        Index(
+            "ix_posts_search_vector", "search_vector", postgresql_using="gin"
+        ),
     )
-    votes = relationship("Vote", back_populates="post", cascade="all, delete")
 
 
 class User(Base):
@@ -62,11 +103,28 @@ class User(Base):
         TIMESTAMP(timezone=True), nullable=False, server_default=func.now()
     )
 
-    posts = relationship("Post", back_populates="owner", cascade="all, delete")
+    # Deleted by ON DELETE CASCADE, replies included, without loading them
+    posts = relationship(
+        "Post",
+        back_populates="owner",
+        cascade="all, delete",
+        passive_deletes=True,
+    )
     comments = relationship(
-        "Comment", back_populates="user", cascade="all, delete"
+        "Comment",
+        back_populates="user",
+        cascade="all, delete",
+        passive_deletes=True,
     )
-    votes = relationship("Vote", back_populates="user", cascade="all, delete")
+    votes = relationship(
+        "Vote",
+        back_populates="user",
+        cascade="all, delete",
+        passive_deletes=True,
+    )
+
+    # Keyset pagination
+    __table_args__ = (Index("ix_users_created_at_id", "created_at", "id"),)
 
 
 class Vote(Base):
@@ -89,7 +147,17 @@ class Vote(Base):
     post = relationship("Post", back_populates="votes")
     user = relationship("User", back_populates="votes")
 
-    __table_args__ = (PrimaryKeyConstraint("user_id", "post_id"),)
+    __table_args__ = (
+        PrimaryKeyConstraint("user_id", "post_id"),
+        # Keyset pagination of the voters of a post, also serving the
+        # lookups and cascades by post_id the primary key cannot
+        Index(
+            "ix_votes_post_id_created_at_user_id",
+            "post_id",
+            "created_at",
+            "user_id",
+        ),
+    )
 
 
 class Comment(Base):
@@ -106,6 +174,23 @@ class Comment(Base):
     owner_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False
     )
+    # The comment a reply answers; none for top-level comments
+    parent_id = Column(
+        Integer, ForeignKey("comments.id", ondelete="CASCADE"), nullable=True
+    )
+    # Ids of the ancestors, root first, 8 hex digits each: a reply takes
+    # the path of its parent
+    ancestry = Column(String(collation="C"), nullable=False, server_default="")
+    # Maintained by Postgres: paths sort a thread depth first, siblings
+    # oldest first, and the replies below a comment are the paths that
+    # extend its own
+    path = Column(
+        String(collation="C"),
+        Computed("ancestry || lpad(to_hex(id), 8, '0')", persisted=True),
+    )
+    depth = Column(Integer, Computed("length(ancestry) / 8", persisted=True))
+    # Direct replies, kept in step by the comment writes in DB
+    reply_count = Column(Integer, nullable=False, server_default="0")
 
     created_at = Column(
         TIMESTAMP(timezone=True),
@@ -121,3 +206,24 @@ class Comment(Base):
 
     post = relationship("Post", back_populates="comments")
     user = relationship("User", back_populates="comments")
+
+    __table_args__ = (
+        # Keyset pagination of the comments of a post, also serving the
+        # lookups and cascades by post_id
+        Index(
+            "ix_comments_post_id_created_at_id", "post_id", "created_at", "id"
+        ),
+        # Comments of a user, and the cascade when a user is deleted
+        Index("ix_comments_owner_id", "owner_id"),
+        # Top-level comments of a post, oldest first
+        Index(
+            "ix_comments_post_id_top_level",
+            "post_id",
+            "id",
+            postgresql_where=text("parent_id IS NULL"),
+        ),
+        # The cascade to the replies of a deleted comment
+        Index("ix_comments_parent_id", "parent_id"),
+        # Threads of a post depth first, and subtrees as ranges of paths
+        Index("ix_comments_post_id_path", "post_id", "path"),
+    )
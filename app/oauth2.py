@@ -7,9 +7,11 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 
-from app.database import get_db, DB, NoResultFound
-from app.schemas import TokenData
+from app.cache import make_cache
+from app.database import get_db, AsyncDB, NoResultFound
+from app.schemas import TokenData, UserDisplay
 from app.config import settings
+from app.metrics import timer
 
 SECRET_KEY = settings.jwt_secret_key
 ALGORITHM = settings.jwt_algorithm
@@ -18,6 +20,13 @@ ACCESS_TOKEN_EXPIRE_MINUTES = settings.jwt_access_token_expire_minutes
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Users resolved from tokens, so authenticated requests skip the lookup
+principal_cache = make_cache(
+    "principal",
+    maxsize=settings.principal_cache_size,
+    ttl=settings.principal_cache_ttl,
+)
+
 
 def create_access_token(data: dict):
     """Create a new JWT access token"""
@@ -41,10 +50,16 @@ def verify_access_token(token: str, credentials_exception):
     return token_data
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme), db: DB = Depends(get_db)
-):
+async def get_current_user(
+    token: str = Depends(oauth2_scheme), db: AsyncDB = Depends(get_db)
+) -> UserDisplay:
     """Get the current user from the token"""
+    with timer("auth"):
+        return await _resolve_user(token, db)
+
+
+async def _resolve_user(token: str, db: AsyncDB) -> UserDisplay:
+    """Resolve the user of a token, from the cache or the database"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -52,8 +67,31 @@ def get_current_user(
     )
 
     token_data = verify_access_token(token, credentials_exception)
+    cached = await principal_cache.get(str(token_data.id))
+    if cached is not None:
+        return UserDisplay(**cached)
     try:
-        user = db.find_user(id=token_data.id)
-        return user
+        user = await db.find_user(id=token_data.id)
     except NoResultFound:
         raise credentials_exception
+    principal = UserDisplay.model_validate(user)
+    await principal_cache.set(
+        str(principal.id), principal.model_dump(mode="json")
+    )
+    return principal
+
+
+async def get_admin_user(
+    current_user: UserDisplay = Depends(get_current_user),
+) -> UserDisplay:
+    """Get the current user, who must be an admin"""
+    if current_user.id not in settings.admin_user_ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Admins only"
+        )
+    return current_user
+
+
+async def forget_user(user_id: int):
+    """Drop a user from the principal cache after a change"""
+    await principal_cache.delete(str(user_id))
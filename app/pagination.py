@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Module for keyset (cursor) pagination helpers
+"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values) -> str:
+    """Encode the sort key of the last row of a page as an opaque cursor"""
+    data = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values],
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    """Decode a cursor, converting each value with the matching type"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError
+        return tuple(convert(v) for convert, v in zip(types, values))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+
+
+def created_at_id(cursor: str) -> tuple:
+    """Decode a cursor over (created_at, id)"""
+    return decode_cursor(cursor, datetime.fromisoformat, int)
+
+
+def paginate(query, columns: tuple, after: tuple, limit: int, desc=False):
+    """Order a query by columns and keep the rows after the given key"""
+    if after:
+        key = tuple_(*columns)
+        query = query.filter(key < after if desc else key > after)
+    order = [column.desc() if desc else column.asc() for column in columns]
+    # One extra row tells whether there is a next page
+    return query.order_by(*order).limit(limit + 1)
+
+
+def page(rows: list, limit: int, key) -> tuple:
+    """Split the fetched rows into a page and the cursor of the next one"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
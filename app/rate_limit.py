@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Module for per-client rate limits: token buckets per route
+
+RATE_LIMITS maps route names (the endpoint function names) to a rate in
+requests per second and a burst. Each client gets a bucket per limited
+route, keyed by the user id of its access token, or by its IP address
+without a valid one. A request finding its bucket empty is answered 429
+with Retry-After before it touches the database. Buckets live in memory
+(per worker) or in Redis (shared), following CACHE_BACKEND.
+"""
+import math
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, status
+from prometheus_client import Counter
+
+from app.config import settings
+from app.oauth2 import verify_access_token
+
+RATE_LIMITED = Counter(
+    "rate_limited_requests_total",
+    "Requests answered 429 by a rate limit",
+    ("route",),
+)
+
+# Refill the bucket, take a token if there is one, return the wait
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1e6
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+
+class MemoryBuckets:
+    """Token buckets of one worker, least recently used dropped first"""
+
+    def __init__(self, maxsize: int):
+        """Initialize MemoryBuckets"""
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        """Take a token, or return the seconds until there is one"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker, updated by a Lua script"""
+
+    def __init__(self, name: str, url: str = None):
+        """Initialize RedisBuckets"""
+        from redis import asyncio as aioredis
+
+        self.name = name
+        self.client = aioredis.from_url(url or settings.redis_url)
+        self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        """Take a token, or return the seconds until there is one"""
+        wait = await self._script(
+            keys=[f"{self.name}:{key}"], args=[rate, burst]
+        )
+        return float(wait)
+
+
+def make_buckets(name: str, maxsize: int):
+    """Create token buckets on the backend chosen in the settings"""
+    if settings.cache_backend == "redis":
+        return RedisBuckets(name)
+    if settings.cache_backend == "memory":
+        return MemoryBuckets(maxsize)
+    raise ValueError(f"Unknown cache backend {settings.cache_backend}")
+
+
+buckets = make_buckets("rate_limit", maxsize=settings.rate_limit_clients)
+
+
+def client_key(request: Request) -> str:
+    """User id of the request's access token, or else its client IP"""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return f"user:{verify_access_token(token, ValueError).id}"
+        except ValueError:
+            pass
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+async def rate_limit(request: Request):
+    """Apply the rate limit of the matched route, if it has one"""
+    route = request.scope.get("route")
+    limit = settings.rate_limits.get(getattr(route, "name", None))
+    if limit is None:
+        return
+    rate, burst = limit
+    wait = await buckets.take(
+        f"{route.name}:{client_key(request)}", rate, burst
+    )
+    if wait > 0:
+        RATE_LIMITED.labels(route.name).inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, retry later",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Module for the read-through cache of serialized responses
+
+Entries are grouped under tags such as "post:12". Each tag has a version
+stored in the cache backend and part of every entry key; invalidating a
+tag replaces its version, which makes all of its entries unreachable at
+once. The version is read before the database, so a response loaded
+while a write invalidates the tag is stored under the old version and is
+never served.
+"""
+import asyncio
+import uuid
+
+from fastapi import Response
+
+from app.cache import make_cache
+from app.config import settings
+
+
+def post_tag(post_id: int) -> str:
+    """Tag of the cached responses of a post"""
+    return f"post:{post_id}"
+
+
+def comments_tag(post_id: int) -> str:
+    """Tag of the cached comment pages of a post"""
+    return f"comments:{post_id}"
+
+
+class ResponseCache:
+    """Read-through cache of serialized responses, with single-flight"""
+
+    def __init__(self, backend):
+        """Initialize ResponseCache"""
+        self.backend = backend
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def _version(self, tag: str) -> str:
+        """Current version of a tag"""
+        version = await self.backend.get(f"tag:{tag}")
+        if version is None:
+            version = uuid.uuid4().hex
+            # Outlive the entries: a lost version only causes misses
+            await self.backend.set(
+                f"tag:{tag}", version, ttl=self.backend.ttl * 10
+            )
+        return version
+
+    async def invalidate(self, *tags: str):
+        """Make every entry of the tags unreachable"""
+        for tag in tags:
+            await self.backend.delete(f"tag:{tag}")
+
+    async def get_or_load(self, tag: str, key: str, load) -> Response:
+        """Serve an entry from the cache, loading it once on a miss
+
+        load is a coroutine function returning (body, headers).
+        """
+        full_key = f"{tag}:{await self._version(tag)}:{key}"
+        entry = await self.backend.get(full_key)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            pending = self._inflight.get(full_key)
+            if pending is not None:
+                self.coalesced += 1
+                entry = await asyncio.shield(pending)
+            else:
+                entry = await self._load(full_key, load)
+        return Response(
+            content=entry["body"],
+            media_type="application/json",
+            headers=entry["headers"],
+        )
+
+    async def _load(self, full_key: str, load) -> dict:
+        """Load an entry and share it with concurrent misses"""
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[full_key] = future
+        try:
+            body, headers = await load()
+            entry = {"body": body, "headers": headers}
+            await self.backend.set(full_key, entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters re-raise it; do not warn about it when there are none
+            future.exception()
+            raise
+        finally:
+            del self._inflight[full_key]
+
+    def stats(self) -> dict:
+        """Counters of the cache, tag lookups excluded"""
+        return {
+            "backend": self.backend.stats()["backend"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+response_cache = ResponseCache(
+    make_cache(
+        "response",
+        maxsize=settings.response_cache_size,
+        ttl=settings.response_cache_ttl,
+    )
+)
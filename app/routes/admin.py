@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Module for admin routes
+"""
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+
+from app.consistency import pins
+from app.database import (
+    get_db,
+    statement_cache_stats,
+    AsyncDB,
+    NoResultFound,
+)
+from app.export import export_response
+from app.hot_feed import hot_feed
+from app.metrics import TimedRoute, compiled_cache_stats
+from app.oauth2 import get_admin_user, principal_cache
+from app.response_cache import response_cache
+from app.slow_queries import slow_query_log
+from app.vote_coalescer import vote_coalescer
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"],
+    route_class=TimedRoute,
+    dependencies=[Depends(get_admin_user)],
+)
+
+
+@router.get("/caches")
+async def get_cache_stats():
+    """Counters and hit ratio of every cache"""
+    stats = {
+        "principal": principal_cache.stats(),
+        "response": response_cache.stats(),
+        "replica_pins": pins.stats(),
+        "statements": statement_cache_stats(),
+        "compiled": compiled_cache_stats(),
+    }
+    for counters in stats.values():
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_ratio"] = counters["hits"] / lookups if lookups else None
+    return stats
+
+
+@router.get("/hot-feed")
+async def get_hot_feed_stats():
+    """Size of the hot feed and the age of its last rebuild"""
+    return await hot_feed.stats()
+
+
+@router.get("/vote-buffer")
+async def get_vote_buffer_stats():
+    """Batches and votes written by the vote buffer of this worker"""
+    return vote_coalescer.stats()
+
+
+@router.get("/users/{user_id}/export")
+async def export_user(user_id: int, db: AsyncDB = Depends(get_db)):
+    """Everything of a user, streamed as NDJSON"""
+    try:
+        return await export_response(db, user_id)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
+        )
+
+
+@router.get("/slow-queries")
+async def get_slow_queries(
+    limit: int = Query(50, gt=0, description="Number of entries to fetch"),
+):
+    """Statements over the slow-query threshold, newest first"""
+    return slow_query_log.recent(limit)
+
+
+@router.get("/slow-queries.jsonl")
+async def dump_slow_queries():
+    """The whole slow-query log as JSON lines, oldest first"""
+    return StreamingResponse(
+        slow_query_log.jsonl(), media_type="application/x-ndjson"
+    )
+
+
+@router.delete("/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_slow_queries():
+    """Empty the slow-query log"""
+    slow_query_log.clear()
@@ -6,31 +6,42 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.exc import NoResultFound
 
-from app.database import get_db, DB
-from app.utils import verify_password
+from app.database import get_db, AsyncDB
+from app.utils import (
+    verify_password_async,
+    hash_password_async,
+    needs_rehash,
+)
 from app.oauth2 import create_access_token
+from app.metrics import TimedRoute
 
-router = APIRouter(prefix="/auth", tags=["Authentication"])
+router = APIRouter(
+    prefix="/auth", tags=["Authentication"], route_class=TimedRoute
+)
 
 
 @router.post("/login")
-def login(
+async def login(
     user_credentials: OAuth2PasswordRequestForm = Depends(),
-    db: DB = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
 ):
     """
     Authenticate a user and return a JWT token.
     """
     try:
         # Fetch user using the database class
-        user = db.find_user(username=user_credentials.username)
+        user = await db.find_user(username=user_credentials.username)
     except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials"
         )
 
-    # Verify password
-    if not verify_password(user_credentials.password, user.hashed_password):
+    # Verify password, in the bcrypt pool, with the database let go
+    async with db.idle():
+        valid = await verify_password_async(
+            user_credentials.password, user.hashed_password
+        )
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials"
         )
@@ -38,4 +49,14 @@ def login(
     # Create JWT token
     access_token = create_access_token(data={"user_id": user.id})
 
+    # Upgrade hashes made with an outdated cost while we know the password
+    if needs_rehash(user.hashed_password):
+        async with db.idle():
+            hashed_password = await hash_password_async(
+                user_credentials.password
+            )
+        await db.update_user_password(
+            user_id=user.id, hashed_password=hashed_password
+        )
+
     return {"access_token": access_token, "token_type": "bearer"}
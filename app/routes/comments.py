@@ -2,62 +2,281 @@
 """
 Module for comments route
 """
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import (
+    APIRouter,
+    Body,
+    HTTPException,
+    Depends,
+    status,
+    Request,
+    Response,
+    Query,
+)
+import orjson
+from pydantic import TypeAdapter
 
-from app.schemas import CommentCreate, CommentDisplay
-from app.models import Comment, User, Post
-from app.database import get_db, DB, NoResultFound
+from app.schemas import (
+    BatchResult,
+    CommentCreate,
+    CommentDisplay,
+    CommentThread,
+    UserDisplay,
+)
+from app.database import get_db, AsyncDB, NoResultFound
 from app.oauth2 import get_current_user
+from app.metrics import TimedRoute
+from app.config import settings
+from app import conditional, fast_json, loaders
+from app.pagination import NEXT_CURSOR_HEADER
+from app.response_cache import response_cache, comments_tag
+
+router = APIRouter(
+    prefix="/comments", tags=["Comments"], route_class=TimedRoute
+)
 
-router = APIRouter(prefix="/comments", tags=["Comments"])
+comment_list = TypeAdapter(list[CommentDisplay])
+thread_list = TypeAdapter(list[CommentThread])
+
+# Status and detail of each reason a comment is not created
+COMMENT_ERRORS = {
+    "no_post": (status.HTTP_404_NOT_FOUND, "Post not found"),
+    "no_parent": (status.HTTP_404_NOT_FOUND, "Parent comment not found"),
+    "other_post": (
+        status.HTTP_400_BAD_REQUEST,
+        "Parent comment is on another post",
+    ),
+    "too_deep": (
+        status.HTTP_400_BAD_REQUEST,
+        f"Replies nest at most {settings.comment_max_depth} deep",
+    ),
+}
 
 
 @router.post(
     "/", response_model=CommentDisplay, status_code=status.HTTP_201_CREATED
 )
-def create_comment(
+async def create_comment(
     comment: CommentCreate,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
-    """Create a comment for a post"""
+    """Create a comment for a post, or a reply to a comment with parent_id"""
     try:
-        post = db.find_post_with_id(id=comment.post_id)
+        await db.find_post_with_id(id=comment.post_id)
     except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Post not found"
         )
 
-    new_comment = Comment(
-        content=comment.content,
-        post_id=comment.post_id,
+    try:
+        new_comment = await db.create_comment(
+            content=comment.content,
+            post_id=comment.post_id,
+            owner_id=current_user.id,
+            parent_id=comment.parent_id,
+        )
+    except ValueError as e:
+        status_code, detail = COMMENT_ERRORS[str(e)]
+        raise HTTPException(status_code=status_code, detail=detail)
+    await response_cache.invalidate(comments_tag(comment.post_id))
+    return new_comment
+
+
+@router.post(
+    "/batch",
+    response_model=list[BatchResult],
+    response_model_exclude_none=True,
+    status_code=status.HTTP_207_MULTI_STATUS,
+)
+async def create_comments(
+    comments: list[CommentCreate] = Body(
+        ..., min_length=1, max_length=settings.batch_max_items
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """Create many comments in one transaction, skipping misplaced ones"""
+    outcomes = await db.create_comments(
+        [comment.model_dump() for comment in comments],
         owner_id=current_user.id,
     )
-    db._session.add(new_comment)
-    db._session.commit()
-    db._session.refresh(new_comment)
-    return new_comment
+    created = [isinstance(outcome, int) for outcome in outcomes]
+    await response_cache.invalidate(
+        *{comments_tag(c.post_id) for c, ok in zip(comments, created) if ok}
+    )
+    return [
+        {"status": status.HTTP_201_CREATED, "id": outcome}
+        if ok
+        else dict(zip(("status", "detail"), COMMENT_ERRORS[outcome]))
+        for outcome, ok in zip(outcomes, created)
+    ]
 
 
 @router.get("/{post_id}", response_model=list[CommentDisplay])
-def get_comments_for_post(post_id: int, db: DB = Depends(get_db)):
-    """Retrieve all comments for a specific post"""
-    comments = db._session.query(Comment).filter(Comment.post_id == post_id).all()
-    return comments
+async def get_comments_for_post(
+    post_id: int,
+    request: Request,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of comments to fetch"
+    ),
+    db: AsyncDB = Depends(get_db),
+):
+    """Retrieve the comments of a specific post, oldest first
+
+    Answers 304 when no comment of the post changed since the client's copy.
+    """
+    count, last_id, last_updated_at = await db.get_comments_version(
+        post_id=post_id
+    )
+    # No Last-Modified: deletes take the newest updated_at no further
+    headers = conditional.validators(
+        conditional.etag(post_id, count, last_id, last_updated_at)
+    )
+    if conditional.not_modified(request, headers["ETag"]):
+        return conditional.not_modified_response(headers)
+    fast = fast_json.enabled("get_comments_for_post")
+    columns = loaders.COMMENT_DISPLAY_COLUMNS
+
+    async def load():
+        # A lagging replica would cache what an invalidation just dropped
+        db.use_primary()
+        try:
+            comments, next_cursor = await db.get_comments(
+                post_id=post_id,
+                limit=limit,
+                cursor=cursor,
+                options=loaders.COMMENT_DISPLAY,
+                columns=columns if fast else None,
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+            )
+        headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+        if fast:
+            body = fast_json.dumps(comments, fast_json.fields(columns))
+        else:
+            body = comment_list.dump_json(comments)
+        return body.decode("utf-8"), headers
+
+    # Keyed by the ETag: loaded after the version was read, a page is
+    # never older than the ETag it is served with
+    response = await response_cache.get_or_load(
+        comments_tag(post_id), f"{headers['ETag']}:{cursor}:{limit}", load
+    )
+    response.headers.update(headers)
+    return response
+
+
+@router.get("/{post_id}/threads", response_model=list[CommentThread])
+async def get_comment_threads(
+    post_id: int,
+    request: Request,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of top-level comments to fetch"
+    ),
+    replies: int = Query(
+        3, ge=0, le=20, description="Number of replies to fetch with each"
+    ),
+    db: AsyncDB = Depends(get_db),
+):
+    """Retrieve the top-level comments of a post, oldest first
+
+    Each comes with its first replies, depth first, and replies_cursor
+    for GET /comments/{comment_id}/replies when it has more. Answers 304
+    when no comment of the post changed since the client's copy.
+    """
+    count, last_id, last_updated_at = await db.get_comments_version(
+        post_id=post_id
+    )
+    # No Last-Modified: deletes take the newest updated_at no further
+    headers = conditional.validators(
+        conditional.etag(post_id, count, last_id, last_updated_at)
+    )
+    if conditional.not_modified(request, headers["ETag"]):
+        return conditional.not_modified_response(headers)
+    fast = fast_json.enabled("get_comment_threads")
+
+    async def load():
+        # A lagging replica would cache what an invalidation just dropped
+        db.use_primary()
+        try:
+            threads, next_cursor = await db.get_comment_threads(
+                post_id=post_id,
+                columns=loaders.COMMENT_DISPLAY_COLUMNS,
+                limit=limit,
+                cursor=cursor,
+                replies=replies,
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+            )
+        headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+        if fast:
+            body = orjson.dumps(threads, option=fast_json.OPTIONS)
+        else:
+            body = thread_list.dump_json(thread_list.validate_python(threads))
+        return body.decode("utf-8"), headers
+
+    # Keyed by the ETag, as the comments of a post
+    response = await response_cache.get_or_load(
+        comments_tag(post_id),
+        f"threads:{headers['ETag']}:{cursor}:{limit}:{replies}",
+        load,
+    )
+    response.headers.update(headers)
+    return response
+
+
+@router.get("/{comment_id}/replies", response_model=list[CommentDisplay])
+async def get_replies(
+    comment_id: int,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of replies to fetch"
+    ),
+    db: AsyncDB = Depends(get_db),
+):
+    """Retrieve the replies under a comment, however deep, depth first"""
+    columns = loaders.COMMENT_DISPLAY_COLUMNS
+    try:
+        rows, next_cursor = await db.get_replies(
+            comment_id=comment_id, columns=columns, limit=limit, cursor=cursor
+        )
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if fast_json.enabled("get_replies"):
+        return fast_json.rows_response(rows, fast_json.fields(columns), headers)
+    return Response(
+        comment_list.dump_json(
+            comment_list.validate_python(rows, from_attributes=True)
+        ),
+        media_type="application/json",
+        headers=headers,
+    )
 
 
 @router.put("/{comment_id}", response_model=CommentDisplay)
-def update_comment(
+async def update_comment(
     comment_id: int,
     updated_comment: CommentCreate,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Update a comment"""
-    comment = (
-        db._session.query(Comment).filter(Comment.id == comment_id).first()
-    )
-    if not comment:
+    try:
+        comment = await db.find_comment(id=comment_id)
+    except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found"
         )
@@ -68,21 +287,23 @@ def update_comment(
             detail="Not authorized to update this comment",
         )
 
-    comment.content = updated_comment.content
-    db._session.commit()
-    db._session.refresh(comment)
+    comment = await db.update_comment(
+        comment_id=comment_id, content=updated_comment.content
+    )
+    await response_cache.invalidate(comments_tag(comment.post_id))
     return comment
 
 
 @router.delete("/{comment_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_comment(
+async def delete_comment(
     comment_id: int,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Delete a comment"""
-    comment = db._session.query(Comment).filter(Comment.id == comment_id).first()
-    if not comment:
+    try:
+        comment = await db.find_comment(id=comment_id)
+    except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found"
         )
@@ -93,6 +314,7 @@ def delete_comment(
             detail="Not authorized to delete this comment",
         )
 
-    db._session.delete(comment)
-    db._session.commit()
+    post_id = comment.post_id
+    await db.delete_comment(comment_id=comment_id)
+    await response_cache.invalidate(comments_tag(post_id))
     return {"detail": "Comment deleted successfully"}
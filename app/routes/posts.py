@@ -2,76 +2,244 @@
 """
 Module for posts route
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Response, Query
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    HTTPException,
+    status,
+    Request,
+    Response,
+    Query,
+)
 from sqlalchemy.exc import NoResultFound
 from typing import List
 
-from app.schemas import PostCreate, PostDisplay, PostDisplayAll
-from app.database import get_db, DB
-from app.models import User
+from app.schemas import (
+    BatchResult,
+    PostCreate,
+    PostDisplay,
+    PostDisplayAll,
+    PostSearchResult,
+    UserDisplay,
+)
+from app.database import get_db, AsyncDB
+from app import conditional, fast_json, loaders
+from app.hot_feed import hot_feed
+from app.pagination import NEXT_CURSOR_HEADER, decode_cursor, page
 from app.oauth2 import get_current_user
+from app.metrics import TimedRoute
+from app.config import settings
+from app.response_cache import response_cache, post_tag, comments_tag
 
 
-router = APIRouter(prefix="/posts", tags=["Posts"])
+router = APIRouter(prefix="/posts", tags=["Posts"], route_class=TimedRoute)
 
 
-@router.get("/", response_model=List[PostDisplay])
-def get_posts(
-    skip: int = Query(0, ge=0, description="Number of posts to skip"),
-    limit: int = Query(10, gt=0, description="Number of posts to fetch"),
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+@router.get(
+    "/",
+    response_model=List[PostSearchResult],
+    response_model_exclude_none=True,
+)
+async def get_posts(
+    response: Response,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of posts to fetch"
+    ),
+    search: str = Query(None, min_length=1, description="Full-text search"),
+    highlight: bool = Query(
+        False, description="Add highlighted snippets to search results"
+    ),
+    fields: str = Query(
+        None,
+        description="Comma-separated fields to return, such as id,title",
+    ),
+    excerpt: int = Query(
+        None, gt=0, description="Cut content to its first N characters"
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
-    """View all posts"""
-    posts = db.get_posts(skip, limit)
+    """View all posts newest first, or the best matches of a search
+
+    With fields or excerpt, only the requested data is selected, and the
+    posts are returned as-is rather than through the response model.
+    """
+    narrowed = fields is not None or excerpt is not None
+    fast = narrowed or fast_json.enabled("get_posts")
+    try:
+        columns = loaders.post_columns(fields, excerpt)
+        if search:
+            posts, next_cursor = await db.search_posts(
+                search,
+                limit=limit,
+                cursor=cursor,
+                highlight=highlight,
+                columns=columns,
+            )
+        else:
+            posts, next_cursor = await db.get_posts(
+                limit=limit,
+                cursor=cursor,
+                options=loaders.POST_DISPLAY,
+                columns=columns if fast else None,
+            )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if fast:
+        names = fast_json.fields(columns)
+        if search:
+            names += ("rank", "snippet") if highlight else ("rank",)
+        return fast_json.rows_response(posts, names, headers)
+    response.headers.update(headers)
     return posts
 
+
+@router.get("/hot", response_model=List[PostDisplay])
+async def get_hot_posts(
+    response: Response,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of posts to fetch"
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """View the hot feed: the most voted posts, decayed by age
+
+    The ranking comes from the precomputed feed; only the posts of the
+    page are read from the database.
+    """
+    try:
+        after = decode_cursor(cursor, float, int) if cursor else None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    ranked, next_cursor = page(
+        await hot_feed.page(after, limit + 1), limit, lambda pair: pair
+    )
+    fast = fast_json.enabled("get_hot_posts")
+    columns = loaders.POST_DISPLAY_COLUMNS
+    posts = await db.get_posts_by_ids(
+        post_ids=[post_id for _, post_id in ranked],
+        options=loaders.POST_DISPLAY,
+        columns=columns if fast else None,
+    )
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if fast:
+        return fast_json.rows_response(
+            posts, fast_json.fields(columns), headers
+        )
+    response.headers.update(headers)
+    return posts
+
+
 @router.get("/{post_id}", response_model=PostDisplayAll)
-def get_posts(
+async def get_post(
     post_id: int,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    request: Request,
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
-    """View all posts"""
+    """View a post, or 304 when the client's copy is current"""
     try:
-        post = db.find_post_with_id(id=post_id)
-        return post
+        version = await db.get_post_version(post_id=post_id)
     except NoResultFound:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail=f"Post doesn't exist"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Post doesn't exist",
         )
+    # Votes change vote_count but not updated_at, hence both in the ETag,
+    # and no Last-Modified, which would stay put across votes
+    headers = conditional.validators(conditional.etag(*version))
+    if conditional.not_modified(request, headers["ETag"]):
+        return conditional.not_modified_response(headers)
+
+    async def load():
+        # A lagging replica would cache what an invalidation just dropped
+        db.use_primary()
+        try:
+            post = await db.find_post_with_id(
+                id=post_id, options=loaders.POST_DISPLAY_ALL
+            )
+        except NoResultFound:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Post doesn't exist",
+            )
+        return PostDisplayAll.model_validate(post).model_dump_json(), {}
+
+    # Keyed by the ETag: loaded after the version was read, a body is
+    # never older than the ETag it is served with
+    response = await response_cache.get_or_load(
+        post_tag(post_id), headers["ETag"], load
+    )
+    response.headers.update(headers)
+    return response
 
 
 @router.post("/", response_model=PostDisplayAll)
-def create_post(
+async def create_post(
     post: PostCreate,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Create a new post"""
     data = post.model_dump()
     data["owner_id"] = current_user.id
-    new_post = db.create_post(**data)
+    new_post = await db.create_post(
+        **data, options=loaders.POST_DISPLAY_ALL
+    )
+    await hot_feed.mark_dirty(new_post.id)
     return new_post
 
 
+@router.post(
+    "/batch",
+    response_model=List[BatchResult],
+    response_model_exclude_none=True,
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_posts(
+    posts: List[PostCreate] = Body(
+        ..., min_length=1, max_length=settings.batch_max_items
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """Create many posts in one transaction"""
+    ids = await db.create_posts(
+        [post.model_dump() for post in posts], owner_id=current_user.id
+    )
+    await hot_feed.mark_dirty(*ids)
+    return [{"status": status.HTTP_201_CREATED, "id": id} for id in ids]
+
+
 @router.put("/{id}", response_model=PostDisplayAll)
-def update_post(
+async def update_post(
     id: int,
     post: PostCreate,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Update an existing post"""
     try:
-        old_post = db.find_post_with_id(id=id)
+        old_post = await db.find_post_with_id(id=id)
         if old_post.owner_id != current_user.id:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You are not allowed to update this post",
             )
         data = post.model_dump()
-        new_post = db.update_post(post_id=id, **data)
+        new_post = await db.update_post(
+            post_id=id, options=loaders.POST_DISPLAY_ALL, **data
+        )
+        await response_cache.invalidate(post_tag(id))
         return new_post
     except NoResultFound:
         raise HTTPException(
@@ -80,21 +248,24 @@ def update_post(
 
 
 @router.delete("/{post_id}", status_code=status.HTTP_200_OK)
-def delete_post(
+async def delete_post(
     post_id: int,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Delete a post"""
     try:
-        post = db.find_post_with_id(id=post_id)
+        post = await db.find_post_with_id(id=post_id)
         if current_user.id != post.owner_id:
             raise HTTPException(
                 status.HTTP_403_FORBIDDEN,
                 detail="You are not allowed to modify/delete this post",
             )
-        db._session.delete(post)
-        db._session.commit()
+        await db.delete_post(post_id=post_id)
+        await response_cache.invalidate(
+            post_tag(post_id), comments_tag(post_id)
+        )
+        await hot_feed.mark_dirty(post_id)
         return {"detail": "Post deleted successfully"}
     except NoResultFound:
         raise HTTPException(
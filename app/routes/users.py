@@ -2,35 +2,84 @@
 """
 Module for users route
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Response
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Query
 from typing import List, Any
 
-from app.database import get_db, DB, NoResultFound
+from app.database import get_db, AsyncDB, NoResultFound
 from app.schemas import UserCreate, UserDisplay, UserPassword, UserDisplayWithPosts
-from app.oauth2 import get_current_user
-from app.models import User
+from app.oauth2 import get_current_user, forget_user
+from app.export import export_response
+from app.hot_feed import hot_feed
+from app.metrics import TimedRoute
+from app.utils import hash_password_async
+from app import fast_json, loaders
+from app.pagination import NEXT_CURSOR_HEADER
+from app.response_cache import response_cache, post_tag, comments_tag
 
-router = APIRouter(prefix="/users", tags=["Users"])
+router = APIRouter(prefix="/users", tags=["Users"], route_class=TimedRoute)
 
 
 @router.get("/", response_model=List[UserDisplay])
-def get_all_users(db: DB = Depends(get_db)):
-    users = db.get_all_users(limit=10)
+async def get_all_users(
+    response: Response,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of users to fetch"
+    ),
+    db: AsyncDB = Depends(get_db),
+):
+    fast = fast_json.enabled("get_all_users")
+    columns = loaders.USER_DISPLAY_COLUMNS
+    try:
+        users, next_cursor = await db.get_all_users(
+            limit=limit,
+            cursor=cursor,
+            options=loaders.USER_DISPLAY,
+            columns=columns if fast else None,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if fast:
+        return fast_json.rows_response(
+            users, fast_json.fields(columns), headers
+        )
+    response.headers.update(headers)
     return users
 
 
 @router.get("/me", response_model=UserDisplayWithPosts)
-def get_one_user(
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+async def get_me(
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
-    return current_user
+    return await db.find_user(
+        id=current_user.id, options=loaders.USER_DISPLAY_WITH_POSTS
+    )
+
+
+@router.get("/me/export")
+async def export_me(
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """Everything of the current user, streamed as NDJSON"""
+    try:
+        return await export_response(db, current_user.id)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User doesn't exist"
+        )
 
 
 @router.get("/{user_id}", response_model=UserDisplay)
-def get_one_user(user_id: int, db: DB = Depends(get_db)):
+async def get_one_user(user_id: int, db: AsyncDB = Depends(get_db)):
     try:
-        user = db.find_user(id=user_id)
+        user = await db.find_user(
+            id=user_id, options=loaders.USER_DISPLAY
+        )
         return user
     except NoResultFound:
         raise HTTPException(
@@ -39,26 +88,42 @@ def get_one_user(user_id: int, db: DB = Depends(get_db)):
 
 
 @router.post("/", response_model=UserDisplay)
-def create_user(new_user: UserCreate, db: DB = Depends(get_db)):
+async def create_user(new_user: UserCreate, db: AsyncDB = Depends(get_db)):
+    taken = HTTPException(
+        status.HTTP_400_BAD_REQUEST,
+        detail="User with email/username already exists",
+    )
+    # Turn duplicates away before they take a slot of the bcrypt pool
+    try:
+        await db.find_user(username=new_user.username, email=new_user.email)
+        raise taken
+    except NoResultFound:
+        pass
     data = new_user.model_dump()
+    async with db.idle():
+        data["hashed_password"] = await hash_password_async(
+            data.pop("password")
+        )
     try:
-        user = db.create_user(**data)
+        user = await db.create_user(**data)
     except ValueError:
-        raise HTTPException(
-            status.HTTP_400_BAD_REQUEST,
-            detail="User with email/username already exists",
-        )
+        raise taken
     return user
 
 
 @router.post("/me")
-def update_user_password(
+async def update_user_password(
     pw: UserPassword,
-    db: DB = Depends(get_db),
-    current_user=Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
+    async with db.idle():
+        hashed_password = await hash_password_async(pw.password)
     try:
-        db.update_user_password(user_id=current_user.id, password=pw.password)
+        await db.update_user_password(
+            user_id=current_user.id, hashed_password=hashed_password
+        )
+        await forget_user(current_user.id)
         return {"message": "Successfully updated user password"}
     except NoResultFound:
         raise HTTPException(
@@ -67,15 +132,18 @@ def update_user_password(
 
 
 @router.delete("/me")
-def delete_user(
-    db: DB = Depends(get_db),
-    current_user=Depends(get_current_user),
+async def delete_user(
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
     """Delete a user"""
     try:
-        user = db.find_user(id=current_user.id)
-        db._session.delete(user)
-        db._session.commit()
+        post_ids = await db.delete_user(user_id=current_user.id)
+        await forget_user(current_user.id)
+        await response_cache.invalidate(
+            *map(post_tag, post_ids), *map(comments_tag, post_ids)
+        )
+        await hot_feed.mark_dirty(*post_ids)
         return Response(content="User deleted successfully", status_code=200)
 
     except NoResultFound:
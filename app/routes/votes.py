@@ -2,54 +2,128 @@
 """
 Module for votes route
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from app.schemas import VoteCreate
-from app.models import User, Vote
-from app.database import get_db, DB
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    HTTPException,
+    status,
+    Response,
+    Query,
+)
+from typing import List
+
+from app.schemas import BatchResult, VoteCreate, VoteDisplay, UserDisplay
+from app.database import get_db, AsyncDB
 from app.oauth2 import get_current_user
+from app.metrics import TimedRoute
+from app.config import settings
+from app import loaders
+from app.pagination import NEXT_CURSOR_HEADER
+from app.hot_feed import hot_feed
+from app.response_cache import response_cache, post_tag
+from app.vote_coalescer import vote_coalescer
 
 router = APIRouter(
     prefix="/votes",
     tags=["Votes"],
+    route_class=TimedRoute,
 )
 
+# Status and message of each outcome of DB.vote and DB.apply_votes
+VOTE_OUTCOMES = {
+    "added": (status.HTTP_201_CREATED, "Vote added successfully"),
+    "removed": (status.HTTP_200_OK, "Vote removed successfully"),
+    "exists": (
+        status.HTTP_400_BAD_REQUEST,
+        "You have already voted for this post",
+    ),
+    "no_vote": (status.HTTP_404_NOT_FOUND, "Vote does not exist"),
+    "no_post": (status.HTTP_404_NOT_FOUND, "Post not found"),
+    "duplicate": (status.HTTP_409_CONFLICT, "Post already in this batch"),
+}
+
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def vote(
+async def vote(
     vote: VoteCreate,
-    db: DB = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
 ):
-    # Check if the post exists
-    post = db.find_post_with_id(id=vote.post_id)
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post not found",
+    """Add (dir 1) or remove (dir 0) the vote of the current user"""
+    if vote_coalescer.enabled:
+        # Give back the connection of the auth lookup, which the buffer
+        # may need to write the batch this request waits for
+        await db.close()
+        outcome = await vote_coalescer.submit(
+            current_user.id, vote.post_id, vote.dir
         )
+    else:
+        outcome = await db.vote(
+            user_id=current_user.id, post_id=vote.post_id, dir=vote.dir
+        )
+    code, detail = VOTE_OUTCOMES[outcome]
+    if code >= status.HTTP_400_BAD_REQUEST:
+        raise HTTPException(status_code=code, detail=detail)
+    await response_cache.invalidate(post_tag(vote.post_id))
+    await hot_feed.mark_dirty(vote.post_id)
+    return {"message": detail}
 
-    # Check if the vote already exists
-    existing_vote = (
-        db._session.query(Vote)
-        .filter(Vote.post_id == vote.post_id, Vote.user_id == current_user.id)
-        .first()
+
+@router.post(
+    "/batch",
+    response_model=List[BatchResult],
+    response_model_exclude_none=True,
+    status_code=status.HTTP_207_MULTI_STATUS,
+)
+async def vote_batch(
+    votes: List[VoteCreate] = Body(
+        ..., min_length=1, max_length=settings.batch_max_items
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """Add or remove many votes in one transaction"""
+    outcomes = await db.apply_votes(
+        votes=[(current_user.id, vote.post_id, vote.dir) for vote in votes],
     )
-    if vote.dir == 1:
-        if existing_vote:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="You have already voted for this post",
-            )
-        new_vote = Vote(post_id=vote.post_id, user_id=current_user.id)
-        db._session.add(new_vote)
-        db._session.commit()
-        return {"message": "Vote added successfully"}
-    else:
-        if not existing_vote:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Vote does not exist",
-            )
-        db._session.delete(existing_vote)
-        db._session.commit()
-        return {"message": "Vote removed successfully"}
+    changed = {
+        vote.post_id
+        for vote, outcome in zip(votes, outcomes)
+        if outcome in ("added", "removed")
+    }
+    await response_cache.invalidate(*map(post_tag, changed))
+    await hot_feed.mark_dirty(*changed)
+    results = []
+    for outcome in outcomes:
+        code, detail = VOTE_OUTCOMES[outcome]
+        results.append({"status": code, "detail": detail})
+    return results
+
+
+@router.get("/{post_id}", response_model=List[VoteDisplay])
+async def get_votes_for_post(
+    post_id: int,
+    response: Response,
+    cursor: str = Query(None, description="Cursor of the page to fetch"),
+    limit: int = Query(
+        10, gt=0, le=100, description="Number of votes to fetch"
+    ),
+    db: AsyncDB = Depends(get_db),
+    current_user: UserDisplay = Depends(get_current_user),
+):
+    """Retrieve the voters of a post, oldest vote first"""
+    try:
+        votes, next_cursor = await db.get_votes(
+            post_id=post_id,
+            limit=limit,
+            cursor=cursor,
+            options=loaders.VOTE_DISPLAY,
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return votes
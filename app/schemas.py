@@ -75,6 +75,14 @@ class PostDisplay(PostDisplayMin):
 
     published: bool
     owner_id: int
+    vote_count: int
+
+
+class PostSearchResult(PostDisplay):
+    """Schema for displaying a post found by a search"""
+
+    rank: float | None = None
+    snippet: str | None = None
 
 
 class PostDisplayAll(PostDisplay):
@@ -83,7 +91,6 @@ class PostDisplayAll(PostDisplay):
     created_at: datetime
     updated_at: datetime
     owner: UserDisplay
-    votes: List[VoteDisplay]
 
 
 # Comment Schemas
@@ -92,6 +99,8 @@ class CommentCreate(BaseModel):
 
     content: str
     post_id: int
+    # The comment replied to, or none for a top-level comment
+    parent_id: int | None = None
 
     class Config:
         from_attributes = True
@@ -102,10 +111,20 @@ class CommentDisplay(CommentCreate):
 
     id: int
     owner_id: int
+    depth: int = 0
+    reply_count: int = 0
     created_at: datetime
     updated_at: datetime
 
 
+class CommentThread(CommentDisplay):
+    """Schema for displaying a top-level comment and its first replies"""
+
+    replies: List[CommentDisplay]
+    # Cursor of GET /comments/{id}/replies past these, if there are more
+    replies_cursor: str | None = None
+
+
 # Token Schema
 class TokenData(BaseModel):
     """Schema for the token payload"""
@@ -117,3 +136,12 @@ class UserDisplayWithPosts(UserDisplay):
     """Schema for displaying a user and their posts"""
 
     posts: List[PostDisplayMin]
+
+
+# Batch Schemas
+class BatchResult(BaseModel):
+    """Schema for the outcome of one item of a batch write"""
+
+    status: int
+    id: int | None = None
+    detail: str | None = None
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Module for the slow-query log
+
+Engine events time every statement. Those over SLOW_QUERY_MS go into a
+bounded ring buffer with their redacted parameters and the route that
+issued them. A sample of them is explained on a background thread and
+the plan is added to the entry when it is ready. Plain SELECTs are re-run
+under EXPLAIN (ANALYZE, BUFFERS), in a transaction that is rolled back;
+writes and locking reads only get a plain EXPLAIN, since running them
+again would take row locks, fire triggers and consume sequence values.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+from app.config import settings
+from app.metrics import current_route
+
+REDACTED = "<redacted>"
+# Bind names whose values never leave the process
+SECRET_NAME = re.compile(r"password|secret|token", re.IGNORECASE)
+# bcrypt hashes, whatever the bind is named
+SECRET_VALUE = re.compile(r"^\$2[aby]?\$\d\d\$")
+MAX_VALUE_LENGTH = 200
+MAX_PARAM_SETS = 5
+# Plans waiting for the EXPLAIN thread beyond which samples are dropped
+MAX_PENDING_EXPLAINS = 8
+EXPLAINABLE = ("select", "insert", "update", "delete", "with")
+# Statements EXPLAIN ANALYZE may run again: reads that take no row locks
+ANALYZABLE = "select"
+ROW_LOCK = re.compile(
+    r"\bFOR\s+(UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b",
+    re.IGNORECASE,
+)
+
+
+def _redact_value(name: str, value):
+    """A JSON-friendly parameter value, without secrets"""
+    if SECRET_NAME.search(name):
+        return REDACTED
+    if isinstance(value, str):
+        if SECRET_VALUE.match(value):
+            return REDACTED
+        if len(value) > MAX_VALUE_LENGTH:
+            return value[:MAX_VALUE_LENGTH] + "..."
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return repr(value)[:MAX_VALUE_LENGTH]
+
+
+def redact(context, parameters) -> list:
+    """The parameter sets of a statement, redacted"""
+    compiled = getattr(context, "compiled_parameters", None)
+    if compiled:
+        # Named by bind, whatever the driver's paramstyle
+        sets = compiled
+    elif isinstance(parameters, dict):
+        sets = [parameters]
+    elif (
+        isinstance(parameters, (list, tuple))
+        and parameters
+        and isinstance(parameters[0], (dict, list, tuple))
+    ):
+        sets = parameters
+    else:
+        sets = [parameters or ()]
+    redacted = []
+    for params in sets[:MAX_PARAM_SETS]:
+        if isinstance(params, dict):
+            redacted.append(
+                {k: _redact_value(k, v) for k, v in params.items()}
+            )
+        else:
+            redacted.append([_redact_value("", v) for v in params])
+    return redacted
+
+
+def to_pyformat(statement: str, parameters) -> tuple:
+    """Rewrite an asyncpg ($1) statement for the sync psycopg2 engine"""
+    statement = statement.replace("%", "%%")
+    statement = re.sub(r"\$(\d+)", r"%(p\1)s", statement)
+    return statement, {f"p{i}": v for i, v in enumerate(parameters, 1)}
+
+
+def analyzable(statement: str) -> bool:
+    """Whether EXPLAIN ANALYZE may run a statement again: a lock-free read"""
+    if not statement.lstrip().lower().startswith(ANALYZABLE):
+        return False
+    return not ROW_LOCK.search(statement)
+
+
+class SlowQueryLog:
+    """Ring buffer of the slow statements of this process"""
+
+    def __init__(
+        self, maxsize: int, threshold_ms: float, explain_rate: float
+    ):
+        """Initialize SlowQueryLog"""
+        self.entries = deque(maxlen=maxsize)
+        self.threshold = threshold_ms / 1000
+        self.explain_rate = explain_rate
+        self._ids = itertools.count(1)
+        self._explainer = None
+        self._explain_engines = {}
+        self._pending = 0
+        # Guards _pending and _explainer across the request threads
+        self._lock = threading.Lock()
+        # Set on the EXPLAIN thread so its own statements are not logged
+        self._local = threading.local()
+
+    def attach(self, engine, explain_engine=None):
+        """Time the statements of a sync engine (or an async sync_engine)
+
+        explain_engine runs the EXPLAINs, the engine itself by default;
+        it must be a sync engine.
+        """
+        if self.threshold <= 0:
+            return
+        if event.contains(engine, "after_cursor_execute", self._after):
+            return
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        self._explain_engines[engine] = explain_engine or engine
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, many):
+        """Note when a statement starts"""
+        context._slow_query_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        """Log the statement when it was slow"""
+        elapsed = time.perf_counter() - context._slow_query_start
+        if elapsed < self.threshold:
+            return
+        if getattr(self._local, "explaining", False):
+            return
+        entry = {
+            "id": next(self._ids),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(elapsed * 1000, 2),
+            "route": current_route(),
+            "statement": statement,
+            "params": redact(context, parameters),
+            "executemany": many,
+            "plan": None,
+        }
+        self.entries.append(entry)
+        if (
+            many
+            or not statement.lstrip().lower().startswith(EXPLAINABLE)
+            or random.random() >= self.explain_rate
+        ):
+            return
+        with self._lock:
+            if self._pending >= MAX_PENDING_EXPLAINS:
+                return
+            self._pending += 1
+            explainer = self._get_explainer()
+        if context.dialect.paramstyle == "numeric_dollar":
+            statement, parameters = to_pyformat(statement, parameters)
+        entry["plan"] = "pending"
+        entry["analyzed"] = analyzable(statement)
+        explainer.submit(
+            self._explain,
+            entry,
+            self._explain_engines[conn.engine],
+            statement,
+            parameters,
+        )
+
+    def _get_explainer(self) -> ThreadPoolExecutor:
+        """The single thread running EXPLAINs; call with _lock held"""
+        if self._explainer is None:
+            self._explainer = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="slow-query-explain"
+            )
+        return self._explainer
+
+    def _explain(self, entry: dict, engine, statement: str, parameters):
+        """EXPLAIN a statement, running it only when it is analyzable"""
+        self._local.explaining = True
+        explain = (
+            "EXPLAIN (ANALYZE, BUFFERS)" if entry["analyzed"] else "EXPLAIN"
+        )
+        try:
+            with engine.connect() as connection:
+                # Closing the connection rolls back the transaction
+                connection.exec_driver_sql(
+                    "SET LOCAL statement_timeout = "
+                    f"{int(settings.slow_query_explain_timeout_ms)}"
+                )
+                rows = connection.exec_driver_sql(
+                    f"{explain} {statement}", parameters or None
+                )
+                entry["plan"] = "\n".join(row[0] for row in rows)
+        except Exception as e:
+            entry["plan"] = None
+            entry["explain_error"] = str(e).splitlines()[0]
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def recent(self, limit: int = None) -> list:
+        """The logged statements, newest first"""
+        entries = list(reversed(self.entries))
+        return entries[:limit] if limit else entries
+
+    def jsonl(self):
+        """The logged statements as JSON lines, oldest first"""
+        for entry in list(self.entries):
+            yield json.dumps(entry) + "\n"
+
+    def clear(self):
+        """Forget the logged statements"""
+        self.entries.clear()
+
+    def shutdown(self):
+        """Stop the EXPLAIN thread"""
+        with self._lock:
+            explainer, self._explainer = self._explainer, None
+        if explainer is not None:
+            explainer.shutdown(wait=False, cancel_futures=True)
+
+
+slow_query_log = SlowQueryLog(
+    maxsize=settings.slow_query_log_size,
+    threshold_ms=settings.slow_query_ms,
+    explain_rate=settings.slow_query_explain_rate,
+)
@@ -2,18 +2,91 @@
 """
 Module for utility functions
 """
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 from bcrypt import hashpw, gensalt, checkpw
 
+from app.config import settings
+from app.metrics import timer
+
+_password_pool = None
+_pending = 0
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password operations are already queued"""
+
 
-def hash_password(password: str) -> str:
+def hash_password(password: str, rounds: int = None) -> str:
     """Hash a password"""
     if not password:
         raise ValueError("A password must be provided")
     encoded = password.encode("utf-8")
-    hashed_password = hashpw(encoded, gensalt(12))
+    hashed_password = hashpw(encoded, gensalt(rounds or settings.bcrypt_rounds))
     return hashed_password.decode("utf-8")
 
 
 def verify_password(password: str, hashed_password: str) -> bool:
     """Verify a hashed password"""
     return checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether a hash was made with another cost than the configured one"""
+    # $2b$<cost>$<salt and hash>
+    return int(hashed_password.split("$")[2]) != settings.bcrypt_rounds
+
+
+def get_password_pool() -> ProcessPoolExecutor:
+    """Get the process pool dedicated to bcrypt"""
+    global _password_pool
+    if _password_pool is None:
+        # Spawned, not forked: the worker already runs threads that may
+        # hold locks, and a fork would inherit its pooled sockets
+        _password_pool = ProcessPoolExecutor(
+            settings.bcrypt_pool_size,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _password_pool
+
+
+def shutdown_password_pool():
+    """Stop the bcrypt processes"""
+    global _password_pool
+    if _password_pool is not None:
+        _password_pool.shutdown(cancel_futures=True)
+    _password_pool = None
+
+
+async def _run_in_password_pool(func, *args):
+    """Run a bcrypt call in the pool, failing fast when it is saturated"""
+    global _pending
+    if _pending >= settings.bcrypt_max_queue:
+        raise PasswordPoolBusy
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        with timer("password"):
+            return await loop.run_in_executor(
+                get_password_pool(), func, *args
+            )
+    finally:
+        _pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password in the bcrypt pool"""
+    if not password:
+        raise ValueError("A password must be provided")
+    return await _run_in_password_pool(
+        hash_password, password, settings.bcrypt_rounds
+    )
+
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    """Verify a hashed password in the bcrypt pool"""
+    return await _run_in_password_pool(
+        verify_password, password, hashed_password
+    )
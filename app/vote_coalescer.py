@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Module for the coalescing of single votes into batched writes
+
+With VOTE_COALESCE_MS set, POST /votes does not write its vote itself: it
+queues it in the buffer of its worker and waits. The buffer is written at
+most every VOTE_COALESCE_MS, or as soon as it holds BATCH_MAX_ITEMS votes,
+with DB.apply_votes: one transaction and one vote_count update per post
+for the whole batch, however many votes a viral post received meanwhile.
+"""
+import asyncio
+import contextvars
+
+from app.config import settings
+from app.database import open_db
+
+
+class VoteCoalescer:
+    """Per-worker buffer of votes, written in batches by one task"""
+
+    def __init__(self, window_ms: float, max_batch: int):
+        """Initialize VoteCoalescer"""
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending = []
+        self._task = None
+        self.batches = 0
+        self.votes = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether votes go through the buffer"""
+        return self.window > 0
+
+    async def submit(self, user_id: int, post_id: int, dir: int) -> str:
+        """Queue a vote, return its outcome once its batch is written"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((user_id, post_id, dir), future))
+        if self._task is None:
+            # Outside the request's context, so the batches do not count
+            # towards the timings of whichever request started the task
+            self._task = asyncio.create_task(
+                self._run(), context=contextvars.Context()
+            )
+        return await future
+
+    async def _run(self):
+        """Write batches until the buffer is empty"""
+        try:
+            while self._pending:
+                if len(self._pending) < self.max_batch:
+                    await asyncio.sleep(self.window)
+                await self._write(self._take())
+        finally:
+            self._task = None
+
+    def _take(self) -> list:
+        """Next batch, holding each (user, post) pair at most once
+
+        A second vote of a user on a post waits for the next batch, so the
+        votes of a pair are applied in the order they came in.
+        """
+        batch, rest, pairs = [], [], set()
+        for item in self._pending:
+            (user_id, post_id, _), _ = item
+            if len(batch) < self.max_batch and (user_id, post_id) not in pairs:
+                pairs.add((user_id, post_id))
+                batch.append(item)
+            else:
+                rest.append(item)
+        self._pending = rest
+        return batch
+
+    async def _write(self, batch: list):
+        """Apply a batch and resolve the futures of its votes"""
+        db = open_db()
+        try:
+            outcomes = await db.apply_votes(votes=[vote for vote, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            await db.close()
+        self.batches += 1
+        self.votes += len(batch)
+        for (_, future), outcome in zip(batch, outcomes):
+            if not future.done():
+                future.set_result(outcome)
+
+    async def drain(self):
+        """Wait until every queued vote is written"""
+        if self._task is not None:
+            await self._task
+
+    def stats(self) -> dict:
+        """Counters of the buffer"""
+        return {
+            "enabled": self.enabled,
+            "batches": self.batches,
+            "votes": self.votes,
+            "pending": len(self._pending),
+        }
+
+
+vote_coalescer = VoteCoalescer(
+    settings.vote_coalesce_ms, settings.batch_max_items
+)
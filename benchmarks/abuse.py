@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark of one abusive client against the latency of everyone else
+
+Seeds users and posts, then has one user send --rate POST /votes/ a
+second for --seconds, in-process, while other users read posts at a
+steady pace. Runs without rate limits, then with
+the configured ones, and reports the abuser's answers by status and the
+readers' latency percentiles.
+
+Usage: python -m benchmarks.abuse [--seconds S] [--rate N]
+           [--readers N]
+"""
+import argparse
+import asyncio
+import collections
+import statistics
+import time
+
+import httpx
+
+from app.config import settings
+from app.database import upgrade_schema
+from app.hot_feed import hot_feed
+from app.main import app
+from app.oauth2 import create_access_token
+from benchmarks.seed import clean, seed
+
+
+async def hammer(client, token: str, post_id: int, until: float, rate: float):
+    """Toggle a vote rate times a second until the deadline
+
+    The votes are sent on schedule whether or not the previous ones were
+    answered, as a client that does not back off would. Returns the count
+    of answers per status.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    codes = collections.Counter()
+
+    async def vote(dir: int):
+        response = await client.post(
+            "/votes/", json={"post_id": post_id, "dir": dir}, headers=headers
+        )
+        codes[response.status_code] += 1
+
+    tasks, dir = [], 1
+    while time.perf_counter() < until:
+        tasks.append(asyncio.create_task(vote(dir)))
+        dir = 1 - dir
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    return codes
+
+
+async def read(client, token: str, post_ids: list, until: float) -> list:
+    """Read posts until the deadline, in milliseconds per request"""
+    headers = {"Authorization": f"Bearer {token}"}
+    timings = []
+    while time.perf_counter() < until:
+        for post_id in post_ids:
+            start = time.perf_counter()
+            await client.get(f"/posts/{post_id}", headers=headers)
+            timings.append((time.perf_counter() - start) * 1000)
+            await asyncio.sleep(0.01)
+    return timings
+
+
+async def run(seeded: dict, seconds: float, rate: float, readers: int):
+    """Run the abuser and the readers, with and without rate limits"""
+    abuser, *others = [
+        create_access_token({"user_id": u}) for u in seeded["user_ids"]
+    ]
+    post_ids = seeded["post_ids"]
+    limits = settings.rate_limits
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        await hot_feed.page(None, 1)  # let the startup rebuild finish
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=60
+        ) as client:
+            print(
+                f"{'mode':<14}{'abuser answers':<40}"
+                f"{'p50 ms':>8}{'p99 ms':>8}"
+            )
+            modes = (("no limits", {}), ("rate limited", limits))
+            for mode, rate_limits in modes:
+                settings.rate_limits = rate_limits
+                until = time.perf_counter() + seconds
+                codes, *timings = await asyncio.gather(
+                    hammer(client, abuser, post_ids[0], until, rate),
+                    *(
+                        read(client, token, post_ids[1:], until)
+                        for token in others[:readers]
+                    ),
+                )
+                quantiles = statistics.quantiles(sum(timings, []), n=100)
+                answers = ", ".join(
+                    f"{count} x {code}" for code, count in sorted(codes.items())
+                )
+                print(
+                    f"{mode:<14}{answers:<40}"
+                    f"{quantiles[49]:>8.1f}{quantiles[98]:>8.1f}"
+                )
+    settings.rate_limits = limits
+
+
+def main():
+    """Seed, run the benchmark and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rate", type=float, default=200)
+    parser.add_argument("--readers", type=int, default=8)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=args.readers + 1, posts=20, votes=0, comments=0)
+    try:
+        asyncio.run(run(seeded, args.seconds, args.rate, args.readers))
+    finally:
+        clean(seeded["tag"])
+
+
+if __name__ == "__main__":
+    main()
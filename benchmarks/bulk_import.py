@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the bulk importer on generated files
+
+Writes --users users (pre-hashed, but for --plain ones hashed at --rounds
+by the importer), --posts posts, votes and comments as JSONL, or as CSV
+with --csv, runs python -m app.bulk_import --append on them, and reports
+rows per second. Half the comments reply to another, listed in random
+order as in exports. Fails if a vote_count of the imported posts
+disagrees with their votes, or a reply_count or thread path of their
+comments with the replies. The imported users, and all they own, are
+deleted.
+
+Usage: python -m benchmarks.bulk_import [--users N] [--posts N]
+           [--plain N] [--rounds N] [--csv]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from app.bulk_import import read_records
+from app.database import get_session_factory, upgrade_schema
+from app.models import Comment, Post, User, Vote
+from app.utils import hash_password
+from benchmarks.seed import PASSWORD, clean
+
+
+def write(path: str, records: list):
+    """Write records as CSV or JSONL, after the extension of path"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=list(records[0]))
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+
+def generate(folder: str, tag: str, args) -> dict:
+    """Write the files of each kind, return their paths"""
+    rng = random.Random(42)
+    hashed = hash_password(PASSWORD)
+    users = [
+        {
+            "id": i,
+            "username": f"bench_{tag}_{i}",
+            "email": f"bench_{tag}_{i}@bench.io",
+            "password": PASSWORD if i <= args.plain else "",
+            "hashed_password": "" if i <= args.plain else hashed,
+        }
+        for i in range(1, args.users + 1)
+    ]
+    posts = [
+        {
+            "id": i,
+            "owner_id": rng.randint(1, args.users),
+            "title": f"imported post {i}",
+            "content": f"imported content of post {i} " * 8,
+            "published": True,
+        }
+        for i in range(1, args.posts + 1)
+    ]
+    pairs = {
+        (rng.randint(1, args.users), rng.randint(1, args.posts))
+        for _ in range(args.posts)
+    }
+    votes = [{"user_id": u, "post_id": p} for u, p in pairs]
+    comments = []
+    for i in range(1, args.posts + 1):
+        parent = rng.choice(comments) if comments and rng.random() < 0.5 else {}
+        comments.append(
+            {
+                "id": i,
+                "post_id": parent.get("post_id") or rng.randint(1, args.posts),
+                "owner_id": rng.randint(1, args.users),
+                "parent_id": parent.get("id") or "",
+                "content": f"imported comment {i}",
+            }
+        )
+    # Replies before the comments they answer, as an export may list them
+    rng.shuffle(comments)
+    extension = "csv" if args.csv else "jsonl"
+    paths = {}
+    for kind, records in (
+        ("users", users),
+        ("posts", posts),
+        ("votes", votes),
+        ("comments", comments),
+    ):
+        paths[kind] = os.path.join(folder, f"{kind}.{extension}")
+        write(paths[kind], records)
+    return paths
+
+
+def counts_agree(tag: str) -> bool:
+    """Whether every imported post's vote_count matches its votes"""
+    votes = (
+        select(func.count())
+        .where(Vote.post_id == Post.id)
+        .correlate(Post)
+        .scalar_subquery()
+    )
+    with get_session_factory()() as session:
+        wrong = session.scalar(
+            select(func.count())
+            .select_from(Post)
+            .join(User, Post.owner_id == User.id)
+            .where(User.username.like(f"bench\\_{tag}\\_%"))
+            .where(Post.vote_count != votes)
+        )
+    return wrong == 0
+
+
+def threads_agree(tag: str) -> bool:
+    """Whether every imported comment's replies and path are consistent"""
+    reply = aliased(Comment)
+    parent = aliased(Comment)
+    replies = (
+        select(func.count())
+        .where(reply.parent_id == Comment.id)
+        .correlate(Comment)
+        .scalar_subquery()
+    )
+    imported = (
+        select(Comment.id)
+        .join(User, Comment.owner_id == User.id)
+        .where(User.username.like(f"bench\\_{tag}\\_%"))
+    )
+    with get_session_factory()() as session:
+        wrong_counts = session.scalar(
+            select(func.count())
+            .select_from(Comment)
+            .where(Comment.id.in_(imported))
+            .where(Comment.reply_count != replies)
+        )
+        wrong_paths = session.scalar(
+            select(func.count())
+            .select_from(Comment)
+            .join(parent, Comment.parent_id == parent.id)
+            .where(Comment.id.in_(imported))
+            .where(Comment.ancestry != parent.path)
+        )
+        linked = session.scalar(
+            select(func.count())
+            .select_from(Comment)
+            .where(Comment.id.in_(imported))
+            .where(Comment.parent_id.is_not(None))
+        )
+    print(f"{linked:,} imported replies linked")
+    return wrong_counts == 0 and wrong_paths == 0
+
+
+def main():
+    """Generate the files, import them, check and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--posts", type=int, default=200_000)
+    parser.add_argument("--plain", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--csv", action="store_true")
+    args = parser.parse_args()
+
+    upgrade_schema()
+    tag = uuid.uuid4().hex[:8]
+    with tempfile.TemporaryDirectory() as folder:
+        paths = generate(folder, tag, args)
+        command = [sys.executable, "-m", "app.bulk_import", "--append"]
+        for kind, path in paths.items():
+            command += [f"--{kind}", path]
+        command += ["--checkpoint", os.path.join(folder, "checkpoint.json")]
+        command += ["--rounds", str(args.rounds)]
+        start = time.perf_counter()
+        try:
+            subprocess.run(command, check=True)
+            elapsed = time.perf_counter() - start
+            rows = sum(
+                sum(1 for _ in read_records(path)) for path in paths.values()
+            )
+            print(
+                f"{rows:,} records in {elapsed:.1f}s"
+                f" ({rows / elapsed:,.0f}/s)"
+            )
+            consistent = counts_agree(tag)
+            threaded = threads_agree(tag)
+        finally:
+            clean(tag)
+    if not consistent:
+        print("vote_count disagrees with the votes")
+    if not threaded:
+        print("reply_count or path disagrees with the replies")
+    return 0 if consistent and threaded else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
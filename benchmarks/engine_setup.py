@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-request database setup overhead
+
+Compares the old pattern, where every request built its own engine, pool,
+session factory and ran create_all, with the shared process-wide engine.
+
+Usage: python -m benchmarks.engine_setup [iterations]
+"""
+import statistics
+import sys
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from app.database import get_db_url, get_session_factory, dispose_db
+from app.models import Base
+
+
+def per_request_engine():
+    """One request as handled before: a fresh engine every time"""
+    engine = create_engine(get_db_url())
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        session.execute(text("SELECT 1"))
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def shared_engine():
+    """One request as handled now: a session from the shared factory"""
+    session = get_session_factory()()
+    try:
+        session.execute(text("SELECT 1"))
+    finally:
+        session.close()
+
+
+def measure(func, iterations: int) -> list:
+    """Time `iterations` calls of func, in milliseconds"""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings: list):
+    """Print a one line summary of timings"""
+    quantiles = statistics.quantiles(timings, n=100)
+    print(
+        f"{name:<20} mean={statistics.mean(timings):8.3f}ms "
+        f"p50={quantiles[49]:8.3f}ms p95={quantiles[94]:8.3f}ms"
+    )
+
+
+def main(iterations: int = 200):
+    """Run both variants and print the results"""
+    shared_engine()  # warm the pool
+    report("per-request engine", measure(per_request_engine, iterations))
+    report("shared engine", measure(shared_engine, iterations))
+    dispose_db()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the NDJSON export, for memory flat in the size of the account
+
+Seeds one user owning --rows posts, votes and comments per size, then
+calls GET /users/me/export on the ASGI app directly, so nothing buffers
+the body, and reports lines, bytes, lines per second and the peak Python
+memory of the export. The slow reader waits --delay-ms per chunk, as a
+client reading slower than the database produces.
+
+Usage: python -m benchmarks.export [--rows N ...] [--delay-ms MS]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from app.database import upgrade_schema
+from app.main import app
+from app.oauth2 import create_access_token
+from benchmarks.seed import clean, seed
+
+
+async def export(token: str, delay: float) -> tuple:
+    """Stream the export, return its lines and bytes"""
+    lines = size = 0
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/users/me/export",
+        "raw_path": b"/users/me/export",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 1),
+        "server": ("bench", 80),
+    }
+
+    async def receive():
+        await asyncio.Event().wait()  # never disconnects
+
+    async def send(message):
+        nonlocal lines, size
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+        if message["type"] == "http.response.body":
+            lines += message.get("body", b"").count(b"\n")
+            size += len(message.get("body", b""))
+            await asyncio.sleep(delay)
+
+    await app(scope, receive, send)
+    return lines, size
+
+
+async def run(user_id: int, delay_ms: float, label: str):
+    """Export a user as a fast and a slow reader, print one line each"""
+    token = create_access_token({"user_id": user_id})
+    for reader, delay in (("fast", 0), ("slow", delay_ms / 1000)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        lines, size = await export(token, delay)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{label:>10}{reader:>8}{lines:>10}{size / 1e6:>10.1f}"
+            f"{lines / elapsed:>12.0f}{peak / 1e6:>10.1f}"
+        )
+
+
+async def run_all(users: list, delay_ms: float):
+    """Run the exports under one app lifespan"""
+    async with app.router.lifespan_context(app):
+        print(
+            f"{'rows':>10}{'reader':>8}{'lines':>10}{'MB':>10}"
+            f"{'lines/s':>12}{'peak MB':>10}"
+        )
+        for rows, user_id in users:
+            await run(user_id, delay_ms, f"{rows:,}")
+
+
+def main():
+    """Seed a user per size, export them and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000]
+    )
+    parser.add_argument("--delay-ms", type=float, default=1)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeds = [
+        seed(users=1, posts=rows, votes=rows, comments=rows)
+        for rows in args.rows
+    ]
+    try:
+        asyncio.run(
+            run_all(
+                [(r, s["user_ids"][0]) for r, s in zip(args.rows, seeds)],
+                args.delay_ms,
+            )
+        )
+    finally:
+        for seeded in seeds:
+            clean(seeded["tag"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark of login throughput, and of the other routes during a login burst
+
+Fires concurrent logins at the app in-process while probing a cheap route,
+and reports logins per second plus the latency of the probe. The burst
+comes from one client, so the rate limits are lifted for it.
+
+Usage: python -m benchmarks.login [--logins N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+from app.config import settings
+from app.database import DB
+from app.main import app
+from app.utils import hash_password
+
+
+async def login_burst(client, username: str, logins: int, concurrency: int):
+    """Run the logins, return how many succeeded and were shed"""
+    semaphore = asyncio.Semaphore(concurrency)
+    codes = []
+
+    async def login():
+        async with semaphore:
+            response = await client.post(
+                "/auth/login", data={"username": username, "password": "bench"}
+            )
+            codes.append(response.status_code)
+
+    await asyncio.gather(*(login() for _ in range(logins)))
+    return codes.count(200), codes.count(503)
+
+
+async def probe(client, user_id: int, done: asyncio.Event) -> list:
+    """Time a cheap route until the burst is over, in milliseconds"""
+    timings = []
+    while not done.is_set():
+        start = time.perf_counter()
+        await client.get(f"/users/{user_id}")
+        timings.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.01)
+    return timings
+
+
+async def run(logins: int, concurrency: int):
+    """Seed a user, run the burst and print the results"""
+    tag = uuid.uuid4().hex[:8]
+    db = DB()
+    user = db.create_user(
+        f"login_{tag}",
+        f"login_{tag}@bench.io",
+        hashed_password=hash_password("bench"),
+    )
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as client:
+                done = asyncio.Event()
+                prober = asyncio.create_task(probe(client, user.id, done))
+                start = time.perf_counter()
+                ok, shed = await login_burst(
+                    client, user.username, logins, concurrency
+                )
+                elapsed = time.perf_counter() - start
+                done.set()
+                timings = await prober
+    finally:
+        db.delete_user(user.id)
+
+    quantiles = statistics.quantiles(timings, n=100)
+    print(f"logins: {ok} ok, {shed} shed in {elapsed:.2f}s")
+    print(f"throughput: {ok / elapsed:.1f} logins/s")
+    print(
+        f"GET /users/{{id}} during the burst: p50={quantiles[49]:.1f}ms "
+        f"p99={quantiles[98]:.1f}ms ({len(timings)} probes)"
+    )
+
+
+def main():
+    """Parse the arguments and run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    settings.rate_limits = {}
+    asyncio.run(run(args.logins, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the DB methods and of the response serialization
+
+Seeds a small dataset, then times each read method of DB on a fresh
+session per call (as a request would), and the pydantic serialization of
+PostDisplayAll apart from the query that loads the post.
+
+Usage: python -m benchmarks.micro [--runs N] [--output FILE]
+           [--compare FILE] [--threshold 0.2]
+"""
+import argparse
+import random
+import sys
+import time
+
+from app import loaders
+from app.database import DB, upgrade_schema
+from app.schemas import PostDisplayAll
+from benchmarks import results as res
+from benchmarks.seed import clean, seed
+
+
+def db_benchmarks(seeded: dict, rng: random.Random) -> dict:
+    """Name of each DB micro-benchmark, and a call taking a DB"""
+    post_ids, user_ids = seeded["post_ids"], seeded["user_ids"]
+    usernames = seeded["usernames"]
+    return {
+        "DB.find_user": lambda db: db.find_user(
+            username=rng.choice(usernames), options=loaders.USER_DISPLAY
+        ),
+        "DB.get_all_users": lambda db: db.get_all_users(
+            options=loaders.USER_DISPLAY
+        ),
+        "DB.get_posts": lambda db: db.get_posts(options=loaders.POST_DISPLAY),
+        "DB.search_posts": lambda db: db.search_posts("generated"),
+        "DB.find_post_with_id": lambda db: db.find_post_with_id(
+            id=rng.choice(post_ids), options=loaders.POST_DISPLAY_ALL
+        ),
+        "DB.get_comments": lambda db: db.get_comments(
+            rng.choice(post_ids), options=loaders.COMMENT_DISPLAY
+        ),
+        "DB.get_votes": lambda db: db.get_votes(
+            rng.choice(post_ids), options=loaders.VOTE_DISPLAY
+        ),
+        "DB.find_vote": lambda db: db.find_vote(
+            user_id=rng.choice(user_ids), post_id=rng.choice(post_ids)
+        ),
+    }
+
+
+def timed(func, items) -> list:
+    """Time a call of func on each item, in milliseconds"""
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run_db(func, runs: int) -> list:
+    """Time a DB method, each call on its own session"""
+
+    def call(_):
+        db = DB()
+        try:
+            func(db)
+        finally:
+            db._session.close()
+
+    call(None)  # warm up the statement cache and the pool
+    return timed(call, range(runs))
+
+
+def run_serialization(post_ids: list, runs: int) -> dict:
+    """Time the validation and the JSON dump of PostDisplayAll per post"""
+    db = DB()
+    try:
+        posts = [
+            db.find_post_with_id(id=id, options=loaders.POST_DISPLAY_ALL)
+            for id in post_ids[:runs]
+        ]
+    finally:
+        db._session.close()
+    validated = [PostDisplayAll.model_validate(post) for post in posts]
+    return {
+        "PostDisplayAll.model_validate": timed(
+            PostDisplayAll.model_validate, posts
+        ),
+        "PostDisplayAll.model_dump_json": timed(
+            PostDisplayAll.model_dump_json, validated
+        ),
+    }
+
+
+def main():
+    """Seed, run the micro-benchmarks, report and compare"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=50, posts=500, votes=2_000, comments=1_000)
+    rng = random.Random(42)
+    timings = {}
+    try:
+        for name, func in db_benchmarks(seeded, rng).items():
+            timings[name] = run_db(func, args.runs)
+        timings.update(run_serialization(seeded["post_ids"], args.runs))
+    finally:
+        clean(seeded["tag"])
+
+    results = {name: res.summarize(values) for name, values in timings.items()}
+    res.print_table(results)
+    if args.output:
+        res.save(args.output, results, benchmark="micro", runs=args.runs)
+    if args.compare:
+        return res.check(args.compare, results, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
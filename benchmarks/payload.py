@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark of sparse fieldsets and excerpts on GET /posts
+
+Seeds posts with long generated content, then calls GET /posts in-process
+with full posts, with ?fields= and with ?excerpt=, and reports for each the
+response size, the database time from the Server-Timing header and the
+requests per second.
+
+Usage: python -m benchmarks.payload [--requests N] [--limit N]
+           [--content-kb N]
+"""
+import argparse
+import asyncio
+import random
+import re
+import statistics
+import time
+
+import httpx
+from sqlalchemy import bindparam, update
+
+from app.database import get_session_factory, upgrade_schema
+from app.main import app
+from app.models import Post
+from app.oauth2 import create_access_token
+from benchmarks.seed import clean, seed
+
+DB_TIMING = re.compile(r"\bdb;dur=([\d.]+)")
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo "
+    "lima mike november oscar papa quebec romeo sierra tango uniform"
+).split()
+
+
+def lengthen(post_ids: list, content_kb: int, rng: random.Random):
+    """Give posts content of about content_kb KB, of words in random order
+
+    Random words keep pglz from compressing the content away, so it is
+    TOASTed out of line like real long posts.
+    """
+    rows = []
+    for post_id in post_ids:
+        words, size = [], 0
+        while size < content_kb * 1024:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        rows.append({"pid": post_id, "content": " ".join(words)})
+    with get_session_factory()() as session:
+        session.connection().execute(
+            update(Post.__table__)
+            .where(Post.id == bindparam("pid"))
+            .values(content=bindparam("content")),
+            rows,
+        )
+        session.commit()
+
+
+async def measure(client, url: str, requests: int) -> tuple:
+    """Bytes per response, mean database ms and requests per second"""
+    await client.get(url)  # warm up
+    sizes, db_ms = [], []
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = await client.get(url)
+        response.raise_for_status()
+        sizes.append(len(response.content))
+        timing = DB_TIMING.search(response.headers.get("server-timing", ""))
+        if timing:
+            db_ms.append(float(timing.group(1)))
+    elapsed = time.perf_counter() - start
+    return (
+        statistics.mean(sizes),
+        statistics.mean(db_ms) if db_ms else float("nan"),
+        requests / elapsed,
+    )
+
+
+async def run(user_id: int, requests: int, limit: int):
+    """Measure every variant of GET /posts"""
+    token = create_access_token({"user_id": user_id})
+    base = f"/posts/?limit={limit}"
+    urls = (
+        base,
+        f"{base}&fields=id,title,owner_id,vote_count",
+        f"{base}&excerpt=200",
+        f"{base}&fields=id,title,content&excerpt=200",
+        f"{base}&search=alpha",
+        f"{base}&search=alpha&fields=id,title&excerpt=200",
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://bench",
+            headers={"Authorization": f"Bearer {token}"},
+        ) as client:
+            print(f"{'url':<58}{'bytes':>11}{'db ms':>9}{'req/s':>8}")
+            for url in urls:
+                size, db_ms, rate = await measure(client, url, requests)
+                print(f"{url:<58}{size:>11,.0f}{db_ms:>9.2f}{rate:>8.0f}")
+
+
+def main():
+    """Seed long posts and compare the variants"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--content-kb", type=int, default=20)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=1, posts=args.limit * 2, votes=0, comments=0)
+    try:
+        lengthen(seeded["post_ids"], args.content_kb, random.Random(42))
+        asyncio.run(run(seeded["user_ids"][0], args.requests, args.limit))
+    finally:
+        clean(seeded["tag"])
+
+
+if __name__ == "__main__":
+    main()
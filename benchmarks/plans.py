@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Check that no query of the API plans a sequential scan of a large table
+
+Seeds a large dataset, calls every route, captures the statements they
+send (DB methods included) and EXPLAINs each with its own parameters.
+Exits non-zero when a plan scans a table of more than --min-rows rows
+sequentially, or when a foreign key has no index to serve the lookups of
+its ON DELETE CASCADE (which EXPLAIN does not show).
+
+Usage: python -m benchmarks.plans [--users N] [--posts N] [--votes N]
+           [--comments N] [--min-rows N]
+"""
+import argparse
+import json
+import sys
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event, inspect
+
+from app.database import init_db, init_async_db, upgrade_schema
+from app.main import app
+from app.metrics import current_route
+from app.oauth2 import create_access_token
+from app.slow_queries import EXPLAINABLE, to_pyformat
+from benchmarks.seed import PASSWORD, clean, seed
+
+
+class StatementRecorder:
+    """Keep the first run of every distinct statement, with its step"""
+
+    def __init__(self):
+        """Initialize StatementRecorder"""
+        self.step = None
+        self.statements = {}
+
+    def __call__(self, conn, cursor, statement, parameters, context, many):
+        """before_cursor_execute listener"""
+        if self.step is None or statement in self.statements:
+            return
+        # Background tasks, such as the hot feed rebuild, are no route's
+        if current_route() is None:
+            return
+        if not statement.lstrip().lower().startswith(EXPLAINABLE):
+            return
+        if many:
+            parameters = parameters[0] if parameters else None
+        if context.dialect.paramstyle == "numeric_dollar":
+            statement, parameters = to_pyformat(statement, parameters)
+            if statement in self.statements:
+                return
+        self.statements[statement] = (self.step, parameters)
+
+    def attach(self):
+        """Listen on the sync engine and the asyncpg engine"""
+        for engine in (init_db(), init_async_db().sync_engine):
+            event.listen(engine, "before_cursor_execute", self)
+
+    def detach(self):
+        """Stop listening on both engines"""
+        for engine in (init_db(), init_async_db().sync_engine):
+            event.remove(engine, "before_cursor_execute", self)
+
+
+def steps(seeded: dict) -> list:
+    """The requests to make, as (method, url, json) with seeded ids"""
+    post_id = seeded["post_ids"][0]
+    other_id = seeded["post_ids"][1]
+    user_id = seeded["user_ids"][0]
+    return [
+        ("GET", "/posts/", None),
+        ("GET", "/posts/?cursor={cursor}", None),
+        ("GET", "/posts/?search=4242&highlight=true", None),
+        ("GET", "/posts/hot", None),
+        ("GET", f"/posts/{post_id}", None),
+        ("GET", "/users/", None),
+        ("GET", f"/users/{user_id}", None),
+        ("GET", "/users/me", None),
+        ("GET", "/users/me/export", None),
+        ("GET", f"/comments/{post_id}", None),
+        ("GET", f"/votes/{post_id}", None),
+        ("POST", "/posts/", {"title": "plan", "content": "check"}),
+        ("PUT", "/posts/{new_post}", {"title": "plan", "content": "again"}),
+        ("POST", "/posts/batch", [{"title": "plan", "content": "batch"}]),
+        ("POST", "/comments/", {"post_id": other_id, "content": "plan"}),
+        (
+            "POST",
+            "/comments/",
+            {
+                "post_id": other_id,
+                "content": "reply",
+                "parent_id": "{new_comment}",
+            },
+        ),
+        ("GET", f"/comments/{other_id}/threads", None),
+        ("GET", "/comments/{new_comment}/replies", None),
+        ("PUT", "/comments/{new_comment}", {"post_id": 0, "content": "x"}),
+        ("POST", "/comments/batch", [{"post_id": other_id, "content": "b"}]),
+        ("DELETE", "/comments/{new_comment}", None),
+        ("POST", "/votes/", {"post_id": other_id, "dir": 1}),
+        ("POST", "/votes/", {"post_id": other_id, "dir": 0}),
+        ("POST", "/votes/batch", [{"post_id": other_id, "dir": 1}]),
+        ("DELETE", "/posts/{new_post}", None),
+        ("POST", "/users/me", {"password": PASSWORD}),
+        ("DELETE", "/users/me", None),
+    ]
+
+
+def fill(body, ids: dict):
+    """A request body with its "{name}" values replaced by those ids"""
+    if not isinstance(body, dict):
+        return body
+    return {
+        key: ids[value[1:-1]] if str(value).startswith("{") else value
+        for key, value in body.items()
+    }
+
+
+def run_steps(client, seeded: dict, recorder: StatementRecorder):
+    """Call every route as the first seeded user"""
+    username = seeded["usernames"][0]
+    recorder.step = "POST /auth/login"
+    response = client.post(
+        "/auth/login", data={"username": username, "password": PASSWORD}
+    )
+    response.raise_for_status()
+    token = create_access_token({"user_id": seeded["user_ids"][0]})
+    headers = {"Authorization": f"Bearer {token}"}
+    ids = {}
+    for method, url, body in steps(seeded):
+        url = url.format(**ids)
+        recorder.step = f"{method} {url}"
+        response = client.request(
+            method, url, json=fill(body, ids), headers=headers
+        )
+        response.raise_for_status()
+        if method == "GET" and url == "/posts/":
+            ids["cursor"] = response.headers["X-Next-Cursor"]
+        elif method == "POST" and url == "/posts/":
+            ids["new_post"] = response.json()["id"]
+        elif method == "POST" and url == "/comments/":
+            ids["new_comment"] = response.json()["id"]
+    recorder.step = None
+
+
+def seq_scans(plan: dict, large: set) -> list:
+    """Large tables scanned sequentially somewhere in a plan"""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        if plan.get("Relation Name") in large:
+            found.append(plan["Relation Name"])
+    for child in plan.get("Plans", ()):
+        found.extend(seq_scans(child, large))
+    return found
+
+
+def explain(statements: dict, large: set) -> list:
+    """EXPLAIN every statement, return (step, tables, statement, plan)"""
+    failures = []
+    with init_db().connect() as connection:
+        for statement, (step, parameters) in statements.items():
+            # Plain EXPLAIN plans without running, even for writes
+            (plan,) = connection.exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {statement}", parameters or None
+            ).scalar()
+            tables = seq_scans(plan["Plan"], large)
+            if tables:
+                failures.append((step, tables, statement, plan["Plan"]))
+        connection.rollback()
+    return failures
+
+
+def unindexed_foreign_keys() -> list:
+    """Foreign keys whose columns do not lead any index of their table"""
+    missing = []
+    tables = inspect(init_db())
+    for table in tables.get_table_names():
+        leading = [
+            index["column_names"] for index in tables.get_indexes(table)
+        ]
+        primary_key = tables.get_pk_constraint(table)["constrained_columns"]
+        leading.append(primary_key)
+        for key in tables.get_foreign_keys(table):
+            columns = key["constrained_columns"]
+            if not any(index[: len(columns)] == columns for index in leading):
+                missing.append(f"{table}({', '.join(columns)})")
+    return missing
+
+
+def large_tables(min_rows: int) -> set:
+    """Tables the planner estimates at min_rows rows or more"""
+    with init_db().connect() as connection:
+        rows = connection.exec_driver_sql(
+            "SELECT relname FROM pg_class WHERE relkind = 'r' "
+            "AND relnamespace = 'public'::regnamespace "
+            "AND reltuples >= %(min_rows)s",
+            {"min_rows": min_rows},
+        )
+        return {name for (name,) in rows}
+
+
+def main():
+    """Seed, capture, explain and report"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--posts", type=int, default=50_000)
+    parser.add_argument("--votes", type=int, default=100_000)
+    parser.add_argument("--comments", type=int, default=50_000)
+    parser.add_argument("--min-rows", type=int, default=10_000)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    missing = unindexed_foreign_keys()
+    seeded = seed(args.users, args.posts, args.votes, args.comments)
+    recorder = StatementRecorder()
+    try:
+        with TestClient(app) as client:
+            recorder.attach()
+            run_steps(client, seeded, recorder)
+        large = large_tables(args.min_rows)
+        failures = explain(recorder.statements, large)
+
+        print(
+            f"{len(recorder.statements)} statements explained, large tables: "
+            f"{', '.join(sorted(large))}"
+        )
+        for step, tables, statement, plan in failures:
+            print(f"\nseq scan of {', '.join(tables)} in {step}")
+            print(statement)
+            print(json.dumps(plan, indent=2))
+        for key in missing:
+            print(f"foreign key without an index: {key}")
+        if not failures and not missing:
+            print("no sequential scan of a large table")
+        return 1 if failures or missing else 0
+    finally:
+        clean(seeded["tag"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Check that read endpoints run a fixed number of SQL statements
+
+Seeds the same shape of data at several sizes, calls every read endpoint
+and counts the statements it issues. Exits non-zero when a count grows
+with the amount of data, i.e. when an N+1 lazy load came back.
+
+Usage: python -m benchmarks.query_counts [size ...]
+"""
+import sys
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import DB, init_db, init_async_db
+from app.main import app
+from app.oauth2 import create_access_token
+from app.utils import hash_password
+
+ENDPOINTS = (
+    "/posts/{post_id}",
+    "/posts/",
+    "/users/me",
+    "/users/",
+    "/users/{user_id}",
+    "/comments/{post_id}",
+    "/comments/{post_id}/threads",
+    "/comments/{comment_id}/replies",
+)
+
+
+class StatementCounter:
+    """Count the statements sent through the engines"""
+
+    def __init__(self):
+        """Initialize StatementCounter"""
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        """before_cursor_execute listener"""
+        self.count += 1
+
+    def attach(self):
+        """Listen on the sync engine and the asyncpg engine"""
+        engines = [init_db(), init_async_db().sync_engine]
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self)
+
+
+def seed(db: DB, size: int, hashed_password: str) -> dict:
+    """Create an owner with `size` posts, voters and comments on one post
+
+    The comments form one thread: comment i replies to comment (i - 1) / 2.
+    """
+    tag = uuid.uuid4().hex[:8]
+    owner = db.create_user(
+        f"owner_{tag}", f"owner_{tag}@bench.io", hashed_password=hashed_password
+    )
+    posts = [
+        db.create_post(f"post {i}", "content", owner_id=owner.id)
+        for i in range(size)
+    ]
+    post = posts[0]
+    user_ids = [owner.id]
+    comment_ids = []
+    for i in range(size):
+        voter = db.create_user(
+            f"voter_{tag}_{i}",
+            f"voter_{tag}_{i}@bench.io",
+            hashed_password=hashed_password,
+        )
+        user_ids.append(voter.id)
+        db.vote(user_id=voter.id, post_id=post.id, dir=1)
+        comment = db.create_comment(
+            "comment",
+            post_id=post.id,
+            owner_id=voter.id,
+            parent_id=comment_ids[(i - 1) // 2] if i else None,
+        )
+        comment_ids.append(comment.id)
+    return {
+        "user_id": owner.id,
+        "post_id": post.id,
+        "comment_id": comment_ids[0],
+        "user_ids": user_ids,
+    }
+
+
+def cleanup(db: DB, user_ids: list):
+    """Delete the seeded users, with their posts, votes and comments"""
+    for user_id in user_ids:
+        db.delete_user(user_id)
+
+
+def main(sizes: list):
+    """Count statements per endpoint for each size"""
+    db = DB()
+    hashed_password = hash_password("bench")
+    counter = StatementCounter()
+    counts = {endpoint: [] for endpoint in ENDPOINTS}
+    with TestClient(app) as client:
+        counter.attach()
+        for size in sizes:
+            seeded = seed(db, size, hashed_password)
+            token = create_access_token({"user_id": seeded["user_id"]})
+            headers = {"Authorization": f"Bearer {token}"}
+            for endpoint in ENDPOINTS:
+                counter.count = 0
+                response = client.get(
+                    endpoint.format(**seeded), headers=headers
+                )
+                response.raise_for_status()
+                counts[endpoint].append(counter.count)
+            cleanup(db, seeded["user_ids"])
+
+    failed = False
+    print(f"{'endpoint':<32}" + "".join(f"{size:>8}" for size in sizes))
+    for endpoint, values in counts.items():
+        flag = "" if len(set(values)) == 1 else "  <- grows with data"
+        failed = failed or bool(flag)
+        print(f"{endpoint:<32}" + "".join(f"{v:>8}" for v in values) + flag)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main([int(size) for size in sys.argv[1:]] or [1, 20]))
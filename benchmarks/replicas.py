@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Check of the read/write routing over the replicas of DB_REPLICA_URLS
+
+Seeds users and posts, waits for the replicas to have them, then, in
+process: readers list posts, which must only reach the replicas, in
+turn; a writer votes and reads the post right back, which must reach the
+primary alone and show the vote. Prints the statements of each phase per
+database and fails on a misrouted statement or a stale read of the
+writer. Two local instances do: a primary, and a standby started from
+pg_basebackup -R on another port.
+
+Usage: DB_REPLICA_URLS='["postgresql://..."]' python -m benchmarks.replicas
+           [--reads N] [--writes N]
+"""
+import argparse
+import asyncio
+import collections
+import contextvars
+import sys
+import time
+
+import httpx
+from sqlalchemy import event, func, select
+
+from app import database
+from app.config import settings
+from app.database import upgrade_schema
+from app.main import app
+from app.models import Post
+from app.oauth2 import create_access_token
+from benchmarks.seed import clean, seed
+
+# Phase whose statements are counted; other tasks' are not
+phase = contextvars.ContextVar("phase", default=None)
+statements = collections.Counter()
+
+
+def name(engine) -> str:
+    """host:port of an engine's database"""
+    return f"{engine.url.host}:{engine.url.port}"
+
+
+def count(conn, cursor, statement, parameters, context, executemany):
+    """Count a statement of the current phase against its database"""
+    if phase.get() is not None:
+        statements[phase.get(), name(conn.engine)] += 1
+
+
+def listen() -> str:
+    """Count the statements of every engine, return the primary's name"""
+    engines = [database.init_db(), *database._replicas]
+    if settings.db_async:
+        engines += [
+            engine.sync_engine
+            for engine in (database.init_async_db(), *database._async_replicas)
+        ]
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", count)
+    return name(engines[0])
+
+
+def wait_for_replicas(post_id: int, timeout: float = 30):
+    """Block until every replica has the post"""
+    deadline = time.monotonic() + timeout
+    for replica in database._replicas:
+        with replica.connect() as connection:
+            while not connection.scalar(
+                select(func.count()).where(Post.id == post_id)
+            ):
+                if time.monotonic() > deadline:
+                    raise SystemExit(f"{name(replica)} is not replicating")
+                connection.rollback()
+                time.sleep(0.1)
+
+
+async def run(seeded: dict, reads: int, writes: int) -> int:
+    """Run the phases, return the count of failures"""
+    primary = listen()
+    writer, *readers = [
+        {"Authorization": f"Bearer {create_access_token({'user_id': u})}"}
+        for u in seeded["user_ids"]
+    ]
+    post_id = seeded["post_ids"][0]
+    stale = 0
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            phase.set("reads")
+            for i in range(reads):
+                response = await client.get(
+                    "/posts/", headers=readers[i % len(readers)]
+                )
+                response.raise_for_status()
+            phase.set("writes")
+            for i in range(writes):
+                dir = 1 - i % 2
+                response = await client.post(
+                    "/votes/",
+                    json={"post_id": post_id, "dir": dir},
+                    headers=writer,
+                )
+                response.raise_for_status()
+                response = await client.get(
+                    f"/posts/{post_id}", headers=writer
+                )
+                stale += response.json()["vote_count"] != dir
+            phase.set(None)
+
+    print(f"{'phase':<8}{'database':<24}{'statements':>12}")
+    for (step, database_name), n in sorted(statements.items()):
+        print(f"{step:<8}{database_name:<24}{n:>12}")
+    failures = statements["reads", primary] + stale
+    failures += sum(
+        n
+        for (step, database_name), n in statements.items()
+        if step == "writes" and database_name != primary
+    )
+    print(f"stale reads of the writer: {stale}")
+    return failures
+
+
+def main():
+    """Seed, check the routing and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--writes", type=int, default=50)
+    args = parser.parse_args()
+    if not settings.db_replica_urls:
+        raise SystemExit("Set DB_REPLICA_URLS to the replicas to check")
+    # The voting user must not be throttled by the check itself
+    settings.rate_limits = {}
+
+    upgrade_schema()
+    seeded = seed(users=5, posts=20, votes=0, comments=0)
+    try:
+        wait_for_replicas(seeded["post_ids"][-1])
+        failures = asyncio.run(run(seeded, args.reads, args.writes))
+    finally:
+        clean(seeded["tag"])
+    if failures:
+        print(f"{failures} misrouted statements or stale reads")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Latency summaries of benchmark runs, saved as JSON and compared
+
+A result file maps each measured name (a route or a micro-benchmark) to
+its summary, next to metadata about the run. Comparing two files flags
+every name whose p50 or p95 grew by more than a threshold.
+"""
+import json
+import platform
+import statistics
+import time
+
+COMPARED = ("p50", "p95")
+
+
+def summarize(timings: list, elapsed: float = None) -> dict:
+    """Summary of timings in milliseconds, with throughput over elapsed s"""
+    ordered = sorted(timings)
+    if len(ordered) > 1:
+        quantiles = statistics.quantiles(ordered, n=100, method="inclusive")
+    else:
+        quantiles = ordered * 99
+    summary = {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": quantiles[49],
+        "p95": quantiles[94],
+        "p99": quantiles[98],
+        "max": ordered[-1],
+    }
+    if elapsed:
+        summary["throughput"] = len(ordered) / elapsed
+    return summary
+
+
+def print_table(results: dict):
+    """Print the summaries, one line per name"""
+    print(
+        f"{'name':<32}{'count':>8}{'req/s':>9}"
+        f"{'p50':>9}{'p95':>9}{'p99':>9}  (ms)"
+    )
+    for name, summary in results.items():
+        throughput = summary.get("throughput")
+        print(
+            f"{name:<32}{summary['count']:>8}"
+            + (f"{throughput:>9.1f}" if throughput else f"{'':>9}")
+            + "".join(f"{summary[q]:>9.2f}" for q in ("p50", "p95", "p99"))
+        )
+
+
+def save(path: str, results: dict, **meta):
+    """Write the results and the run metadata to a JSON file"""
+    document = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            **meta,
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+
+
+def load(path: str) -> dict:
+    """Read the results of a JSON file"""
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list:
+    """Print the change against a baseline, return the regressions"""
+    regressions = []
+    print(f"{'name':<32}" + "".join(f"{q:>22}" for q in COMPARED))
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        line = f"{name:<32}"
+        for q in COMPARED:
+            before, after = baseline[name][q], summary[q]
+            change = (after - before) / before if before else 0.0
+            line += f"{before:>8.2f}->{after:>6.2f} {change:>+4.0%}"
+            if change > threshold:
+                regressions.append(f"{name} {q} {change:+.0%}")
+        print(line)
+    return regressions
+
+
+def check(path: str, results: dict, threshold: float) -> int:
+    """Compare against the baseline file, exit status 1 on regressions"""
+    regressions = compare(load(path), results, threshold)
+    for regression in regressions:
+        print(f"regression: {regression}")
+    return 1 if regressions else 0
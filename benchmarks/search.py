@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark of post search: ILIKE scan against the full-text search index
+
+Seeds a bench user with N generated posts (1,000,000 by default) through
+COPY, then times the legacy icontains filter and DB.search_posts for a
+few terms.
+
+Usage: python -m benchmarks.search [--posts N] [--runs N] [--keep]
+"""
+import argparse
+import io
+import itertools
+import random
+import statistics
+import time
+
+from sqlalchemy import or_
+
+from app.database import DB, upgrade_schema, init_db
+from app.models import Post
+
+BENCH_USER = "bench_search"
+# Zipf-distributed vocabulary: a few common words, a long tail of rare ones
+WORDS = (
+    "database index query planner vacuum replica cursor python async "
+    "latency throughput postgres cache memory disk network socket thread"
+).split() + [f"word{i}" for i in range(20_000)]
+CUM_WEIGHTS = list(
+    itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1))
+)
+# A common word, a phrase, a mid-frequency word, a rare word, no match
+TERMS = ("postgres", "latency cache", "word50", "word15000", "zebra")
+
+
+def words(rng: random.Random, count: int) -> list:
+    """Draw words from the vocabulary"""
+    return rng.choices(WORDS, cum_weights=CUM_WEIGHTS, k=count)
+
+
+def seed(db: DB, posts: int, batch: int = 50_000) -> int:
+    """Create the bench user and COPY generated posts, return the user id"""
+    user = db.create_user(
+        BENCH_USER, f"{BENCH_USER}@bench.io", password="bench"
+    )
+    rng = random.Random(42)
+    engine = init_db()
+    # Building the GIN index once is far cheaper than maintaining it per row
+    search_index = next(
+        i for i in Post.__table__.indexes if i.name == "ix_posts_search_vector"
+    )
+    search_index.drop(bind=engine, checkfirst=True)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for start in range(0, posts, batch):
+            buffer = io.StringIO()
+            for _ in range(min(batch, posts - start)):
+                title = " ".join(words(rng, 5))
+                content = " ".join(words(rng, 60))
+                buffer.write(f"{title}\t{content}\t{user.id}\n")
+            buffer.seek(0)
+            cursor.copy_from(
+                buffer, "posts", columns=("title", "content", "owner_id")
+            )
+            connection.commit()
+    finally:
+        connection.close()
+    search_index.create(bind=engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE posts")
+    return user.id
+
+
+def icontains(db: DB, term: str, limit: int = 10):
+    """The search as implemented before: ILIKE on title and content"""
+    return (
+        db._session.query(Post.id)
+        .filter(or_(Post.title.icontains(term), Post.content.icontains(term)))
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def full_text(db: DB, term: str, limit: int = 10):
+    """The ranked full-text search"""
+    return db.search_posts(term, limit=limit)
+
+
+def timed(func, db: DB, term: str, runs: int) -> float:
+    """Median time of a search, in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(db, term)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    """Seed the posts and compare both searches"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="keep the posts")
+    args = parser.parse_args()
+
+    upgrade_schema()
+    db = DB()
+    try:
+        user_id = db.find_user(username=BENCH_USER).id
+        print(f"reusing the posts of {BENCH_USER}")
+    except Exception:
+        start = time.perf_counter()
+        user_id = seed(db, args.posts)
+        elapsed = time.perf_counter() - start
+        print(f"seeded {args.posts} posts in {elapsed:.1f}s")
+
+    print(f"{'term':<16}{'icontains':>14}{'full-text':>14}")
+    for term in TERMS:
+        slow = timed(icontains, db, term, args.runs)
+        fast = timed(full_text, db, term, args.runs)
+        print(f"{term:<16}{slow:>12.2f}ms{fast:>12.2f}ms")
+
+    if not args.keep:
+        # ON DELETE CASCADE removes the posts in the database
+        db._session.query(Post).filter(Post.owner_id == user_id).delete()
+        db.delete_user(user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Seed the database with generated users, posts, votes and comments
+
+Every seeded user is named bench_<tag>_<n> and shares the password
+"bench", so a run can log in as any of them and remove everything it
+created with one DELETE (votes, comments and posts cascade).
+
+Usage: python -m benchmarks.seed [--users N] [--posts N] [--votes N]
+                                 [--comments N] | --clean TAG
+"""
+import argparse
+import random
+import time
+import uuid
+
+from sqlalchemy import delete, func, insert, select, update
+
+from app.database import upgrade_schema, get_session_factory, init_db
+from app.models import User, Post, Vote, Comment
+from app.utils import hash_password
+
+PASSWORD = "bench"
+BATCH = 5_000
+
+
+def _insert(session, table, rows: list, returning=None) -> list:
+    """Insert rows in multi-row batches, return the `returning` column"""
+    ids = []
+    for start in range(0, len(rows), BATCH):
+        chunk = rows[start : start + BATCH]
+        if returning is None:
+            session.execute(insert(table), chunk)
+        else:
+            ids.extend(
+                session.scalars(
+                    insert(table).returning(
+                        returning, sort_by_parameter_order=True
+                    ),
+                    chunk,
+                )
+            )
+    return ids
+
+
+def seed(
+    users: int = 100,
+    posts: int = 1_000,
+    votes: int = 5_000,
+    comments: int = 2_000,
+    rng: random.Random = None,
+) -> dict:
+    """Create the data, return the tag, usernames and post ids"""
+    rng = rng or random.Random(42)
+    tag = uuid.uuid4().hex[:8]
+    hashed_password = hash_password(PASSWORD)
+    usernames = [f"bench_{tag}_{i}" for i in range(users)]
+    with get_session_factory()() as session:
+        user_ids = _insert(
+            session,
+            User,
+            [
+                {
+                    "username": name,
+                    "email": f"{name}@bench.io",
+                    "hashed_password": hashed_password,
+                }
+                for name in usernames
+            ],
+            returning=User.id,
+        )
+        post_ids = _insert(
+            session,
+            Post,
+            [
+                {
+                    "title": f"post {i}",
+                    "content": f"generated content of post {i} " * 8,
+                    "published": True,
+                    "owner_id": rng.choice(user_ids),
+                }
+                for i in range(posts)
+            ],
+            returning=Post.id,
+        )
+        # Votes are unique per (user, post), so cap them at every pair
+        pairs = set()
+        while len(pairs) < min(votes, users * posts):
+            pairs.add((rng.choice(user_ids), rng.choice(post_ids)))
+        _insert(
+            session,
+            Vote,
+            [{"user_id": user, "post_id": post} for user, post in pairs],
+        )
+        _insert(
+            session,
+            Comment,
+            [
+                {
+                    "content": f"comment {i}",
+                    "post_id": rng.choice(post_ids),
+                    "owner_id": rng.choice(user_ids),
+                }
+                for i in range(comments)
+            ],
+        )
+        counts = (
+            select(func.count())
+            .where(Vote.post_id == Post.id)
+            .scalar_subquery()
+        )
+        session.execute(
+            update(Post)
+            .where(Post.id.in_(post_ids))
+            .values(vote_count=counts, updated_at=Post.updated_at)
+        )
+        session.commit()
+    with init_db().begin() as connection:
+        for table in ("users", "posts", "votes", "comments"):
+            connection.exec_driver_sql(f"ANALYZE {table}")
+    return {
+        "tag": tag,
+        "usernames": usernames,
+        "user_ids": user_ids,
+        "post_ids": post_ids,
+    }
+
+
+def clean(tag: str) -> int:
+    """Delete the users of a seed and everything they own"""
+    with get_session_factory()() as session:
+        deleted = session.execute(
+            delete(User).where(User.username.like(f"bench\\_{tag}\\_%"))
+        ).rowcount
+        session.commit()
+    return deleted
+
+
+def main():
+    """Seed the database, or clean a previous seed"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1_000)
+    parser.add_argument("--votes", type=int, default=5_000)
+    parser.add_argument("--comments", type=int, default=2_000)
+    parser.add_argument("--clean", metavar="TAG", help="delete a seed")
+    args = parser.parse_args()
+
+    if args.clean:
+        print(f"deleted {clean(args.clean)} users")
+        return
+    upgrade_schema()
+    start = time.perf_counter()
+    seeded = seed(args.users, args.posts, args.votes, args.comments)
+    print(
+        f"seeded {args.users} users, {args.posts} posts, {args.votes} votes "
+        f"and {args.comments} comments in {time.perf_counter() - start:.1f}s"
+    )
+    print(f"tag: {seeded['tag']}")
+
+
+if __name__ == "__main__":
+    main()
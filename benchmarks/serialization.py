@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the list endpoints: ORM + pydantic against rows + orjson
+
+Seeds full pages of posts, users and comments, then calls each list
+endpoint in-process, one request at a time, with the route on and off
+FAST_JSON_ROUTES. Reports requests per second of wall time and per
+second of CPU time of this process, i.e. per core.
+
+Usage: python -m benchmarks.serialization [--requests N] [--limit N]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from app.config import settings
+from app.database import DB, upgrade_schema
+from app.main import app
+from app.oauth2 import create_access_token
+from app.response_cache import response_cache, comments_tag
+from benchmarks.seed import clean, seed
+
+
+async def measure(client, url: str, requests: int, before=None) -> tuple:
+    """Requests per wall second and per CPU second of a URL"""
+    await client.get(url)  # warm up
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(requests):
+        if before is not None:
+            await before()
+        response = await client.get(url)
+        response.raise_for_status()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return requests / wall, requests / cpu
+
+
+async def run(seeded: dict, post_id: int, requests: int, limit: int):
+    """Measure every list endpoint on both paths"""
+    token = create_access_token({"user_id": seeded["user_ids"][0]})
+    routes = (
+        ("get_posts", f"/posts/?limit={limit}", None),
+        ("get_posts", f"/posts/?limit={limit}&search=generated", None),
+        ("get_all_users", f"/users/?limit={limit}", None),
+        (
+            "get_comments_for_post",
+            f"/comments/{post_id}?limit={limit}",
+            # Measure the serialization, not the response cache
+            lambda: response_cache.invalidate(comments_tag(post_id)),
+        ),
+    )
+    fast_routes = settings.fast_json_routes
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://bench",
+            headers={"Authorization": f"Bearer {token}"},
+        ) as client:
+            print(
+                f"{'url':<40}{'req/s':>16}{'req/cpu-s':>19}{'speedup':>9}"
+            )
+            for name, url, before in routes:
+                settings.fast_json_routes = []
+                slow = await measure(client, url, requests, before)
+                settings.fast_json_routes = [name]
+                fast = await measure(client, url, requests, before)
+                print(
+                    f"{url:<40}{slow[0]:>7.0f} ->{fast[0]:>6.0f}"
+                    f"{slow[1]:>10.0f} ->{fast[1]:>6.0f}"
+                    f"{fast[1] / slow[1]:>8.2f}x"
+                )
+    settings.fast_json_routes = fast_routes
+
+
+def main():
+    """Seed full pages and compare both paths"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=args.limit * 2, posts=args.limit * 2, comments=0)
+    try:
+        post_id = seeded["post_ids"][0]
+        DB().create_comments(
+            [
+                {"post_id": post_id, "content": f"comment {i}"}
+                for i in range(args.limit * 2)
+            ],
+            owner_id=seeded["user_ids"][0],
+        )
+        asyncio.run(run(seeded, post_id, args.requests, args.limit))
+    finally:
+        clean(seeded["tag"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the cached statements of the DB hot-path lookups
+
+Seeds a small dataset, then times find_user, find_post_with_id,
+find_vote and get_comments per call against the session.query chains
+they replaced, on one session so that only the statement work differs.
+Reports wall and CPU microseconds per call (CPU of this process: query
+building and compilation, not the database), the statement and compiled
+cache counters, and fails when a cached statement costs more CPU.
+
+Usage: python -m benchmarks.statements [--runs N]
+"""
+import argparse
+import random
+import sys
+import time
+
+from app import loaders
+from app.database import DB, statement_cache_stats, upgrade_schema
+from app.metrics import compiled_cache_stats
+from app.models import User, Post, Vote, Comment
+from app.pagination import paginate, page
+from benchmarks.seed import clean, seed
+
+
+def query_chains(session) -> dict:
+    """The lookups as they were built before, one query chain per call"""
+
+    def find_user(options: tuple = (), **kwargs):
+        for key, value in kwargs.items():
+            user = (
+                session.query(User)
+                .options(*options)
+                .filter(getattr(User, key) == value)
+                .first()
+            )
+            if user is not None:
+                return user
+
+    def get_comments(post_id: int, limit: int = 10, options: tuple = ()):
+        keys = (Comment.created_at, Comment.id)
+        query = paginate(
+            session.query(Comment)
+            .options(*options)
+            .filter(Comment.post_id == post_id),
+            keys,
+            None,
+            limit,
+        )
+        return page(query.all(), limit, lambda c: (c.created_at, c.id))
+
+    def find_post_with_id(id: int, options: tuple = ()):
+        return session.query(Post).options(*options).filter_by(id=id).first()
+
+    def find_vote(user_id: int, post_id: int):
+        return (
+            session.query(Vote)
+            .filter(Vote.post_id == post_id, Vote.user_id == user_id)
+            .first()
+        )
+
+    return {
+        "find_user": find_user,
+        "find_post_with_id": find_post_with_id,
+        "find_vote": find_vote,
+        "get_comments": get_comments,
+    }
+
+
+def calls(seeded: dict, rng: random.Random) -> dict:
+    """Name of each lookup, and a call of it on a set of methods"""
+    post_ids, user_ids = seeded["post_ids"], seeded["user_ids"]
+    usernames = seeded["usernames"]
+    return {
+        "find_user(username)": lambda m: m["find_user"](
+            username=rng.choice(usernames), options=loaders.USER_DISPLAY
+        ),
+        "find_user(email, username)": lambda m: m["find_user"](
+            email="nobody@bench.io",
+            username=rng.choice(usernames),
+            options=loaders.USER_DISPLAY,
+        ),
+        "find_post_with_id": lambda m: m["find_post_with_id"](
+            id=rng.choice(post_ids), options=loaders.POST_DISPLAY_ALL
+        ),
+        "find_vote": lambda m: m["find_vote"](
+            user_id=rng.choice(user_ids), post_id=rng.choice(post_ids)
+        ),
+        "get_comments": lambda m: m["get_comments"](
+            rng.choice(post_ids), options=loaders.COMMENT_DISPLAY
+        ),
+    }
+
+
+def timed(call, methods: dict, session, runs: int) -> tuple:
+    """Wall and CPU microseconds per call"""
+    call(methods)  # warm up the caches
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(runs):
+        call(methods)
+        session.expunge_all()
+    return (
+        (time.perf_counter() - wall) / runs * 1e6,
+        (time.process_time() - cpu) / runs * 1e6,
+    )
+
+
+def main():
+    """Seed, time both ways, report and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=2_000)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=50, posts=500, votes=2_000, comments=1_000)
+    db = DB()
+    session = db._session
+    cached = {name: getattr(db, name) for name in query_chains(session)}
+    slower = 0
+    try:
+        print(
+            f"{'lookup':<28}{'query us':>10}{'cached us':>11}"
+            f"{'query cpu':>11}{'cached cpu':>12}{'saved':>8}"
+        )
+        for name, call in calls(seeded, random.Random(42)).items():
+            query_wall, query_cpu = timed(
+                call, query_chains(session), session, args.runs
+            )
+            cached_wall, cached_cpu = timed(call, cached, session, args.runs)
+            slower += cached_cpu >= query_cpu
+            print(
+                f"{name:<28}{query_wall:>10.0f}{cached_wall:>11.0f}"
+                f"{query_cpu:>11.0f}{cached_cpu:>12.0f}"
+                f"{1 - cached_cpu / query_cpu:>8.0%}"
+            )
+    finally:
+        session.close()
+        clean(seeded["tag"])
+    print("statements", statement_cache_stats())
+    print("compiled", compiled_cache_stats())
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
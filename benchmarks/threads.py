@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark of comment threads on one large post
+
+Seeds a post with --top top-level comments and --replies replies, each
+answering a random earlier comment of the post, created through
+DB.create_comments in batches. Then walks every page of GET
+/comments/{post_id}/threads and every page of GET
+/comments/{comment_id}/replies under the top-level comment with the
+most replies, reporting milliseconds and statements per page for the
+first and last pages. Fails when a page takes more statements than its
+route's fixed count, or when a reply_count disagrees with the replies
+stored.
+
+Usage: python -m benchmarks.threads [--top N] [--replies N] [--limit N]
+"""
+import argparse
+import random
+import sys
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from app.config import settings
+from app.database import DB, get_session_factory, upgrade_schema
+from app.main import app
+from app.metrics import current_route
+from app.models import Comment
+from benchmarks.query_counts import StatementCounter
+from benchmarks.seed import clean, seed
+
+# Statements per page: the comments version and the threads, the replies
+STATEMENTS = {"threads": 2, "replies": 1}
+
+
+class RouteStatements(StatementCounter):
+    """Count the statements of routes, not of background tasks"""
+
+    def __call__(self, *args, **kwargs):
+        """before_cursor_execute listener"""
+        if current_route() is not None:
+            self.count += 1
+
+
+def build(post_id: int, user_ids: list, top: int, replies: int) -> list:
+    """Create the comments of the post, return their ids"""
+    rng = random.Random(42)
+    db = DB()
+    deepest = settings.comment_max_depth
+    ids, depths = [], {}
+    kinds = [False] * top + [True] * replies
+    for start in range(0, len(kinds), settings.batch_max_items):
+        comments = []
+        for reply in kinds[start : start + settings.batch_max_items]:
+            parent_id = rng.choice(ids) if reply and ids else None
+            # Past the deepest reply allowed, answer another comment
+            while parent_id and depths[parent_id] >= deepest:
+                parent_id = rng.choice(ids)
+            comments.append(
+                {"post_id": post_id, "content": "reply", "parent_id": parent_id}
+            )
+        created = db.create_comments(comments, owner_id=rng.choice(user_ids))
+        for comment, id in zip(comments, created):
+            parent_id = comment["parent_id"]
+            depths[id] = depths[parent_id] + 1 if parent_id else 0
+            ids.append(id)
+    db._session.close()
+    return ids
+
+
+def wrong_counts(post_id: int) -> int:
+    """Comments of the post whose reply_count disagrees with their replies"""
+    reply = aliased(Comment)
+    replies = (
+        select(func.count())
+        .where(reply.parent_id == Comment.id)
+        .correlate(Comment)
+        .scalar_subquery()
+    )
+    with get_session_factory()() as session:
+        return session.scalar(
+            select(func.count())
+            .select_from(Comment)
+            .where(Comment.post_id == post_id)
+            .where(Comment.reply_count != replies)
+        )
+
+
+def walk(client, url: str, params: dict, counter) -> list:
+    """Fetch every page of a route, return (ms, statements, items) each"""
+    pages, cursor = [], None
+    while True:
+        counter.count = 0
+        start = time.perf_counter()
+        response = client.get(
+            url, params={**params, **({"cursor": cursor} if cursor else {})}
+        )
+        response.raise_for_status()
+        elapsed = (time.perf_counter() - start) * 1e3
+        pages.append((elapsed, counter.count, len(response.json())))
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pages
+
+
+def report(name: str, pages: list) -> int:
+    """Print the pages of a walk, return the count of pages over budget"""
+    first, last = pages[0], pages[-1]
+    items = sum(page[2] for page in pages)
+    print(
+        f"{name:<10}{len(pages):>7}{items:>9}"
+        f"{first[0]:>10.1f}{last[0]:>10.1f}"
+        f"{max(page[1] for page in pages):>12}"
+    )
+    return sum(page[1] > STATEMENTS[name] for page in pages)
+
+
+def main():
+    """Seed, walk the threads and replies, check and clean up"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--top", type=int, default=500)
+    parser.add_argument("--replies", type=int, default=50_000)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=20, posts=1, votes=0, comments=0)
+    post_id = seeded["post_ids"][0]
+    try:
+        start = time.perf_counter()
+        ids = build(post_id, seeded["user_ids"], args.top, args.replies)
+        print(f"{len(ids):,} comments in {time.perf_counter() - start:.1f}s")
+        wrong = wrong_counts(post_id)
+        counter = RouteStatements()
+        with TestClient(app) as client:
+            counter.attach()
+            threads = walk(
+                client,
+                f"/comments/{post_id}/threads",
+                {"limit": args.limit, "replies": 3},
+                counter,
+            )
+            largest = client.get(
+                f"/comments/{post_id}/threads", params={"limit": 100}
+            ).json()
+            root = max(largest, key=lambda thread: thread["reply_count"])
+            replies = walk(
+                client,
+                f"/comments/{root['id']}/replies",
+                {"limit": args.limit},
+                counter,
+            )
+        print(
+            f"{'route':<10}{'pages':>7}{'items':>9}"
+            f"{'first ms':>10}{'last ms':>10}{'statements':>12}"
+        )
+        over = report("threads", threads) + report("replies", replies)
+    finally:
+        clean(seeded["tag"])
+    print(f"reply counts disagreeing with the replies: {wrong}")
+    return 1 if over or wrong else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark of a vote burst on one post, with and without coalescing
+
+Seeds users and one post, then has every user vote on the post at once,
+and remove the vote at once, in-process. Runs the burst with each vote
+written on its own, then with the votes coalesced per --window-ms, and
+reports votes per second and statements per vote. Fails if the post's
+vote_count ever disagrees with its votes.
+
+Usage: python -m benchmarks.votes [--users N] [--concurrency N]
+           [--window-ms MS]
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+from sqlalchemy import event, func, select
+
+from app.database import (
+    get_session_factory,
+    init_async_db,
+    init_db,
+    upgrade_schema,
+)
+from app.main import app
+from app.models import Post, Vote
+from app.oauth2 import create_access_token
+from app.vote_coalescer import vote_coalescer
+from benchmarks.seed import clean, seed
+
+
+class StatementCounter:
+    """Count the statements of both engines"""
+
+    def __init__(self):
+        """Initialize StatementCounter"""
+        self.count = 0
+
+    def __call__(self, *args):
+        """before_cursor_execute listener"""
+        self.count += 1
+
+    def attach(self):
+        """Listen on the sync engine and the asyncpg engine"""
+        for engine in (init_db(), init_async_db().sync_engine):
+            event.listen(engine, "before_cursor_execute", self)
+
+
+def counts_agree(post_id: int) -> bool:
+    """Whether vote_count matches the votes of the post"""
+    with get_session_factory()() as session:
+        stored = session.scalar(select(Post.vote_count).filter_by(id=post_id))
+        actual = session.scalar(
+            select(func.count()).select_from(Vote).filter_by(post_id=post_id)
+        )
+    return stored == actual
+
+
+async def burst(client, tokens: list, post_id: int, dir: int, limit: int):
+    """Every user votes at once, at most limit requests in flight"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def one(token):
+        async with semaphore:
+            response = await client.post(
+                "/votes/",
+                json={"post_id": post_id, "dir": dir},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            response.raise_for_status()
+
+    await asyncio.gather(*(one(token) for token in tokens))
+
+
+async def run(seeded: dict, concurrency: int, window_ms: float) -> bool:
+    """Run the burst per mode, return whether the counts stayed right"""
+    post_id = seeded["post_ids"][0]
+    tokens = [create_access_token({"user_id": u}) for u in seeded["user_ids"]]
+    counter = StatementCounter()
+    consistent = True
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        counter.attach()
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            print(f"{'mode':<24}{'votes/s':>10}{'statements/vote':>17}")
+            for mode, window in (("one by one", 0), ("coalesced", window_ms)):
+                vote_coalescer.window = window / 1000
+                for dir in (1, 0):
+                    counter.count = 0
+                    start = time.perf_counter()
+                    await burst(client, tokens, post_id, dir, concurrency)
+                    elapsed = time.perf_counter() - start
+                    label = f"{mode}, {'up' if dir else 'remove'}"
+                    print(
+                        f"{label:<24}{len(tokens) / elapsed:>10.0f}"
+                        f"{counter.count / len(tokens):>17.2f}"
+                    )
+                    consistent &= counts_agree(post_id)
+    return consistent
+
+
+def main():
+    """Seed users, run the bursts and check the vote count"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--window-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    upgrade_schema()
+    seeded = seed(users=args.users, posts=1, votes=0, comments=0)
+    try:
+        consistent = asyncio.run(run(seeded, args.concurrency, args.window_ms))
+    finally:
+        clean(seeded["tag"])
+    if not consistent:
+        print("vote_count disagrees with the votes")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Mixed workload against the API, with latency percentiles per route
+
+Seeds a dataset, then runs concurrent virtual users that log in and pick
+routes by weight: list posts, hot feed, get post, vote and comment. Runs
+against app.main:app in-process by default, or against a running server
+with --url (which must use the same database, and should run with
+RATE_LIMITS='{}', the virtual users sharing one address). Results can be
+saved as JSON and compared to a previous run; regressions make the exit
+code 1.
+
+Usage: python -m benchmarks.workload [--requests N] [--concurrency N]
+           [--url URL] [--users N] [--posts N] [--votes N] [--comments N]
+           [--output FILE] [--compare FILE] [--threshold 0.2]
+"""
+import argparse
+import asyncio
+import collections
+import random
+import sys
+import time
+
+import httpx
+
+from app.config import settings
+from app.database import upgrade_schema
+from app.main import app
+from benchmarks import results as res
+from benchmarks.seed import PASSWORD, clean, seed
+
+# Share of each route in the mix; every virtual user logs in once first
+MIX = {
+    "list posts": 30,
+    "hot feed": 10,
+    "get post": 35,
+    "vote": 15,
+    "comment": 10,
+}
+
+
+class VirtualUser:
+    """A seeded user sending requests and recording their latency"""
+
+    def __init__(self, client, username: str, post_ids: list, rng, timings):
+        """Initialize VirtualUser"""
+        self.client = client
+        self.username = username
+        self.post_ids = post_ids
+        self.rng = rng
+        self.timings = timings
+        self.errors = collections.Counter()
+        self.headers = {}
+
+    async def request(
+        self, route: str, method: str, url: str, expected=(), **kwargs
+    ):
+        """Send a request, record its latency and unexpected errors"""
+        start = time.perf_counter()
+        response = await self.client.request(
+            method, url, headers=self.headers, **kwargs
+        )
+        self.timings[route].append((time.perf_counter() - start) * 1000)
+        code = response.status_code
+        if code >= 400 and code not in expected:
+            self.errors[f"{route} {code}"] += 1
+        return response
+
+    async def login(self):
+        """Log in and keep the token"""
+        response = await self.request(
+            "login",
+            "POST",
+            "/auth/login",
+            data={"username": self.username, "password": PASSWORD},
+        )
+        token = response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def step(self):
+        """Send one request of the mix"""
+        route = self.rng.choices(list(MIX), weights=list(MIX.values()))[0]
+        post_id = self.rng.choice(self.post_ids)
+        if route == "list posts":
+            await self.request(route, "GET", "/posts/")
+        elif route == "hot feed":
+            await self.request(route, "GET", "/posts/hot")
+        elif route == "get post":
+            await self.request(route, "GET", f"/posts/{post_id}")
+        elif route == "vote":
+            # Upvote, and take it back when the post was already voted
+            response = await self.request(
+                route,
+                "POST",
+                "/votes/",
+                expected=(400,),
+                json={"post_id": post_id, "dir": 1},
+            )
+            if response.status_code == 400:
+                await self.request(
+                    route,
+                    "POST",
+                    "/votes/",
+                    json={"post_id": post_id, "dir": 0},
+                )
+        else:
+            await self.request(
+                route,
+                "POST",
+                "/comments/",
+                json={"post_id": post_id, "content": "bench comment"},
+            )
+
+
+async def run(client, seeded: dict, requests: int, concurrency: int):
+    """Run the virtual users, return the timings, errors and duration"""
+    timings = collections.defaultdict(list)
+    rng = random.Random(7)
+    users = [
+        VirtualUser(
+            client,
+            rng.choice(seeded["usernames"]),
+            seeded["post_ids"],
+            random.Random(i),
+            timings,
+        )
+        for i in range(concurrency)
+    ]
+    remaining = requests
+
+    async def worker(user: VirtualUser):
+        nonlocal remaining
+        await user.login()
+        while remaining > 0:
+            remaining -= 1
+            await user.step()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in users))
+    elapsed = time.perf_counter() - start
+    errors = sum((user.errors for user in users), collections.Counter())
+    return timings, +errors, elapsed
+
+
+async def run_workload(args, seeded: dict):
+    """Run against the app in-process, or over HTTP with --url"""
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            return await run(client, seeded, args.requests, args.concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=60
+        ) as client:
+            return await run(client, seeded, args.requests, args.concurrency)
+
+
+def main():
+    """Seed, run the workload, report and compare"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--url", help="base URL of a running server")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1_000)
+    parser.add_argument("--votes", type=int, default=5_000)
+    parser.add_argument("--comments", type=int, default=2_000)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    settings.rate_limits = {}
+
+    upgrade_schema()
+    seeded = seed(args.users, args.posts, args.votes, args.comments)
+    try:
+        timings, errors, elapsed = asyncio.run(run_workload(args, seeded))
+    finally:
+        clean(seeded["tag"])
+
+    results = {
+        route: res.summarize(values, elapsed)
+        for route, values in sorted(timings.items())
+    }
+    total = sum(len(values) for values in timings.values())
+    print(f"{total} requests in {elapsed:.2f}s: {total / elapsed:.1f} req/s")
+    res.print_table(results)
+    for error, count in errors.items():
+        print(f"errors: {error} x{count}")
+    if args.output:
+        res.save(
+            args.output,
+            results,
+            benchmark="workload",
+            target=args.url or "in-process",
+            requests=args.requests,
+            concurrency=args.concurrency,
+        )
+    if args.compare:
+        return res.check(args.compare, results, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
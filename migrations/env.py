@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Alembic environment: migrate the database configured in app.config
+"""
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from app.database import get_db_url
+from app.models import Base
+
+# Held while migrating, so workers starting together migrate one at a time
+MIGRATION_LOCK = 7_140_001
+
+target_metadata = Base.metadata
+
+# Log like the CLI, unless called by app.database.upgrade_schema
+if context.config.attributes.get("connection") is None:
+    fileConfig(context.config.config_file_name, disable_existing_loggers=False)
+
+
+def run_migrations_offline():
+    """Emit the migrations as SQL, for --sql"""
+    context.configure(
+        url=get_db_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Run the migrations against the database"""
+    connection = context.config.attributes.get("connection")
+    if connection is not None:
+        _run(connection)
+        return
+    engine = create_engine(get_db_url(), poolclass=pool.NullPool)
+    with engine.connect() as connection:
+        _run(connection)
+
+
+def _run(connection):
+    """Run the migrations on a connection, under the migration lock"""
+    connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK})")
+    connection.commit()
+    try:
+        context.configure(
+            connection=connection, target_metadata=target_metadata
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+        connection.commit()
+    finally:
+        connection.exec_driver_sql(
+            f"SELECT pg_advisory_unlock({MIGRATION_LOCK})"
+        )
+        connection.commit()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,50 @@
+"""Index posts and comments by owner
+
+Serves the posts of a user (GET /users/me) and the ON DELETE CASCADE of
+users, which scanned both tables. Built CONCURRENTLY so writes go on
+while the indexes build.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create the owner indexes without locking out writes"""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_posts_owner_id",
+            "posts",
+            ["owner_id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_comments_owner_id",
+            "comments",
+            ["owner_id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    """Drop the owner indexes"""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_comments_owner_id",
+            table_name="comments",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_posts_owner_id",
+            table_name="posts",
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,93 @@
+"""Thread comments with a materialized path
+
+Adds parent_id, the ancestry of each comment and the path and depth
+Postgres derives from it, and a reply_count per comment. Existing
+comments become top-level ones. The generated columns rewrite the table
+under an exclusive lock, once; the indexes are then built CONCURRENTLY
+so writes go on while they build.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add the thread columns, then index them without locking out writes"""
+    op.add_column("comments", sa.Column("parent_id", sa.Integer()))
+    op.create_foreign_key(
+        "comments_parent_id_fkey",
+        "comments",
+        "comments",
+        ["parent_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.add_column(
+        "comments",
+        sa.Column(
+            "ancestry",
+            sa.String(collation="C"),
+            nullable=False,
+            server_default="",
+        ),
+    )
+    op.add_column(
+        "comments",
+        sa.Column(
+            "reply_count", sa.Integer(), nullable=False, server_default="0"
+        ),
+    )
+    # One statement, so the table is rewritten once for both columns
+    op.execute(
+        "ALTER TABLE comments"
+        " ADD COLUMN path VARCHAR COLLATE \"C\" GENERATED ALWAYS AS"
+        " (ancestry || lpad(to_hex(id), 8, '0')) STORED,"
+        " ADD COLUMN depth INTEGER GENERATED ALWAYS AS"
+        " (length(ancestry) / 8) STORED"
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_comments_post_id_top_level",
+            "comments",
+            ["post_id", "id"],
+            postgresql_where=sa.text("parent_id IS NULL"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_comments_parent_id",
+            "comments",
+            ["parent_id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_comments_post_id_path",
+            "comments",
+            ["post_id", "path"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    """Drop the thread indexes and columns"""
+    with op.get_context().autocommit_block():
+        for name in (
+            "ix_comments_post_id_path",
+            "ix_comments_parent_id",
+            "ix_comments_post_id_top_level",
+        ):
+            op.drop_index(
+                name, table_name="comments", postgresql_concurrently=True
+            )
+    for column in ("depth", "path", "reply_count", "ancestry", "parent_id"):
+        op.drop_column("comments", column)
@@ -0,0 +1,55 @@
+"""Keyset pagination indexes
+
+The indexes create_all built for keyset pagination on top of the first
+release, before migrations existed. Databases stamped with 0001 may hold
+them already, so each is only created when missing, CONCURRENTLY so
+writes go on while they build.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+# (name, table, columns) of the indexes, in creation order
+INDEXES = (
+    ("ix_users_created_at_id", "users", ["created_at", "id"]),
+    ("ix_posts_created_at_id", "posts", ["created_at", "id"]),
+    (
+        "ix_comments_post_id_created_at_id",
+        "comments",
+        ["post_id", "created_at", "id"],
+    ),
+    (
+        "ix_votes_post_id_created_at_user_id",
+        "votes",
+        ["post_id", "created_at", "user_id"],
+    ),
+)
+
+
+def upgrade():
+    """Build the missing indexes without locking out writes"""
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade():
+    """Drop the indexes"""
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(
+                name, table_name=table, postgresql_concurrently=True
+            )
@@ -0,0 +1,48 @@
+"""Full-text search vector of posts
+
+posts.search_vector, maintained by Postgres from the title and the
+content, and its GIN index. Databases stamped with 0001 may hold both
+already, from create_all, so each is only added when missing. The column
+rewrites the posts table under an exclusive lock, once; the index is
+then built CONCURRENTLY so writes go on while it builds.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add the search vector, then index it without locking out writes"""
+    op.execute(
+        "ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector TSVECTOR"
+        " GENERATED ALWAYS AS"
+        " (setweight(to_tsvector('english', title), 'A')"
+        " || setweight(to_tsvector('english', content), 'B')) STORED"
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_posts_search_vector",
+            "posts",
+            ["search_vector"],
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade():
+    """Drop the index and the search vector"""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_posts_search_vector",
+            table_name="posts",
+            postgresql_concurrently=True,
+        )
+    op.drop_column("posts", "search_vector")
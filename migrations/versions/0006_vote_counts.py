@@ -0,0 +1,40 @@
+"""Materialized vote counts of posts
+
+posts.vote_count, backfilled from the votes. Databases stamped with 0001
+may hold it already, from create_all, so it is only added when missing,
+and only the posts whose count is off are written.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add the vote counts and backfill them"""
+    op.add_column(
+        "posts",
+        sa.Column(
+            "vote_count", sa.Integer(), nullable=False, server_default="0"
+        ),
+        if_not_exists=True,
+    )
+    op.execute(
+        "UPDATE posts SET vote_count = counts.votes"
+        " FROM (SELECT posts.id, count(votes.post_id) AS votes"
+        " FROM posts LEFT JOIN votes ON votes.post_id = posts.id"
+        " GROUP BY posts.id) AS counts"
+        " WHERE posts.id = counts.id AND posts.vote_count <> counts.votes"
+    )
+
+
+def downgrade():
+    """Drop the vote counts"""
+    op.drop_column("posts", "vote_count")
@@ -0,0 +1,4 @@
+#!/usr/bin/env python3
+"""
+Package for tests of the API
+"""
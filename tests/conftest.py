@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Fixtures shared by the tests, run against the database of .env
+
+Without a usable database, every test module is skipped without being
+imported.
+"""
+import functools
+
+import pytest
+from pydantic import ValidationError
+from sqlalchemy.exc import OperationalError
+
+
+@functools.cache
+def database_unavailable() -> str:
+    """Why the database of .env cannot be used, if it cannot"""
+    try:
+        from app.database import init_db
+
+        with init_db().connect():
+            return ""
+    except (ValidationError, OperationalError) as e:
+        return f"no usable database in .env: {e.__class__.__name__}"
+
+
+class SkippedModule(pytest.Module):
+    """A test module left unimported, reported as skipped"""
+
+    def collect(self):
+        """Skip the whole module"""
+        pytest.skip(database_unavailable())
+
+
+def pytest_pycollect_makemodule(module_path, parent):
+    """Skip the test modules when the database cannot be used"""
+    if database_unavailable():
+        return SkippedModule.from_parent(parent, path=module_path)
+
+
+@pytest.fixture(scope="session")
+def client():
+    """A client of the app, started once for every test"""
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
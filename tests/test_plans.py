@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests of the query plans of every route
+
+The data is seeded large enough for the planner to prefer the indexes,
+then every route is called as by benchmarks.plans and each statement it
+sent is EXPLAINed with its own parameters.
+"""
+import json
+
+import pytest
+
+from benchmarks.plans import (
+    StatementRecorder,
+    explain,
+    large_tables,
+    run_steps,
+    unindexed_foreign_keys,
+)
+from benchmarks.seed import clean, seed
+
+# Tables of this many rows or more must never be scanned sequentially
+MIN_ROWS = 1_000
+
+
+@pytest.fixture(scope="module")
+def seeded(client):
+    """Users, posts, votes and comments past MIN_ROWS each"""
+    seeded = seed(users=1_000, posts=5_000, votes=10_000, comments=5_000)
+    yield seeded
+    clean(seeded["tag"])
+
+
+def test_foreign_keys_indexed(client):
+    """Every foreign key leads an index, for the lookups of its cascade"""
+    assert unindexed_foreign_keys() == []
+
+
+def test_no_sequential_scan(client, seeded):
+    """No statement of a route scans a large table sequentially"""
+    recorder = StatementRecorder()
+    recorder.attach()
+    try:
+        run_steps(client, seeded, recorder)
+    finally:
+        recorder.detach()
+    large = large_tables(MIN_ROWS)
+    assert large >= {"users", "posts", "votes", "comments"}
+    failures = [
+        f"{step}: seq scan of {', '.join(tables)}\n{statement}\n"
+        f"{json.dumps(plan, indent=2)}"
+        for step, tables, statement, plan in explain(
+            recorder.statements, large
+        )
+    ]
+    assert not failures, "\n\n".join(failures)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Tests of the number of statements each read endpoint runs
+
+The data is seeded at two sizes: a count that grows with the data is an
+N+1 lazy load come back. Statements are read from the Server-Timing
+header, which counts those of the request only.
+"""
+import re
+import uuid
+
+import pytest
+
+from app.database import DB
+from app.oauth2 import create_access_token
+from app.utils import hash_password
+
+# Statements per endpoint, whatever the size of the data
+STATEMENTS = {
+    "/posts/{post_id}": 2,
+    "/posts/": 1,
+    "/users/me": 2,
+    "/users/": 1,
+    "/users/{user_id}": 1,
+    "/comments/{post_id}": 2,
+    "/comments/{post_id}/threads": 2,
+    "/comments/{comment_id}/replies": 1,
+}
+
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def seed(db: DB, size: int) -> dict:
+    """Create an owner with `size` posts, voters and comments on one post
+
+    The comments form one thread: comment i replies to comment (i - 1) / 2.
+    """
+    tag = uuid.uuid4().hex[:8]
+    hashed_password = hash_password("test")
+    owner = db.create_user(
+        f"owner_{tag}", f"owner_{tag}@test.io", hashed_password=hashed_password
+    )
+    posts = [
+        db.create_post(f"post {i}", "content", owner_id=owner.id)
+        for i in range(size)
+    ]
+    post = posts[0]
+    user_ids = [owner.id]
+    comment_ids = []
+    for i in range(size):
+        voter = db.create_user(
+            f"voter_{tag}_{i}",
+            f"voter_{tag}_{i}@test.io",
+            hashed_password=hashed_password,
+        )
+        user_ids.append(voter.id)
+        db.vote(user_id=voter.id, post_id=post.id, dir=1)
+        comment = db.create_comment(
+            "comment",
+            post_id=post.id,
+            owner_id=voter.id,
+            parent_id=comment_ids[(i - 1) // 2] if i else None,
+        )
+        comment_ids.append(comment.id)
+    return {
+        "user_id": owner.id,
+        "post_id": post.id,
+        "comment_id": comment_ids[0],
+        "user_ids": user_ids,
+    }
+
+
+def statements(response) -> int:
+    """Statements a request ran, from its Server-Timing header"""
+    return int(QUERIES.search(response.headers["Server-Timing"]).group(1))
+
+
+@pytest.fixture(scope="module", params=(1, 20), ids="size {}".format)
+def seeded(request, client):
+    """An owner with posts, voters and one thread of comments"""
+    db = DB()
+    seeded = seed(db, request.param)
+    token = create_access_token({"user_id": seeded["user_id"]})
+    seeded["headers"] = {"Authorization": f"Bearer {token}"}
+    # Measure every endpoint with the owner in the principal cache
+    client.get("/users/me", headers=seeded["headers"]).raise_for_status()
+    yield seeded
+    for user_id in seeded["user_ids"]:
+        db.delete_user(user_id)
+    db._session.close()
+
+
+@pytest.mark.parametrize("endpoint", STATEMENTS)
+def test_statement_count(client, seeded, endpoint):
+    """An endpoint runs its fixed number of statements"""
+    response = client.get(endpoint.format(**seeded), headers=seeded["headers"])
+    assert response.status_code == 200
+    assert statements(response) == STATEMENTS[endpoint]